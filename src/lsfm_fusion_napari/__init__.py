@@ -1,8 +1,20 @@
 __version__ = "0.0.1"
-from ._widget import FusionWidget
-from ._writer import write_tiff
 
 __all__ = (
     "write_tiff",
     "FusionWidget",
 )
+
+
+def __getattr__(name):
+    # the submodules pull in Qt and napari, so they are only imported on
+    # first access to keep plugin discovery fast
+    if name == "FusionWidget":
+        from ._widget import FusionWidget
+
+        return FusionWidget
+    if name == "write_tiff":
+        from ._writer import write_tiff
+
+        return write_tiff
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
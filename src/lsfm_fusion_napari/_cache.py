@@ -0,0 +1,353 @@
+"""
+Content-addressed cache of fusion results.
+
+Results are stored as .npy files named after a hash of the input images and
+of every parameter that changes the result. Memory-mapped images are keyed
+on their file instead of their content, see image_token. Rerunning a fusion
+on the same data with the same parameters loads the stored result as a
+memory map instead of running FUSE again. The cache is limited to a number
+of bytes, the least recently used results are evicted first. A cache in a
+scratch root shares the budget of its runs, see ScratchStore.cache.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import inspect
+import json
+import os
+from pathlib import Path
+from typing import Any, Callable, Collection, Generator
+
+import numpy as np
+
+from ._fusion import image_keys, mapped_file
+from ._normalization import iter_data_chunks
+
+# default size limit of a cache directory
+CACHE_BYTES = 16 * 1024**3
+
+# parameters that don't change the fused image
+_IGNORED_PARAMETERS = ("tmp_path", "keep_intermediates")
+
+# arguments of fusion functions that don't change the fused image
+_IGNORED_ARGUMENTS = ("workers",)
+
+
+def hash_array(data) -> str:
+    """
+    Hash the shape, dtype and content of an array chunk by chunk
+
+    Parameters
+    ----------
+    data : array-like
+        In-memory, memory-mapped or lazy array
+
+    Returns
+    -------
+    str
+        Hex digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{data.shape}{np.dtype(data.dtype).str}".encode())
+    for chunk in iter_data_chunks(data):
+        digest.update(np.ascontiguousarray(data[chunk]).data)
+    return digest.hexdigest()
+
+
+def image_token(data) -> str:
+    """
+    Identify an image for a cache key
+
+    Memory-mapped images are identified by the path, size and modification
+    time of their file and the region they view, so their files are not
+    read for every run. Other images are hashed, see hash_array.
+
+    Parameters
+    ----------
+    data : array-like
+        In-memory, memory-mapped or lazy array
+
+    Returns
+    -------
+    str
+        Hex digest
+    """
+    region = mapped_file(data)
+    if region is None:
+        return hash_array(data)
+    filename, offset, _, start = region
+    stat = os.stat(filename)
+    description = [
+        os.path.abspath(filename),
+        stat.st_size,
+        stat.st_mtime_ns,
+        offset,
+        start,
+        data.shape,
+        np.dtype(data.dtype).str,
+        data.strides,
+    ]
+    text = json.dumps(description)
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+def _result_file(data) -> str | None:
+    # .npy file holding exactly data, which can be moved into the cache
+    region = mapped_file(data)
+    if region is None:
+        return None
+    filename, offset, nbytes, start = region
+    if (
+        not filename.endswith(".npy")
+        or start != 0
+        or nbytes != data.nbytes
+        or not data.flags.c_contiguous
+        or offset + nbytes != os.path.getsize(filename)
+    ):
+        return None
+    return filename
+
+
+def cache_key(params: dict[str, Any], *extra) -> str:
+    """
+    Key of a fusion result
+
+    Parameters
+    ----------
+    params : dict
+        Parameters as compiled by FusionWidget._get_parameters
+    *extra
+        Further JSON-serializable arguments that change the result, like
+        the slab geometry of a tiled fusion
+
+    Returns
+    -------
+    str
+        Hex digest of the images, the parameters and extra, see image_token
+    """
+    names = [
+        f"image{index}"
+        for index in image_keys(params["method"], params["amount"])
+    ]
+    description = {
+        key: value
+        for key, value in params.items()
+        if key not in names and key not in _IGNORED_PARAMETERS
+    }
+    description["images"] = [image_token(params[name]) for name in names]
+    description["extra"] = extra
+    text = json.dumps(description, sort_keys=True, default=str)
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+def result_arguments(
+    run: Callable[..., Any], params: dict[str, Any], *args
+) -> dict[str, Any]:
+    """
+    Arguments of a fusion function besides params that change its result
+
+    Omitted arguments are filled in with their defaults and arguments like
+    the number of workers are left out, so runs that only differ in their
+    parallelism share a key.
+
+    Parameters
+    ----------
+    run : callable
+        Fusion function like _tiling.run_tiled_fusion
+    params : dict
+        Its first argument
+    *args
+        Its further arguments
+
+    Returns
+    -------
+    dict
+        Arguments by name
+    """
+    bound = inspect.signature(run).bind(params, *args)
+    bound.apply_defaults()
+    _, *arguments = bound.arguments.items()
+    return {
+        name: value
+        for name, value in arguments
+        if name not in _IGNORED_ARGUMENTS
+    }
+
+
+class FusionCache:
+    """
+    Directory of fusion results limited to a number of bytes
+
+    Parameters
+    ----------
+    directory : str or Path
+        Directory of the cached results, created if missing
+    max_bytes : int, optional
+        Size limit, by default CACHE_BYTES
+    keep : collection of Path, optional
+        Resolved paths of results never evicted, like the pinned ones of a
+        scratch root, see ScratchStore.pin
+    """
+
+    def __init__(
+        self,
+        directory: str | Path,
+        max_bytes: int = CACHE_BYTES,
+        keep: Collection[Path] = (),
+    ):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.keep = keep
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.npy"
+
+    def __contains__(self, key: str) -> bool:
+        return self._path(key).exists()
+
+    def get(self, key: str) -> np.ndarray | None:
+        """
+        Cached result as a read-only memory map, None if not cached
+        """
+        path = self._path(key)
+        try:
+            data = np.load(path, mmap_mode="r")
+        except (OSError, ValueError):
+            return None
+        # the modification time orders the entries for eviction
+        os.utime(path)
+        return data
+
+    def put(self, key: str, data) -> np.ndarray:
+        """
+        Store a result and evict old results if needed
+
+        A result memory-mapped from a whole .npy file, like the result of
+        run_fusion, is moved into the cache or hard-linked where it can't be
+        moved. Other results are copied chunk by chunk.
+
+        Returns
+        -------
+        np.ndarray
+            The stored result as a read-only memory map
+        """
+        data_bytes = int(np.prod(data.shape)) * np.dtype(data.dtype).itemsize
+        self.evict(self.max_bytes - data_bytes)
+        path = self._path(key)
+        partial_path = path.with_suffix(".partial.npy")
+        if not self._take(data, partial_path):
+            out = np.lib.format.open_memmap(
+                partial_path, mode="w+", dtype=data.dtype, shape=data.shape
+            )
+            for chunk in iter_data_chunks(data):
+                out[chunk] = np.asarray(data[chunk])
+            out.flush()
+            del out
+        # results become visible only once complete
+        os.replace(partial_path, path)
+        return np.load(path, mmap_mode="r")
+
+    @staticmethod
+    def _take(data, path: Path) -> bool:
+        # moves or links the file of a result to path, False if it has none
+        source = _result_file(data)
+        if source is None:
+            return False
+        try:
+            # on Windows, files mapped by a layer can't be moved
+            os.replace(source, path)
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.link(source, path)
+                return True
+            return False
+        return True
+
+    def entries(self) -> list[Path]:
+        """
+        Files of all cached results, least recently used first
+        """
+        paths = [
+            path
+            for path in self.directory.glob("*.npy")
+            if not path.name.endswith(".partial.npy")
+        ]
+        return sorted(paths, key=lambda path: path.stat().st_mtime)
+
+    def size(self) -> int:
+        """
+        Total size of all cached results in bytes
+        """
+        return sum(path.stat().st_size for path in self.entries())
+
+    def evict(self, max_bytes: int | None = None):
+        """
+        Delete the least recently used results until the cache fits
+
+        Parameters
+        ----------
+        max_bytes : int, optional
+            Size to shrink the cache to, by default self.max_bytes
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = self.entries()
+        total = sum(path.stat().st_size for path in entries)
+        for path in entries:
+            if total <= max_bytes:
+                break
+            if path.resolve() in self.keep:
+                continue
+            size = path.stat().st_size
+            try:
+                path.unlink()
+            except OSError:
+                # still memory-mapped by a layer on some platforms
+                continue
+            total -= size
+
+
+def run_cached(
+    cache: FusionCache,
+    run: Callable[..., Generator[tuple[int, int, str], None, Any]],
+    params: dict[str, Any],
+    *args,
+) -> Generator[tuple[int, int, str], None, np.ndarray]:
+    """
+    Run a fusion generator unless its result is cached
+
+    Parameters
+    ----------
+    cache : FusionCache
+        Cache to look up and store the result in
+    run : callable
+        Generator function like _fusion.run_fusion, called with params
+        and args
+    params : dict
+        Parameters as compiled by FusionWidget._get_parameters
+    *args
+        Further arguments of run, those changing the result are part of
+        the cache key, see result_arguments
+
+    Yields
+    ------
+    tuple[int, int, str]
+        Progress as yielded by run
+
+    Returns
+    -------
+    np.ndarray
+        Fused image
+    """
+    yield 0, 1, "Hashing inputs"
+    key = cache_key(params, run.__name__, result_arguments(run, params, *args))
+    output_image = cache.get(key)
+    if output_image is not None:
+        yield 1, 1, "Loaded result from cache"
+        return output_image
+    output_image = yield from run(params, *args)
+    yield 1, 1, "Storing result in cache"
+    return cache.put(key, output_image)
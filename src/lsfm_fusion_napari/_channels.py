@@ -0,0 +1,134 @@
+"""
+Fusion of multi-channel images with FUSE on a reference channel only.
+
+All channels of a view are acquired with the same geometry, so the blend
+weights that FUSE finds for the reference channel apply to the others.
+The reference channel is fused with FUSE, its weights are fitted to the
+result and the other channels are weighed the same way in parallel
+threads, see _weights. Channels are handled like the timepoints of a
+time-lapse fusion with the reference channel as the only keyframe, so
+registered or flipped views are refused like there, see _weights.validate_reuse.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import time
+from pathlib import Path
+from typing import Any, Generator
+
+import numpy as np
+
+from ._timelapse import fuse_keyframe
+from ._weights import validate_reuse, view_images
+
+
+def channels_first(data, axes: str | None = None):
+    """
+    View of an image with its channel axis first
+
+    Parameters
+    ----------
+    data : array-like
+        Image with a channel axis, may be lazy or memory-mapped
+    axes : str, optional
+        Dimension order like "ZCYX" as stored by the reader, by default
+        the channel axis is assumed to be first already
+
+    Returns
+    -------
+    array-like
+        Image of shape (C, Z, Y, X)
+    """
+    if axes and len(axes) == data.ndim and "C" in axes.upper():
+        return np.moveaxis(data, axes.upper().index("C"), 0)
+    return data
+
+
+def channel_count(params: dict[str, Any]) -> int:
+    """
+    Number of channels of a multi-channel fusion
+
+    Raises
+    ------
+    ValueError
+        If the images are not 4D or differ in their number of channels
+    """
+    images = view_images(params)
+    if any(image.ndim != 4 for image in images):
+        raise ValueError("Multi-channel fusion requires (C, Z, Y, X) images")
+    counts = {image.shape[0] for image in images}
+    if len(counts) != 1:
+        raise ValueError("All images must have the same number of channels")
+    return counts.pop()
+
+
+def run_multichannel(
+    params: dict[str, Any], reference: int = 0, workers: int = 1
+) -> Generator[tuple[int, int, str], None, np.ndarray]:
+    """
+    Fuse every channel of (C, Z, Y, X) images
+
+    Works like _fusion.run_fusion, but the fused channels are stacked into
+    a float32 memory map in tmp_path.
+
+    Parameters
+    ----------
+    params : dict
+        Parameters as compiled by FusionWidget._get_parameters, with
+        (C, Z, Y, X) images
+    reference : int, optional
+        Index of the channel fused with FUSE, by default the first
+    workers : int, optional
+        Number of channels fused in parallel, by default 1
+
+    Yields
+    ------
+    tuple[int, int, str]
+        Channels done, total channels and a description
+
+    Returns
+    -------
+    np.ndarray
+        Fused images of shape (C, Z, Y, X)
+
+    Raises
+    ------
+    ValueError
+        If the weights of the reference channel can't be reused, see
+        _weights.validate_reuse, or the reference channel doesn't exist
+    """
+    validate_reuse(params)
+    n_channels = channel_count(params)
+    if not 0 <= reference < n_channels:
+        raise ValueError(
+            f"Reference channel must be between 0 and {n_channels - 1}"
+        )
+    path = Path(params["tmp_path"]) / time.strftime(
+        "fused_channels_%Y%m%d_%H%M%S.npy"
+    )
+    path.parent.mkdir(parents=True, exist_ok=True)
+    out = np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.float32, shape=params["image1"].shape
+    )
+    yield 0, n_channels, "Preparing channels"
+
+    done = 0
+    others = [channel for channel in range(n_channels) if channel != reference]
+    stage = f"Fusing reference channel {reference}"
+    fusion = fuse_keyframe(params, reference, others, out, workers)
+    with contextlib.closing(fusion):
+        for fused in fusion:
+            if fused is not None:
+                channel, error = fused
+                done += 1
+                if error is None:
+                    stage = f"Fused channel {channel}"
+                else:
+                    stage = (
+                        f"Fused reference channel {channel}, its weights "
+                        f"reproduce it to {error:.1%}"
+                    )
+            yield done, n_channels, stage
+    out.flush()
+    return out
@@ -0,0 +1,379 @@
+"""
+Headless batch fusion from the command line.
+
+Every dataset is described by a JSON job file holding the same keys that
+FusionWidget._get_parameters compiles, with file paths instead of layers:
+
+    {
+        "method": "detection",
+        "amount": 2,
+        "image1": "sample_front.tiff",
+        "direction1": "Top",
+        "image3": "sample_back.tiff",
+        "direction3": "Top",
+        "resample_ratio": 2,
+        "window_size": [59, 5],
+        "GF_kernel_size": 49,
+        "require_segmentation": false,
+        "require_registration": false,
+        "require_flip_illu": false,
+        "require_flip_det": false,
+        "keep_intermediates": false,
+        "tmp_path": "/scratch/intermediates",
+        "output": "sample_fused.tiff",
+        "tiling": {"slab_size": 64, "overlap": null, "workers": 1}
+    }
+
+Relative paths are resolved against the directory of the job file. tmp_path
+is a scratch root managed by _scratch.ScratchStore, every job runs in its own
+subdirectory of it. The optional "tiling" entry fuses the job slab-wise, see
+_tiling. With "save_weights": "weights.npz" the blend weights of the result
+are saved, and with "apply_weights": "weights.npz" saved weights fuse the
+images instead of FUSE, see _weights. Weights of registered or flipped
+views can't be reused, so such jobs are rejected when they are loaded.
+Jobs run in a pool of worker
+processes, one job per process at a time. A job whose resident memory
+exceeds the limit given with --memory-limit is stopped, see job_memory.
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import json
+import logging
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+from ._fusion import image_keys, run_fusion, validate_parameters
+from ._profiling import RunProfile, profile_run
+from ._scratch import ScratchStore, default_scratch_root
+from ._tiling import run_tiled_fusion, validate_tiling
+from ._weights import (
+    run_and_save_weights,
+    run_apply_weights,
+    validate_reuse,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "amount": 2,
+    "resample_ratio": 2,
+    "window_size": (59, 5),
+    "GF_kernel_size": 49,
+    "require_segmentation": False,
+    "require_registration": False,
+    "require_flip_illu": False,
+    "require_flip_det": False,
+    "keep_intermediates": False,
+}
+
+_LOG_FORMAT = {
+    "format": "%(asctime)s - %(levelname)s - %(message)s",
+    "datefmt": "%Y-%m-%d %H:%M:%S",
+}
+
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def parse_size(text: str) -> int:
+    """
+    Parse a memory size like "512M" or "32G" into bytes
+
+    Parameters
+    ----------
+    text : str
+        Plain amount of bytes or amount followed by K, M, G or T
+
+    Returns
+    -------
+    int
+        Size in bytes
+    """
+    text = text.strip().upper().removesuffix("B")
+    unit = text[-1:] if text[-1:] in _SIZE_UNITS else ""
+    number = text[: len(text) - len(unit)]
+    try:
+        return int(float(number) * _SIZE_UNITS[unit])
+    except ValueError:
+        raise ValueError(f"Invalid size: {text}") from None
+
+
+def load_job(path: str | Path) -> dict[str, Any]:
+    """
+    Read and validate a job file
+
+    Image entries stay file paths, they are loaded by the worker process.
+
+    Parameters
+    ----------
+    path : str or Path
+        Path of the JSON job file
+
+    Returns
+    -------
+    dict
+        Parameters in the format of FusionWidget._get_parameters
+    """
+    path = Path(path)
+    with open(path) as f:
+        job = json.load(f)
+    params = {**DEFAULTS, **job}
+    params["window_size"] = tuple(params["window_size"])
+    if params.get("method") == "illumination":
+        params["amount"] = 2
+    base = path.parent
+    for index in image_keys(params.get("method"), params["amount"]):
+        if params.get(f"image{index}") is not None:
+            params[f"image{index}"] = str(base / params[f"image{index}"])
+    params["tmp_path"] = str(
+        base / params.get("tmp_path", default_scratch_root())
+    )
+    params["output"] = str(
+        base / params.get("output", f"{path.stem}_fused.tiff")
+    )
+    for key in ("save_weights", "apply_weights"):
+        if params.get(key) is not None:
+            params[key] = str(base / params[key])
+    validate_parameters(params)
+    for key in ("save_weights", "apply_weights"):
+        if params.get(key) is not None:
+            try:
+                validate_reuse(params)
+            except ValueError as e:
+                raise ValueError(f'"{key}" is not available: {e}') from None
+    if params.get("tiling") is not None:
+        params["tiling"] = {
+            "slab_size": None,
+            "overlap": None,
+            "workers": 1,
+            **params["tiling"],
+        }
+        validate_tiling(
+            params,
+            params["tiling"]["slab_size"],
+            params["tiling"]["overlap"],
+        )
+    return params
+
+
+def load_image(path: str) -> np.ndarray:
+    """
+    Open an input image of a job without reading it into memory
+
+    .npy files and uncompressed TIFF files are memory-mapped, so a worker
+    only holds what the fusion reads. Compressed TIFF files can't be
+    mapped and are read.
+
+    Parameters
+    ----------
+    path : str
+        Path of a TIFF or .npy file
+
+    Returns
+    -------
+    np.ndarray
+        Image data, memory-mapped where possible
+    """
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r")
+    import tifffile
+
+    try:
+        return tifffile.memmap(path, mode="r")
+    except ValueError:
+        return tifffile.imread(path)
+
+
+def _setup_worker():
+    # runs once in every worker process
+    logging.basicConfig(level=logging.INFO, **_LOG_FORMAT)
+
+
+def _anonymous_memory(process) -> int:
+    info = process.memory_info()
+    # shared counts file-backed pages on Linux, like those of mapped inputs
+    return info.rss - getattr(info, "shared", 0)
+
+
+def job_memory(process=None) -> int:
+    """
+    Resident memory of a job and its FUSE processes in bytes
+
+    Pages of memory-mapped files are left out where the platform reports
+    them, the system drops them under memory pressure, so large mapped
+    inputs don't count against the limit of a job.
+
+    Parameters
+    ----------
+    process : psutil.Process, optional
+        Process running the job, by default the current one
+
+    Returns
+    -------
+    int
+        Memory of the process and all of its children
+    """
+    import psutil
+
+    process = process or psutil.Process()
+    total = _anonymous_memory(process)
+    for child in process.children(recursive=True):
+        with contextlib.suppress(psutil.Error):
+            total += _anonymous_memory(child)
+    return total
+
+
+def run_job(params: dict[str, Any], memory_limit: int | None = None) -> str:
+    """
+    Load the images of a job, fuse them and write the result
+
+    Parameters
+    ----------
+    params : dict
+        Parameters as returned by load_job
+    memory_limit : int, optional
+        Resident memory in bytes the job may use, see job_memory. It is
+        checked whenever the fusion reports its progress, by default
+        unlimited
+
+    Returns
+    -------
+    str
+        Path of the fused image
+
+    Raises
+    ------
+    MemoryError
+        If the job exceeds memory_limit or FUSE runs out of memory
+    """
+    from ._writer import write_tiff
+
+    params = dict(params)
+    output = params.pop("output")
+    tiling = params.pop("tiling", None)
+    save_weights = params.pop("save_weights", None)
+    apply_weights = params.pop("apply_weights", None)
+    store = ScratchStore(params["tmp_path"])
+    with store.run(Path(output).stem, params) as run_directory:
+        profile = RunProfile(run_directory.name)
+        with profile.stage("Loading images"):
+            for index in image_keys(params["method"], params["amount"]):
+                params[f"image{index}"] = load_image(params[f"image{index}"])
+        params["tmp_path"] = str(run_directory)
+        if apply_weights is not None:
+            function, args = run_apply_weights, (params, apply_weights)
+        elif tiling is None:
+            function, args = run_fusion, (params,)
+        else:
+            function, args = partial(run_tiled_fusion, **tiling), (params,)
+        if save_weights is not None:
+            function, args = run_and_save_weights, (
+                save_weights,
+                params,
+                function,
+                *args,
+            )
+        fusion = profile_run(profile, function, *args)
+        logged = None
+        try:
+            while True:
+                _, _, stage = next(fusion)
+                # stages are reported again while they run
+                if stage != logged:
+                    logged = stage
+                    logger.info("%s: %s", output, stage)
+                if memory_limit is not None and job_memory() > memory_limit:
+                    raise MemoryError(
+                        f"Resident memory exceeded {memory_limit} bytes"
+                    )
+        except StopIteration as stop:
+            output_image = stop.value
+        finally:
+            # terminates FUSE if the job failed
+            fusion.close()
+        with profile.stage("Writing output"):
+            write_tiff(output, output_image)
+    profile.save(store.root / "profiles" / f"{run_directory.name}.json")
+    logger.info("%s: statistics\n%s", output, profile.summary())
+    return output
+
+
+def main(argv: list[str] | None = None) -> int:
+    """Entry point of the lsfm-fusion command."""
+    parser = argparse.ArgumentParser(
+        prog="lsfm-fusion",
+        description="Fuse LSFM datasets described by JSON job files.",
+    )
+    parser.add_argument("jobs", nargs="+", help="JSON job files")
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="number of jobs to run in parallel (default: 1)",
+    )
+    parser.add_argument(
+        "-m",
+        "--memory-limit",
+        type=parse_size,
+        default=None,
+        help="resident memory limit per job, e.g. 64G",
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, **_LOG_FORMAT)
+
+    jobs = {}
+    for job_path in args.jobs:
+        try:
+            jobs[job_path] = load_job(job_path)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error("%s: invalid job file: %s", job_path, e)
+    failed = len(args.jobs) - len(jobs)
+
+    # spawn keeps the workers free of state inherited from the parent
+    with ProcessPoolExecutor(
+        max_workers=max(1, args.workers),
+        mp_context=get_context("spawn"),
+        initializer=_setup_worker,
+    ) as executor:
+        start = time.perf_counter()
+        futures = {
+            executor.submit(run_job, params, args.memory_limit): job_path
+            for job_path, params in jobs.items()
+        }
+        for future in as_completed(futures):
+            job_path = futures[future]
+            try:
+                output = future.result()
+            except MemoryError as e:
+                failed += 1
+                logger.error("%s: out of memory: %s", job_path, e)
+            except BrokenProcessPool:
+                failed += 1
+                logger.error("%s: worker process died", job_path)
+            except Exception as e:  # noqa: BLE001
+                failed += 1
+                logger.error("%s: %s: %s", job_path, type(e).__name__, e)
+            else:
+                logger.info("%s: written to %s", job_path, output)
+    logger.info(
+        "%d/%d jobs finished in %.1f s",
+        len(args.jobs) - failed,
+        len(args.jobs),
+        time.perf_counter() - start,
+    )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,498 @@
+"""
+Headless execution of FUSE runs.
+
+The functions in this module do not depend on Qt, so they can be used from
+the widget (inside a napari worker) as well as from scripts. FUSE runs in a
+child process that is terminated when its run is cancelled.
+"""
+
+from __future__ import annotations
+
+import atexit
+import contextlib
+import mmap
+import os
+import signal
+import time
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from typing import Any, Generator, Iterable
+
+import numpy as np
+
+from ._normalization import is_dask, iter_data_chunks
+
+FUSION_STAGES = (
+    "Preparing inputs",
+    "Fusing",
+    "Finished",
+)
+
+
+DIRECTIONS = ("Top", "Bottom", "Left", "Right")
+
+# seconds between two progress reports while a stage runs
+POLL_INTERVAL = 0.5
+
+
+def image_keys(method: str, amount: int) -> list[int]:
+    """
+    Indices of the images used by a fusion
+
+    Parameters
+    ----------
+    method : str
+        Either "illumination" or "detection"
+    amount : int
+        Amount of images to fuse (2 or 4)
+
+    Returns
+    -------
+    list[int]
+        Indices n of the "image<n>" and "direction<n>" parameters
+    """
+    if method == "illumination":
+        return [1, 2]
+    if amount == 2:
+        return [1, 3]
+    return [1, 2, 3, 4]
+
+
+def validate_parameters(params: dict[str, Any]):
+    """
+    Check the parameters of a fusion for completeness and valid ranges
+
+    Parameters
+    ----------
+    params : dict
+        Parameters as compiled by FusionWidget._get_parameters
+
+    Raises
+    ------
+    ValueError
+        If a parameter is missing or out of range
+    """
+    if params.get("method") not in ("illumination", "detection"):
+        raise ValueError("Method must be illumination or detection")
+    if params["method"] == "illumination" and params.get("amount") != 2:
+        raise ValueError("Illumination fusion requires 2 images")
+    if params.get("amount") not in (2, 4):
+        raise ValueError("Amount of images must be 2 or 4")
+    for index in image_keys(params["method"], params["amount"]):
+        if params.get(f"image{index}") is None:
+            raise ValueError(f"Image {index} not set")
+        if params.get(f"direction{index}") not in DIRECTIONS:
+            raise ValueError(f"Invalid direction for image {index}")
+    if not (1 <= params["resample_ratio"] <= 5):
+        raise ValueError("Resample ratio must be between 1 and 5")
+    if not (
+        9 <= params["window_size"][0] <= 89
+        and 3 <= params["window_size"][1] <= 29
+    ):
+        raise ValueError("Window size must be between 3x9 and 29x89")
+    if not (29 <= params["GF_kernel_size"] <= 89):
+        raise ValueError("GF kernel size must be between 29 and 89")
+    if params.get("require_registration") and not (
+        "lateral_resolution" in params and "axial_resolution" in params
+    ):
+        raise ValueError("Registration requires lateral and axial resolution")
+
+
+def get_model(method: str):
+    """
+    Create the FUSE model for the given fusion method
+
+    FUSE is imported here and not at module level because it pulls in a
+    large dependency stack that is only needed once a fusion is started.
+
+    Parameters
+    ----------
+    method : str
+        Either "illumination" or "detection"
+
+    Returns
+    -------
+    FUSE_illu or FUSE_det
+        Untrained model
+    """
+    from FUSE import FUSE_det, FUSE_illu
+
+    if method == "illumination":
+        return FUSE_illu()
+    return FUSE_det()
+
+
+def load_image(data) -> np.ndarray:
+    """
+    Read a lazy image into memory chunk by chunk
+
+    Dask and Zarr arrays are copied into one preallocated array, so only
+    the chunks of the image itself are read and no intermediate copies of
+    the whole volume are made. In-memory and memory-mapped images are
+    returned as they are.
+
+    Parameters
+    ----------
+    data : array-like
+        Image of any kind
+
+    Returns
+    -------
+    np.ndarray
+        Image as a NumPy array or memory map
+    """
+    if isinstance(data, np.ndarray):
+        return data
+    out = np.empty(data.shape, dtype=data.dtype)
+    for chunk in iter_data_chunks(data):
+        block = data[chunk]
+        out[chunk] = block.compute() if is_dask(block) else block
+    return out
+
+
+def load_inputs(params: dict[str, Any]) -> dict[str, Any]:
+    """
+    Parameters with all images read into memory, see load_image
+    """
+    loaded = dict(params)
+    for index in image_keys(params["method"], params["amount"]):
+        loaded[f"image{index}"] = load_image(params[f"image{index}"])
+    return loaded
+
+
+def mapped_file(image) -> tuple[str, int, int, int] | None:
+    """
+    Locate the file region an array maps, if it is memory-mapped
+
+    Parameters
+    ----------
+    image : array-like
+        Image of any kind, also views of memory maps
+
+    Returns
+    -------
+    tuple[str, int, int, int] or None
+        Path of the file, file offset and size in bytes of the memory map
+        the image views and the offset of the image's first element within
+        it, None if the image is not memory-mapped
+    """
+    root = image
+    while isinstance(root, np.ndarray) and not isinstance(
+        root.base, mmap.mmap
+    ):
+        root = root.base
+    if not isinstance(root, np.memmap) or root.filename is None:
+        return None
+    start = (
+        image.__array_interface__["data"][0]
+        - root.__array_interface__["data"][0]
+    )
+    return os.fspath(root.filename), root.offset, root.nbytes, start
+
+
+def share_image(image, handles: list[SharedMemory]):
+    """
+    Describe an image so a child process can open it without pickling it
+
+    Memory-mapped images are described by their file region, in-memory
+    images are copied into shared memory. Lazy images are returned as they
+    are, the child reads them.
+
+    Parameters
+    ----------
+    image : array-like
+        Image of any kind
+    handles : list[SharedMemory]
+        Shared memory created for the image is appended, the caller
+        unlinks it once the child is done
+
+    Returns
+    -------
+    tuple or array-like
+        Reference for open_image, or the lazy image
+    """
+    if not isinstance(image, np.ndarray):
+        return image
+    layout = (image.dtype.str, image.shape, image.strides)
+    region = mapped_file(image)
+    if region is not None:
+        return ("file", *region, *layout)
+    shared = SharedMemory(create=True, size=max(1, image.nbytes))
+    handles.append(shared)
+    _shared_array(shared, image.dtype, image.shape)[...] = image
+    return ("shared", shared.name, image.dtype.str, image.shape)
+
+
+def _shared_array(shared: SharedMemory, dtype, shape) -> np.ndarray:
+    # the array holds a buffer of the shared memory, so closing it fails
+    # with a BufferError instead of unmapping memory still in use
+    count = int(np.prod(shape))
+    return np.frombuffer(shared.buf, dtype, count).reshape(shape)
+
+
+def open_image(reference, handles: list[SharedMemory]):
+    """
+    Open an image described by share_image
+
+    Shared memory attached for the image is appended to handles.
+    """
+    if not isinstance(reference, tuple):
+        return reference
+    if reference[0] == "shared":
+        _, name, dtype, shape = reference
+        shared = SharedMemory(name=name)
+        handles.append(shared)
+        return _shared_array(shared, dtype, shape)
+    _, filename, offset, size, start, dtype, shape, strides = reference
+    region = np.memmap(
+        filename, dtype=np.uint8, mode="r", offset=offset, shape=(size,)
+    )
+    return np.ndarray(
+        shape, dtype, buffer=region, offset=start, strides=strides
+    )
+
+
+def _train(params: dict[str, Any], path: str, connection):
+    # runs in the FUSE process, reports the stage reached and writes the
+    # fused image to path instead of pickling it back to the parent
+    handles = []
+    try:
+        for index in image_keys(params["method"], params["amount"]):
+            params[f"image{index}"] = open_image(
+                params[f"image{index}"], handles
+            )
+        params = load_inputs(params)
+        model = get_model(params["method"])
+        connection.send(("stage", 1))
+        np.save(path, np.asarray(model.train_from_params(params)))
+    except BaseException as e:  # noqa: BLE001
+        connection.send(("error", (type(e).__name__, str(e))))
+    else:
+        connection.send(("done", None))
+    finally:
+        connection.close()
+        params = model = None
+        for shared in handles:
+            # arrays FUSE still holds keep their mapping until exit
+            with contextlib.suppress(BufferError):
+                shared.close()
+
+
+def run_fusion(
+    params: dict[str, Any], interval: float = POLL_INTERVAL
+) -> Generator[tuple[int, int, str], None, np.ndarray]:
+    """
+    Run a fusion, yielding the progress at every stage reached
+
+    Meant to be used as a generator worker. The images are read and fused
+    in a child process, and the current stage is yielded again every
+    interval seconds, so the worker can be aborted while FUSE trains.
+    Closing the generator terminates the process. Memory-mapped images are
+    mapped by the process as well, in-memory images are copied to shared
+    memory and lazy images are read there, see share_image.
+
+    Parameters
+    ----------
+    params : dict
+        Parameters as compiled by FusionWidget._get_parameters
+    interval : float, optional
+        Seconds between two yields while a stage runs, by default
+        POLL_INTERVAL
+
+    Yields
+    ------
+    tuple[int, int, str]
+        Steps done, total steps and name of the stage
+
+    Returns
+    -------
+    np.ndarray
+        Fused image, memory-mapped from tmp_path
+
+    Raises
+    ------
+    MemoryError
+        If FUSE runs out of memory or its process is killed
+    RuntimeError
+        If FUSE fails otherwise or its process dies
+    """
+    total = len(FUSION_STAGES) - 1
+    os.makedirs(params["tmp_path"], exist_ok=True)
+    path = os.path.join(
+        params["tmp_path"], time.strftime("fused_%Y%m%d_%H%M%S.npy")
+    )
+    # spawn keeps the process free of the threads and Qt state of napari,
+    # it isn't a daemon so FUSE may start processes of its own
+    context = get_context("spawn")
+    receiver, sender = context.Pipe(duplex=False)
+    step = 0
+    yield step, total, FUSION_STAGES[step]
+    handles = []
+    shared = dict(params)
+    try:
+        for index in image_keys(params["method"], params["amount"]):
+            shared[f"image{index}"] = share_image(
+                params[f"image{index}"], handles
+            )
+    except BaseException:
+        _release(handles)
+        raise
+    process = context.Process(target=_train, args=(shared, path, sender))
+    process.start()
+    # processes still fusing when the interpreter exits would be waited
+    # for, handlers registered after start run before that
+    atexit.register(process.terminate)
+    sender.close()
+    try:
+        while True:
+            # the pipe is also readable once the process died
+            if not receiver.poll(interval):
+                yield step, total, FUSION_STAGES[step]
+                continue
+            try:
+                kind, value = receiver.recv()
+            except EOFError:
+                process.join()
+                raise _exit_error(process.exitcode) from None
+            if kind == "error":
+                name, message = value
+                if name == "MemoryError":
+                    raise MemoryError(message)
+                raise RuntimeError(f"{name}: {message}")
+            if kind == "done":
+                break
+            step = value
+            yield step, total, FUSION_STAGES[step]
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+        atexit.unregister(process.terminate)
+        receiver.close()
+        _release(handles)
+    yield total, total, FUSION_STAGES[total]
+    return np.load(path, mmap_mode="r")
+
+
+def _exit_error(exitcode: int) -> Exception:
+    # error for a FUSE process that died without reporting one, the
+    # out-of-memory killer of Linux ends processes with SIGKILL
+    kill = getattr(signal, "SIGKILL", None)
+    if kill is not None and exitcode == -kill:
+        return MemoryError("FUSE process was killed, likely out of memory")
+    return RuntimeError(f"FUSE process exited with code {exitcode}")
+
+
+def _release(handles: list[SharedMemory]):
+    # frees the shared memory of the inputs of a FUSE process
+    for shared in handles:
+        shared.close()
+        with contextlib.suppress(FileNotFoundError):
+            shared.unlink()
+
+
+def run_parallel(
+    runs: Iterable[tuple[Any, Generator]], workers: int = 1
+) -> Generator[tuple[Any, Any] | None, None, None]:
+    """
+    Advance up to workers generators like run_fusion in turn
+
+    The generators are started in the order of runs, the next one when
+    another finished. Closing this generator closes the ones running, which
+    terminates their FUSE processes, so nothing is waited for on cancel.
+    Every run_fusion blocks for its interval while polling, so passing
+    POLL_INTERVAL / workers keeps the rounds short.
+
+    Parameters
+    ----------
+    runs : iterable of tuple
+        Key and generator of every run, consumed lazily
+    workers : int, optional
+        Number of generators running at once, by default 1
+
+    Yields
+    ------
+    tuple or None
+        Key and return value of a finished generator, None after every
+        round over the running generators
+    """
+    runs = iter(runs)
+    running = {}
+    try:
+        while True:
+            while len(running) < max(1, workers):
+                run = next(runs, None)
+                if run is None:
+                    break
+                key, generator = run
+                running[key] = generator
+            if not running:
+                return
+            for key in list(running):
+                try:
+                    next(running[key])
+                except StopIteration as stop:
+                    del running[key]
+                    yield key, stop.value
+            yield None
+    finally:
+        for generator in running.values():
+            generator.close()
+
+
+def crop_parameters(
+    params: dict[str, Any],
+    z_range: tuple[int | None, int | None] = (None, None),
+    stride: int = 1,
+) -> dict[str, Any]:
+    """
+    Restrict the images of a fusion to a Z range and subsample them in Y, X
+
+    Only the selected planes and pixels are read from lazy or
+    memory-mapped images. Intermediates go to a "preview" subdirectory of
+    tmp_path so they don't mix with those of full runs.
+
+    Parameters
+    ----------
+    params : dict
+        Parameters as compiled by FusionWidget._get_parameters
+    z_range : tuple[int or None, int or None], optional
+        Start and stop plane, None for the first and last plane
+    stride : int, optional
+        Step between the pixels kept along Y and X, by default 1
+
+    Returns
+    -------
+    dict
+        Parameters with cropped, contiguous images
+    """
+    if stride < 1:
+        raise ValueError("Stride must be positive")
+    cropped = dict(params)
+    lateral = slice(None, None, stride)
+    selection = (slice(*z_range), lateral, lateral)
+    for index in image_keys(params["method"], params["amount"]):
+        image = params[f"image{index}"]
+        cropped[f"image{index}"] = np.ascontiguousarray(image[selection])
+        if cropped[f"image{index}"].size == 0:
+            raise ValueError("The Z range contains no planes")
+    cropped["tmp_path"] = os.path.join(params["tmp_path"], "preview")
+    os.makedirs(cropped["tmp_path"], exist_ok=True)
+    return cropped
+
+
+def run_preview(
+    params: dict[str, Any],
+    z_range: tuple[int | None, int | None] = (None, None),
+    stride: int = 1,
+) -> Generator[tuple[int, int, str], None, np.ndarray]:
+    """
+    Fuse a cropped and subsampled copy of the images, see crop_parameters
+
+    Yields and returns like run_fusion.
+    """
+    yield 0, len(FUSION_STAGES) - 1, "Cropping images"
+    output_image = yield from run_fusion(
+        crop_parameters(params, z_range, stride)
+    )
+    return output_image
@@ -0,0 +1,365 @@
+"""
+Percentile based intensity normalization of large volumes.
+
+Both percentiles are computed in a single pass over the data and the
+normalized volume is written chunk by chunk into one float32 array, so no
+full-size temporary copies are made.
+
+Data that is not held in memory (dask arrays, memory maps, zarr arrays) is
+only ever read chunk by chunk. Its percentiles come from a histogram sketch
+and the normalized result is either a lazy dask array or a memory map
+written chunk by chunk to disk.
+"""
+
+from __future__ import annotations
+
+import tempfile
+from typing import Iterator
+
+import numpy as np
+
+# size of the chunks processed at once
+CHUNK_BYTES = 64 * 1024**2
+
+# data types the normalized data can be stored as, integers are rescaled
+# from [0, 1] to their full range
+OUTPUT_DTYPES = ("float32", "float16", "uint16")
+
+# default accuracy of percentiles of out-of-core data, relative to the
+# range of values
+TOLERANCE = 1e-4
+
+
+def is_dask(data) -> bool:
+    return type(data).__module__.split(".")[0] == "dask"
+
+
+def is_out_of_core(data) -> bool:
+    """
+    Check if data is not fully held in memory
+
+    Parameters
+    ----------
+    data : array-like
+        Layer data
+
+    Returns
+    -------
+    bool
+        True for memory maps and lazy arrays like dask or zarr arrays
+    """
+    return isinstance(data, np.memmap) or not isinstance(data, np.ndarray)
+
+
+def iter_chunks(shape: tuple[int, ...], itemsize: int) -> Iterator[slice]:
+    """
+    Split the first axis into slices of roughly CHUNK_BYTES each
+
+    Parameters
+    ----------
+    shape : tuple[int, ...]
+        Shape of the array
+    itemsize : int
+        Size of one element in bytes
+
+    Yields
+    ------
+    slice
+        Slice along the first axis
+    """
+    if len(shape) == 0:
+        yield ...  # type: ignore[misc]
+        return
+    plane_bytes = max(1, int(np.prod(shape[1:])) * itemsize)
+    step = max(1, CHUNK_BYTES // plane_bytes)
+    for start in range(0, shape[0], step):
+        yield slice(start, min(start + step, shape[0]))
+
+
+def iter_data_chunks(data) -> Iterator[slice]:
+    """
+    Split the first axis of data into slices that are cheap to read
+
+    Dask arrays are split along their own chunk boundaries so every chunk
+    is computed only once.
+
+    Parameters
+    ----------
+    data : array-like
+        Input data
+
+    Yields
+    ------
+    slice
+        Slice along the first axis
+    """
+    if not is_dask(data) or data.ndim == 0:
+        yield from iter_chunks(data.shape, data.dtype.itemsize)
+        return
+    start = 0
+    for size in data.chunks[0]:
+        yield slice(start, start + size)
+        start += size
+
+
+def _histogram_dtype(dtype: np.dtype) -> bool:
+    # integer types small enough for an exact histogram of all values
+    return dtype.kind in "ui" and dtype.itemsize <= 2
+
+
+def _histogram(data: np.ndarray) -> tuple[np.ndarray, int]:
+    """
+    Exact histogram of all values of a small integer array
+
+    Returns
+    -------
+    tuple[np.ndarray, int]
+        Counts of every value and the value of the first bin
+    """
+    offset = int(np.iinfo(data.dtype).min) if data.dtype.kind == "i" else 0
+    n_bins = 2 ** (8 * data.dtype.itemsize)
+    counts = np.zeros(n_bins, dtype=np.int64)
+    # bincount converts its input to int64, so it gets at most CHUNK_BYTES
+    step = max(1, CHUNK_BYTES // 8)
+    for chunk in iter_data_chunks(data):
+        values = np.asarray(data[chunk]).ravel()
+        for start in range(0, values.size, step):
+            block = values[start : start + step]
+            if offset:
+                block = block.astype(np.int32) - offset
+            counts += np.bincount(block, minlength=n_bins)
+    return counts, offset
+
+
+def _sketch(data, tolerance: float) -> tuple[np.ndarray, float, float]:
+    """
+    Histogram of data with bins of width tolerance times its value range
+
+    Needs two passes over the data, one for the value range and one for
+    the counts, but only one chunk is in memory at a time.
+
+    Returns
+    -------
+    tuple[np.ndarray, float, float]
+        Counts of every bin, minimum and maximum value
+    """
+    min_v, max_v = np.inf, -np.inf
+    for chunk in iter_data_chunks(data):
+        values = np.asarray(data[chunk])
+        min_v = min(min_v, float(values.min()))
+        max_v = max(max_v, float(values.max()))
+    n_bins = max(1, int(np.ceil(1.0 / tolerance)))
+    counts = np.zeros(n_bins, dtype=np.int64)
+    for chunk in iter_data_chunks(data):
+        counts += np.histogram(
+            np.asarray(data[chunk]), bins=n_bins, range=(min_v, max_v)
+        )[0]
+    return counts, min_v, max_v
+
+
+def _interpolate(values_at, n: int, q: np.ndarray) -> np.ndarray:
+    # linear interpolation between closest ranks, like np.percentile
+    position = q / 100.0 * (n - 1)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, n - 1)
+    fraction = position - lower
+    lower_v = values_at(lower)
+    upper_v = values_at(upper)
+    return lower_v + fraction * (upper_v - lower_v)
+
+
+def percentiles(data, q, tolerance: float = TOLERANCE) -> np.ndarray:
+    """
+    Compute several percentiles of an array in a single pass
+
+    Integer data up to 16 bit is summarized by an exact histogram, other
+    in-memory data by one partition over all requested ranks. The results
+    are equal to np.percentile with linear interpolation. Other out-of-core
+    data is summarized by a histogram sketch, which is accurate to
+    tolerance times the range of values.
+
+    Parameters
+    ----------
+    data : array-like
+        Input data of any shape
+    q : float or sequence of float
+        Percentiles to compute, between 0 and 100
+    tolerance : float, optional
+        Accuracy of the sketch relative to the range of values
+
+    Returns
+    -------
+    np.ndarray
+        Percentiles as float64, in the order of q
+    """
+    q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+    if np.any((q < 0) | (q > 100)):
+        raise ValueError("Percentiles must be between 0 and 100")
+    n = int(np.prod(data.shape))
+    if n == 0:
+        raise ValueError("Percentiles of an empty array are undefined")
+
+    if _histogram_dtype(np.dtype(data.dtype)):
+        counts, offset = _histogram(data)
+        cumulative = np.cumsum(counts)
+
+        def values_at(ranks):
+            return (
+                np.searchsorted(cumulative, ranks, side="right") + offset
+            ).astype(np.float64)
+
+    elif is_out_of_core(data):
+        counts, min_v, max_v = _sketch(data, tolerance)
+        cumulative = np.cumsum(counts)
+        width = (max_v - min_v) / len(counts)
+
+        def values_at(ranks):
+            # assume the values are spread evenly within every bin
+            bins = np.searchsorted(cumulative, ranks, side="right")
+            below = np.where(bins > 0, cumulative[bins - 1], 0)
+            fraction = (ranks - below + 0.5) / counts[bins]
+            return np.clip(min_v + (bins + fraction) * width, min_v, max_v)
+
+    else:
+        flat = np.asarray(data).ravel()
+        position = q / 100.0 * (n - 1)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, n - 1)
+        ranks = np.unique(np.concatenate([lower, upper]))
+        partitioned = np.partition(flat, ranks)
+
+        def values_at(ranks):
+            return partitioned[ranks].astype(np.float64)
+
+    return _interpolate(values_at, n, q)
+
+
+def normalize(
+    data: np.ndarray,
+    lower_v: float,
+    upper_v: float,
+    out: np.ndarray | None = None,
+) -> np.ndarray:
+    """
+    Clip data to [lower_v, upper_v] and rescale it to [0, 1]
+
+    The computation runs chunk by chunk. Float32 and float64 results are
+    computed directly in the output array, which may also be data itself.
+    Other types are computed in a float32 buffer of one chunk and converted,
+    integers are rescaled to their full range.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Input data
+    lower_v : float
+        Value mapped to 0
+    upper_v : float
+        Value mapped to 1
+    out : np.ndarray, optional
+        Array of the same shape to write the result to, by default a new
+        float32 array
+
+    Returns
+    -------
+    np.ndarray
+        Normalized data
+    """
+    if out is None:
+        out = np.empty(data.shape, dtype=np.float32)
+    # constant images are mapped to 0 instead of dividing by zero
+    scale = 1.0 / (upper_v - lower_v) if upper_v > lower_v else 0.0
+    in_place = out.dtype in (np.float32, np.float64)
+    if out.dtype.kind in "ui":
+        scale *= np.iinfo(out.dtype).max
+    for chunk in iter_chunks(data.shape, max(out.dtype.itemsize, 4)):
+        out_chunk = out[chunk]
+        buffer = out_chunk if in_place else np.empty_like(out_chunk, "f4")
+        np.clip(np.asarray(data[chunk]), lower_v, upper_v, out=buffer)
+        buffer -= lower_v
+        buffer *= scale
+        if out.dtype.kind in "ui":
+            np.rint(buffer, out=buffer)
+        if not in_place:
+            out_chunk[...] = buffer
+    return out
+
+
+def normalize_percentiles(
+    data,
+    lower_percentage: float,
+    upper_percentage: float,
+    tolerance: float = TOLERANCE,
+    directory: str | None = None,
+    dtype: str = "float32",
+    in_place: bool = False,
+):
+    """
+    Normalize data between two of its percentiles
+
+    In-memory data is normalized into a new array, dask arrays into a lazy
+    dask array and other out-of-core data into a .npy memory map. With
+    in_place, writable in-memory data of the output dtype is overwritten
+    instead, so no second volume is allocated. The levels of a multiscale
+    image are all normalized with the percentiles of the first level.
+
+    Parameters
+    ----------
+    data : array-like or list of array-like
+        Input data, or the levels of a multiscale image
+    lower_percentage : float
+        Percentile mapped to 0
+    upper_percentage : float
+        Percentile mapped to 1
+    tolerance : float, optional
+        Accuracy of percentiles of out-of-core data, see percentiles
+    directory : str, optional
+        Directory of the memory map, by default the system's temporary
+        directory. The file is left to the caller, the widget writes it to
+        a scratch run, see _scratch
+    dtype : str, optional
+        One of OUTPUT_DTYPES, by default "float32"
+    in_place : bool, optional
+        Overwrite data if possible, by default False
+
+    Returns
+    -------
+    array-like or list of array-like
+        Normalized data, or its levels
+    """
+    if dtype not in OUTPUT_DTYPES:
+        raise ValueError(f"Output dtype must be one of {OUTPUT_DTYPES}")
+    dtype = np.dtype(dtype)
+    levels = data if isinstance(data, (list, tuple)) else [data]
+    lower_v, upper_v = percentiles(
+        levels[0], [lower_percentage, upper_percentage], tolerance
+    )
+    normalized = [
+        _normalize_like(level, lower_v, upper_v, directory, dtype, in_place)
+        for level in levels
+    ]
+    return normalized if isinstance(data, (list, tuple)) else normalized[0]
+
+
+def _normalize_like(data, lower_v, upper_v, directory, dtype, in_place):
+    # normalized data of the same kind as the input, see
+    # normalize_percentiles
+    if is_dask(data):
+        return data.map_blocks(
+            lambda block: normalize(
+                block, lower_v, upper_v, np.empty(block.shape, dtype)
+            ),
+            dtype=dtype,
+        )
+    if is_out_of_core(data):
+        with tempfile.NamedTemporaryFile(
+            suffix=".npy", dir=directory, delete=False
+        ) as f:
+            out = np.lib.format.open_memmap(
+                f.name, mode="w+", dtype=dtype, shape=data.shape
+            )
+    elif in_place and data.dtype == dtype and data.flags.writeable:
+        out = data
+    else:
+        out = np.empty(data.shape, dtype=dtype)
+    return normalize(data, lower_v, upper_v, out)
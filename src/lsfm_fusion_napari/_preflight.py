@@ -0,0 +1,239 @@
+"""
+Pre-flight estimate of the memory and disk space a fusion needs.
+
+The estimate is computed from the shapes and dtypes of the inputs and the
+parameters of the run, without reading any image data. It models FUSE as
+holding a float32 working copy of every input and of the output, plus the
+extra volumes that registration and segmentation create and the filtered
+copies at the resampled resolution. Time-lapse and multi-channel fusions
+add their stacked output, the weights of a keyframe and the frames read in
+parallel. The model is deliberately conservative: a run it admits should
+not be killed for lack of memory.
+"""
+
+from __future__ import annotations
+
+import shutil
+from typing import Any, NamedTuple
+
+import numpy as np
+
+from ._fusion import image_keys, mapped_file
+from ._tiling import default_overlap, default_slab_size, slab_bounds
+from ._timelapse import frame_parameters
+
+# float32 copies FUSE holds of every input at full resolution
+INPUT_COPIES = 2
+
+# float32 buffers of every input at the resampled resolution
+RESAMPLED_COPIES = 4
+
+# fraction of the available memory a run may use
+MEMORY_HEADROOM = 0.9
+
+
+class Estimate(NamedTuple):
+    """
+    Peak memory and disk use of a run in bytes
+    """
+
+    memory: int
+    disk: int
+
+
+def _volume_estimate(
+    params: dict[str, Any], shape: tuple[int, ...], read_bytes: int
+) -> int:
+    # memory of a fusion of volumes of the given shape
+    n_images = len(image_keys(params["method"], params["amount"]))
+    voxels = int(np.prod(shape))
+    float_volume = 4 * voxels
+    memory = read_bytes + n_images * INPUT_COPIES * float_volume
+    memory += (
+        n_images
+        * RESAMPLED_COPIES
+        * float_volume
+        // max(1, params["resample_ratio"] ** 2)
+    )
+    # the fused image
+    memory += float_volume
+    if params.get("require_registration"):
+        # a transformed copy of every detection view
+        memory += n_images // 2 * float_volume
+    if params.get("require_segmentation"):
+        # one mask per image
+        memory += n_images * voxels
+    return memory
+
+
+def _stacked_estimate(params: dict[str, Any], workers: int) -> Estimate:
+    # time-lapse or multi-channel fusion of images stacked along their
+    # first axis, see _timelapse.run_timelapse
+    images = [
+        params[f"image{index}"]
+        for index in image_keys(params["method"], params["amount"])
+    ]
+    n_frames = images[0].shape[0]
+    float_volume = 4 * int(np.prod(images[0].shape[1:]))
+    # the fused frames are stacked in a memory map
+    output = n_frames * float_volume
+    # FUSE runs on one frame, see estimate
+    frame = estimate(frame_parameters(params, 0))
+    parallel = min(workers, n_frames)
+    # the weights of a keyframe are a memory map with one volume per view,
+    # lazy views of the frames weighed in parallel are read into memory
+    weights = len(images) * float_volume
+    loaded = parallel * sum(
+        int(np.prod(image.shape[1:])) * np.dtype(image.dtype).itemsize
+        for image in images
+        if not isinstance(image, np.ndarray)
+    )
+    return Estimate(max(frame.memory, loaded), frame.disk + weights + output)
+
+
+def estimate(
+    params: dict[str, Any],
+    tiling: tuple[int | None, int | None, int] | None = None,
+    stacked: int | None = None,
+) -> Estimate:
+    """
+    Estimate the peak memory and disk use of a fusion
+
+    Parameters
+    ----------
+    params : dict
+        Parameters as compiled by FusionWidget._get_parameters
+    tiling : tuple[int or None, int or None, int], optional
+        Slab size, overlap and number of workers of a tiled fusion, see
+        _tiling.run_tiled_fusion, by default a monolithic fusion
+    stacked : int, optional
+        Number of frames fused in parallel if the images are stacked
+        timepoints or channels, see _timelapse.run_timelapse and
+        _channels.run_multichannel, by default the images are volumes
+
+    Returns
+    -------
+    Estimate
+        Peak memory and disk use in bytes
+    """
+    if stacked is not None:
+        return _stacked_estimate(params, stacked)
+    images = [
+        params[f"image{index}"]
+        for index in image_keys(params["method"], params["amount"])
+    ]
+    shape = tuple(images[0].shape)
+    voxels = int(np.prod(shape))
+    # FUSE stores a float32 copy of every input and the result on disk
+    disk = (len(images) + 1) * 4 * voxels
+
+    if tiling is None:
+        # the FUSE process maps memory-mapped inputs, it gets a copy of
+        # all others, see run_fusion
+        read_bytes = sum(
+            int(np.prod(image.shape)) * np.dtype(image.dtype).itemsize
+            for image in images
+            if mapped_file(image) is None
+        )
+        # plus the result it writes for the widget to map
+        disk += 4 * voxels
+        return Estimate(_volume_estimate(params, shape, read_bytes), disk)
+
+    slab_size, overlap, workers = tiling
+    if overlap is None:
+        overlap = default_overlap(params)
+    if slab_size is None:
+        slab_size = default_slab_size(params, overlap)
+    # every slab is read with its overlap on both sides
+    slab_shape = (min(shape[0], slab_size + 2 * overlap), *shape[1:])
+    slab_voxels = int(np.prod(slab_shape))
+    parallel = min(workers, len(slab_bounds(shape[0], slab_size)))
+    read_bytes = sum(
+        slab_voxels * np.dtype(image.dtype).itemsize for image in images
+    )
+    memory = parallel * _volume_estimate(params, slab_shape, read_bytes)
+    if not params.get("keep_intermediates"):
+        # intermediates of a slab are removed once it is fused
+        disk = parallel * (len(images) + 1) * 4 * slab_voxels
+    # plus the memory-mapped output
+    return Estimate(memory, disk + 4 * voxels)
+
+
+def available_resources(directory: str) -> Estimate:
+    """
+    Memory available to a new run and free disk space in a directory
+
+    Parameters
+    ----------
+    directory : str
+        Directory the run writes to
+
+    Returns
+    -------
+    Estimate
+        Available memory and free disk space in bytes
+    """
+    import psutil
+
+    memory = int(psutil.virtual_memory().available * MEMORY_HEADROOM)
+    return Estimate(memory, shutil.disk_usage(directory).free)
+
+
+def fits(needed: Estimate, available: Estimate) -> bool:
+    """
+    Check if a run fits into the available resources
+    """
+    return needed.memory <= available.memory and needed.disk <= available.disk
+
+
+def largest_slab_size(
+    params: dict[str, Any],
+    available: Estimate,
+    overlap: int | None = None,
+    workers: int = 1,
+) -> int | None:
+    """
+    Largest slab size whose tiled fusion fits into the available resources
+
+    Parameters
+    ----------
+    params : dict
+        Parameters as compiled by FusionWidget._get_parameters
+    available : Estimate
+        Available memory and disk space, see available_resources
+    overlap : int, optional
+        Overlap on each side, by default _tiling.default_overlap
+    workers : int, optional
+        Number of slabs fused in parallel, by default 1
+
+    Returns
+    -------
+    int or None
+        Slab size, or None if not even the smallest valid slab fits
+    """
+    if overlap is None:
+        overlap = default_overlap(params)
+    length = params["image1"].shape[0]
+    # the slab size must be at least the overlap, see validate_tiling
+    low = max(1, overlap)
+    high = max(low, length)
+    if not fits(estimate(params, (low, overlap, workers)), available):
+        return None
+    while low < high:
+        middle = (low + high + 1) // 2
+        if fits(estimate(params, (middle, overlap, workers)), available):
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def format_bytes(size: int) -> str:
+    """
+    Human-readable size like "12.3 GB"
+    """
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
@@ -0,0 +1,262 @@
+"""
+Per-stage timing and memory statistics of fusion runs.
+
+A RunProfile records the wall time, the CPU time and the peak resident
+memory of every stage of a run. Stages are either timed explicitly or taken
+from the progress a fusion generator yields, see profile_run. The CPU time
+and the resident memory include child processes, like the FUSE processes of
+a fusion. The resident memory is sampled by a background thread.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Generator, Iterator
+
+# seconds between two memory samples
+SAMPLE_INTERVAL = 0.05
+
+
+def _rss(process) -> int:
+    # resident memory of a process and all of its children
+    total = process.memory_info().rss
+    for child in process.children(recursive=True):
+        with contextlib.suppress(Exception):
+            total += child.memory_info().rss
+    return total
+
+
+def _cpu_time(process) -> float:
+    # CPU time of this process and its children, ended children count once
+    # they were waited for
+    times = os.times()
+    total = time.process_time() + times.children_user + times.children_system
+    if process is None:
+        return total
+    for child in process.children(recursive=True):
+        with contextlib.suppress(Exception):
+            cpu = child.cpu_times()
+            total += cpu.user + cpu.system
+            # descendants the child waited for, not listed as children
+            total += getattr(cpu, "children_user", 0)
+            total += getattr(cpu, "children_system", 0)
+    return total
+
+
+class RunProfile:
+    """
+    Statistics of the stages of one run
+
+    Parameters
+    ----------
+    label : str
+        Name of the run, stored in the record
+    sample_interval : float, optional
+        Seconds between two memory samples, by default SAMPLE_INTERVAL
+    """
+
+    def __init__(self, label: str, sample_interval: float = SAMPLE_INTERVAL):
+        self.label = label
+        self.sample_interval = sample_interval
+        self.started = time.time()
+        self.stages: list[dict[str, Any]] = []
+        self._current: dict[str, Any] | None = None
+        self._lock = threading.Lock()
+        self._peak_rss = 0
+        self._sampler: threading.Thread | None = None
+        self._stop_sampling = threading.Event()
+        try:
+            import psutil
+        except ImportError:
+            self._process = None
+        else:
+            self._process = psutil.Process(os.getpid())
+
+    def _sample(self):
+        while not self._stop_sampling.wait(self.sample_interval):
+            self._update_peak()
+
+    def _update_peak(self):
+        try:
+            rss = _rss(self._process)
+        except Exception:  # noqa: BLE001
+            return
+        with self._lock:
+            self._peak_rss = max(self._peak_rss, rss)
+
+    def _cpu_time(self) -> float:
+        try:
+            return _cpu_time(self._process)
+        except Exception:  # noqa: BLE001
+            return _cpu_time(None)
+
+    def start(self, name: str):
+        """
+        End the current stage, if any, and start a new one
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage
+        """
+        self.stop()
+        if self._process is not None:
+            with self._lock:
+                self._peak_rss = 0
+            self._update_peak()
+            self._stop_sampling.clear()
+            self._sampler = threading.Thread(target=self._sample, daemon=True)
+            self._sampler.start()
+        self._current = {
+            "stage": name,
+            "wall": time.perf_counter(),
+            "cpu": self._cpu_time(),
+        }
+
+    def stop(self):
+        """
+        End the current stage, if any
+        """
+        if self._current is None:
+            return
+        record = {
+            "stage": self._current["stage"],
+            "wall_time_s": time.perf_counter() - self._current["wall"],
+            "cpu_time_s": self._cpu_time() - self._current["cpu"],
+            "peak_rss_bytes": None,
+        }
+        if self._sampler is not None:
+            self._stop_sampling.set()
+            self._sampler.join()
+            self._sampler = None
+            self._update_peak()
+            record["peak_rss_bytes"] = self._peak_rss
+        self.stages.append(record)
+        self._current = None
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Time the body of a with statement as one stage
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage
+        """
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop()
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        Record of the run as a JSON-serializable dict
+        """
+        peaks = [
+            stage["peak_rss_bytes"]
+            for stage in self.stages
+            if stage["peak_rss_bytes"] is not None
+        ]
+        return {
+            "label": self.label,
+            "started": time.strftime(
+                "%Y-%m-%dT%H:%M:%S", time.localtime(self.started)
+            ),
+            "wall_time_s": sum(stage["wall_time_s"] for stage in self.stages),
+            "cpu_time_s": sum(stage["cpu_time_s"] for stage in self.stages),
+            "peak_rss_bytes": max(peaks) if peaks else None,
+            "stages": self.stages,
+        }
+
+    def save(self, path: str | Path) -> Path:
+        """
+        Write the record of the run as JSON
+
+        Parameters
+        ----------
+        path : str or Path
+            JSON file, parent directories are created
+
+        Returns
+        -------
+        Path
+            Path of the file
+        """
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        return path
+
+    def summary(self) -> str:
+        """
+        Table of the stages as plain text
+        """
+        lines = [f"{'Stage':<28}{'Wall':>9}{'CPU':>9}{'Peak RSS':>11}"]
+        record = self.to_dict()
+        for stage in (*self.stages, {**record, "stage": "Total"}):
+            rss = stage["peak_rss_bytes"]
+            rss_text = "n/a" if rss is None else f"{rss / 1024**3:.2f} GB"
+            lines.append(
+                f"{stage['stage'][:27]:<28}"
+                f"{stage['wall_time_s']:>8.1f}s"
+                f"{stage['cpu_time_s']:>8.1f}s"
+                f"{rss_text:>11}"
+            )
+        return "\n".join(lines)
+
+
+def profile_run(
+    profile: RunProfile,
+    run: Callable[..., Generator[tuple[int, int, str], None, Any]],
+    *args,
+    **kwargs,
+) -> Generator[tuple[int, int, str], None, Any]:
+    """
+    Run a fusion generator and record every stage it yields
+
+    The time until the next progress report with another name is
+    attributed to the stage named in the last one. Closing the generator
+    closes run.
+
+    Parameters
+    ----------
+    profile : RunProfile
+        Profile to record the stages in
+    run : callable
+        Generator function like _fusion.run_fusion
+    *args, **kwargs
+        Arguments of run
+
+    Yields
+    ------
+    tuple[int, int, str]
+        Progress as yielded by run
+
+    Returns
+    -------
+    Any
+        Return value of run
+    """
+    fusion = run(*args, **kwargs)
+    stage = None
+    try:
+        while True:
+            progress = next(fusion)
+            # stages are reported again while they run
+            if progress[2] != stage:
+                stage = progress[2]
+                profile.start(stage)
+            yield progress
+    except StopIteration as stop:
+        return stop.value
+    finally:
+        fusion.close()
+        profile.stop()
@@ -0,0 +1,124 @@
+"""
+Multiscale pyramids of fused images for display in napari.
+
+The levels below full resolution are computed in the fusion worker, block
+by block with the vectorized mean reduction of _writer.downsample, so the
+viewer only ever renders a level that fits the screen. The contrast limits
+are computed in the same pass, so napari doesn't scan the full volume
+when the layer is added.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Callable, Generator
+
+import numpy as np
+
+from . import _normalization
+from ._writer import default_levels, downsample
+
+
+def _plane_blocks(shape: tuple[int, ...], itemsize: int, factor: int):
+    # slices along the first axis of about CHUNK_BYTES, each a multiple of
+    # factor planes so that blocks downsample independently
+    plane_bytes = max(1, int(np.prod(shape[1:])) * itemsize)
+    step = _normalization.CHUNK_BYTES // plane_bytes // factor * factor
+    step = max(factor, step)
+    for start in range(0, shape[0], step):
+        yield slice(start, min(start + step, shape[0]))
+
+
+def _limits(min_v: float, max_v: float) -> tuple[float, float]:
+    # napari needs a range even for constant images
+    return (min_v, max_v) if max_v > min_v else (min_v, min_v + 1)
+
+
+def build_pyramid(
+    data, levels: int | None = None
+) -> Generator[tuple[int, int, str], None, tuple[list, tuple[float, float]]]:
+    """
+    Compute the lower resolution levels of an image
+
+    Every level halves the last three axes (Z, Y and X) of the one before.
+
+    Parameters
+    ----------
+    data : array-like
+        Full resolution image, may be memory-mapped
+    levels : int, optional
+        Number of levels including data, by default until the planes are at
+        most 512 pixels wide, see _writer.default_levels
+
+    Yields
+    ------
+    tuple[int, int, str]
+        Levels done, total levels and a description
+
+    Returns
+    -------
+    tuple[list, tuple[float, float]]
+        All levels starting with data, and the minimum and maximum of data
+    """
+    if levels is None:
+        levels = default_levels(data.shape)
+    factors = tuple(
+        1 if axis < data.ndim - 3 else 2 for axis in range(data.ndim)
+    )
+    pyramid = [data]
+    min_v, max_v = np.inf, -np.inf
+
+    if levels == 1:
+        for chunk in _normalization.iter_data_chunks(data):
+            block = np.asarray(data[chunk])
+            min_v = min(min_v, float(block.min()))
+            max_v = max(max_v, float(block.max()))
+        yield 1, 1, "Computed contrast limits"
+        return pyramid, _limits(min_v, max_v)
+
+    for level in range(1, levels):
+        previous = pyramid[-1]
+        shape = tuple(
+            -(-size // factor) for size, factor in zip(previous.shape, factors)
+        )
+        current = np.empty(shape, dtype=previous.dtype)
+        for chunk in _plane_blocks(
+            previous.shape, previous.dtype.itemsize, factors[0]
+        ):
+            block = np.asarray(previous[chunk])
+            if level == 1:
+                min_v = min(min_v, float(block.min()))
+                max_v = max(max_v, float(block.max()))
+            start = chunk.start // factors[0]
+            reduced = downsample(block, factors)
+            current[start : start + len(reduced)] = reduced
+        pyramid.append(current)
+        yield level, levels - 1, f"Built pyramid level {level}/{levels - 1}"
+    return pyramid, _limits(min_v, max_v)
+
+
+def run_with_pyramid(
+    run: Callable[..., Generator[tuple[int, int, str], None, Any]], *args
+) -> Generator[tuple[int, int, str], None, tuple[list, tuple[float, float]]]:
+    """
+    Run a fusion generator and build the pyramid of its result
+
+    Parameters
+    ----------
+    run : callable
+        Generator function like _fusion.run_fusion
+    *args
+        Arguments of run
+
+    Yields
+    ------
+    tuple[int, int, str]
+        Progress of run, then of build_pyramid
+
+    Returns
+    -------
+    tuple[list, tuple[float, float]]
+        Levels of the fused image and its contrast limits
+    """
+    output_image = yield from run(*args)
+    result = yield from build_pyramid(output_image)
+    return result
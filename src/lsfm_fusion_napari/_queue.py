@@ -0,0 +1,163 @@
+"""
+Queue of fusion jobs, each with its own inputs and parameters.
+
+A job holds the parameters of one fusion as compiled by the widget, so
+several samples can be configured one after the other and fused later.
+The queue hands out queued jobs in the order they were added while fewer
+than a limit of jobs are running. Running the jobs is left to the caller.
+"""
+
+from __future__ import annotations
+
+import itertools
+from typing import Any
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+# states a job doesn't leave anymore
+FINISHED = (DONE, FAILED, CANCELLED)
+
+_counter = itertools.count(1)
+
+
+class Job:
+    """
+    One fusion of the queue
+
+    Parameters
+    ----------
+    label : str
+        Name of the job, also used for the layer of its result
+    params : dict
+        Parameters as compiled by FusionWidget._get_parameters
+    tiling : tuple[int or None, int or None, int], optional
+        Slab size, overlap and number of workers of a tiled fusion, see
+        _tiling.run_tiled_fusion, by default a monolithic fusion
+    timelapse : tuple[int, int], optional
+        Keyframe interval and number of workers of a time-lapse fusion, see
+        _timelapse.run_timelapse
+    channels : tuple[int, int], optional
+        Reference channel and number of workers of a multi-channel fusion,
+        see _channels.run_multichannel
+    """
+
+    def __init__(
+        self,
+        label: str,
+        params: dict[str, Any],
+        tiling: tuple[int | None, int | None, int] | None = None,
+        timelapse: tuple[int, int] | None = None,
+        channels: tuple[int, int] | None = None,
+    ):
+        self.id = next(_counter)
+        self.label = label
+        self.params = params
+        self.tiling = tiling
+        self.timelapse = timelapse
+        self.channels = channels
+        self.status = QUEUED
+        # last progress or error message
+        self.message = ""
+
+    def __repr__(self) -> str:
+        return f"Job({self.id}, {self.label!r}, {self.status})"
+
+    def describe(self) -> str:
+        """
+        One line with the label, status and last message of the job
+        """
+        text = f"#{self.id} {self.label}: {self.status}"
+        return f"{text} - {self.message}" if self.message else text
+
+
+class JobQueue:
+    """
+    Jobs in the order they were added
+
+    Parameters
+    ----------
+    limit : int, optional
+        Number of jobs that may run at the same time, by default 1
+    """
+
+    def __init__(self, limit: int = 1):
+        self.jobs: list[Job] = []
+        self.limit = limit
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @limit.setter
+    def limit(self, value: int):
+        if value < 1:
+            raise ValueError("At least one job must be able to run")
+        self._limit = value
+
+    def add(
+        self,
+        label: str,
+        params: dict[str, Any],
+        tiling: tuple[int | None, int | None, int] | None = None,
+        timelapse: tuple[int, int] | None = None,
+        channels: tuple[int, int] | None = None,
+    ) -> Job:
+        """
+        Append a new job, see Job for the parameters
+        """
+        job = Job(label, params, tiling, timelapse, channels)
+        self.jobs.append(job)
+        return job
+
+    def remove(self, job: Job):
+        """
+        Remove a job that isn't running
+        """
+        if job.status == RUNNING:
+            raise ValueError("Running jobs must be cancelled first")
+        self.jobs.remove(job)
+
+    def clear_finished(self):
+        """
+        Remove all jobs that are done, failed or were cancelled
+        """
+        self.jobs = [job for job in self.jobs if job.status not in FINISHED]
+
+    def queued(self) -> list[Job]:
+        return [job for job in self.jobs if job.status == QUEUED]
+
+    def running(self) -> list[Job]:
+        return [job for job in self.jobs if job.status == RUNNING]
+
+    def next_job(self) -> Job | None:
+        """
+        First queued job if another job may start
+
+        The job isn't marked as running, see start.
+        """
+        if len(self.running()) >= self.limit:
+            return None
+        queued = self.queued()
+        return queued[0] if queued else None
+
+    def start(self, job: Job):
+        """
+        Mark a queued job as running
+        """
+        if job.status != QUEUED:
+            raise ValueError(f"Job {job.id} is {job.status}, not queued")
+        job.status = RUNNING
+        job.message = ""
+
+    def finish(self, job: Job, status: str = DONE, message: str = ""):
+        """
+        Mark a job as done, failed or cancelled
+        """
+        if status not in FINISHED:
+            raise ValueError(f"Status must be one of {FINISHED}")
+        job.status = status
+        job.message = message
@@ -0,0 +1,247 @@
+"""
+Lazy reader for LSFM input stacks.
+
+It implements the Reader specification.
+see: https://napari.org/stable/plugins/guides.html?#readers
+
+TIFF files are memory-mapped where possible and otherwise read page by page
+through a dask array, OME-Zarr stores are opened as dask arrays of every pyramid
+level. No image data is read until napari or the fusion accesses it.
+"""
+
+from __future__ import annotations
+
+import os
+from xml.etree import ElementTree
+
+import numpy as np
+import tifffile
+
+from ._writer import read_conversion
+
+TIFF_EXTENSIONS = (".tif", ".tiff")
+
+
+def napari_get_reader(path):
+    """
+    Return a reader function if the path can be read by this plugin
+
+    Parameters
+    ----------
+    path : str or list of str
+        Path to a file or directory, or a list of them
+
+    Returns
+    -------
+    function or None
+        Reader function or None if the path is not supported
+    """
+    if isinstance(path, list):
+        if not all(_reader_for(p) is not None for p in path):
+            return None
+        return read_paths
+    return _reader_for(path)
+
+
+def _reader_for(path: str):
+    path = os.fspath(path).rstrip("/\\")
+    if path.lower().endswith(TIFF_EXTENSIONS):
+        return read_tiff
+    if path.lower().endswith(".zarr"):
+        return read_zarr
+    return None
+
+
+def read_paths(paths: list[str]) -> list[tuple]:
+    """
+    Read several files, every one as separate layers
+
+    Parameters
+    ----------
+    paths : list of str
+        Paths to TIFF files or Zarr stores
+
+    Returns
+    -------
+    list of tuple
+        Layer data tuples of all paths
+    """
+    layers = []
+    for path in paths:
+        layers += _reader_for(path)(path)
+    return layers
+
+
+def _layer_name(path: str) -> str:
+    name = os.path.basename(os.fspath(path).rstrip("/\\"))
+    for extension in (*TIFF_EXTENSIONS, ".ome", ".zarr"):
+        if name.lower().endswith(extension):
+            name = name[: -len(extension)]
+    return name
+
+
+def _tiff_scale(tif: tifffile.TiffFile, axes: str) -> list[float]:
+    """
+    Voxel size along every axis, from OME or ImageJ metadata
+
+    Missing sizes are 1.
+    """
+    sizes = {}
+    if tif.is_ome:
+        pixels = ElementTree.fromstring(tif.ome_metadata).find(
+            "{*}Image/{*}Pixels"
+        )
+        if pixels is not None:
+            for axis in "ZYX":
+                value = pixels.get(f"PhysicalSize{axis}")
+                if value is not None:
+                    sizes[axis] = float(value)
+    elif tif.is_imagej:
+        spacing = tif.imagej_metadata.get("spacing")
+        if spacing is not None:
+            sizes["Z"] = float(spacing)
+        x_resolution = tif.pages[0].tags.get("XResolution")
+        y_resolution = tif.pages[0].tags.get("YResolution")
+        for axis, tag in (("X", x_resolution), ("Y", y_resolution)):
+            if tag is not None and tag.value[0]:
+                sizes[axis] = tag.value[1] / tag.value[0]
+    return [sizes.get(axis, 1.0) for axis in axes.upper()]
+
+
+def read_tiff(path: str) -> list[tuple]:
+    """
+    Read a TIFF or OME-TIFF file without loading it into memory
+
+    Uncompressed contiguous files are memory-mapped, all others are wrapped
+    in a dask array that reads the file page by page, see read_pages.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file
+
+    Returns
+    -------
+    list of tuple
+        One layer data tuple
+    """
+    with tifffile.TiffFile(path) as tif:
+        series = tif.series[0]
+        axes = series.axes
+        scale = _tiff_scale(tif, axes)
+    try:
+        data = tifffile.memmap(path, mode="r")
+    except ValueError:
+        data = read_pages(path)
+
+    metadata = {"axes": axes}
+    intensity_scale, intensity_offset = read_conversion(path)
+    if (intensity_scale, intensity_offset) != (1.0, 0.0):
+        metadata["intensity_scale"] = intensity_scale
+        metadata["intensity_offset"] = intensity_offset
+    add_kwargs = {
+        "name": _layer_name(path),
+        "scale": scale,
+        "metadata": metadata,
+    }
+    return [(data, add_kwargs, "image")]
+
+
+def _read_page(path: str, index: int):
+    return tifffile.imread(path, series=0, key=index)
+
+
+def read_pages(path: str):
+    """
+    Open the first series of a TIFF file as a dask array of its pages
+
+    Every page is read and decompressed on its own when it is accessed,
+    which works for any compression and doesn't depend on the Zarr
+    version tifffile supports.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file
+
+    Returns
+    -------
+    dask.array.Array
+        Lazy image with one chunk per page
+    """
+    import dask.array as da
+    from dask import delayed
+
+    with tifffile.TiffFile(path) as tif:
+        series = tif.series[0]
+        shape = tuple(series.shape)
+        dtype = series.dtype
+        page_shape = tuple(series.keyframe.shape)
+        n_pages = len(series.pages)
+    leading = shape[: len(shape) - len(page_shape)]
+    if int(np.prod(leading)) != n_pages or shape[len(leading) :] != page_shape:
+        raise ValueError(f"Pages of {path} don't tile its image")
+    pages = [
+        da.from_delayed(delayed(_read_page)(path, index), page_shape, dtype)
+        for index in range(n_pages)
+    ]
+    return da.stack(pages).reshape(shape)
+
+
+def read_zarr(path: str) -> list[tuple]:
+    """
+    Read a Zarr array or OME-Zarr store as dask arrays
+
+    All resolution levels of an OME-Zarr store are opened and the layer
+    becomes multiscale.
+
+    Parameters
+    ----------
+    path : str
+        Path to the store
+
+    Returns
+    -------
+    list of tuple
+        One layer data tuple
+    """
+    import dask.array as da
+    import zarr
+
+    node = zarr.open(path, mode="r")
+    add_kwargs = {"name": _layer_name(path)}
+    if isinstance(node, zarr.Array):
+        return [(da.from_zarr(node), add_kwargs, "image")]
+
+    multiscales = node.attrs.get("multiscales")
+    if not multiscales:
+        arrays = list(node.array_keys())
+        if not arrays:
+            raise ValueError(f"No image data found in {path}")
+        return [(da.from_zarr(node[arrays[0]]), add_kwargs, "image")]
+
+    multiscale = multiscales[0]
+    levels = [
+        da.from_zarr(node[dataset["path"]])
+        for dataset in multiscale["datasets"]
+    ]
+    scale = [1.0] * levels[0].ndim
+    for transformation in multiscale["datasets"][0].get(
+        "coordinateTransformations", []
+    ):
+        if transformation.get("type") == "scale":
+            scale = [float(s) for s in transformation["scale"]]
+    add_kwargs["scale"] = scale
+    # axes are names in NGFF 0.3 and objects since 0.4
+    axes = [
+        axis["name"] if isinstance(axis, dict) else axis
+        for axis in multiscale.get("axes", [])
+    ]
+    add_kwargs["metadata"] = {
+        "axes": "".join(axes).upper(),
+        "multiscales": multiscale,
+    }
+    if len(levels) == 1:
+        return [(levels[0], add_kwargs, "image")]
+    add_kwargs["multiscale"] = True
+    return [(levels, add_kwargs, "image")]
@@ -0,0 +1,379 @@
+"""
+Managed scratch space for the intermediates of fusion runs.
+
+Every run gets its own subdirectory of a scratch root with a manifest.json
+describing it. The total size of all runs is limited to a number of bytes:
+before a new run starts, the oldest finished runs are deleted until the
+budget is met. Runs that fail or are cancelled are deleted right away, and
+runs left behind by a process that no longer exists are deleted the next
+time the scratch root is used. The cache of fusion results in the scratch
+root counts against the same budget. Runs and cached results whose files
+back layers of the viewer are pinned and never evicted, see
+ScratchStore.pin.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Iterator
+
+from ._cache import FusionCache
+
+# environment variable overriding the default scratch root
+SCRATCH_ENV = "LSFM_FUSION_SCRATCH"
+
+# default size limit of all runs in a scratch root
+SCRATCH_BYTES = 64 * 1024**3
+
+MANIFEST = "manifest.json"
+
+# directory of the cache of fusion results below the scratch root
+CACHE_DIRECTORY = "cache"
+
+# directory of the pins of every process below the scratch root
+PINS_DIRECTORY = "pins"
+
+_counter = itertools.count()
+
+
+def default_scratch_root() -> str:
+    """
+    Scratch root used unless another one is chosen
+
+    Returns
+    -------
+    str
+        Value of LSFM_FUSION_SCRATCH if set, otherwise a directory in the
+        system's temporary directory
+    """
+    return os.environ.get(SCRATCH_ENV) or os.path.join(
+        tempfile.gettempdir(), "lsfm_fusion"
+    )
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        import psutil
+    except ImportError:
+        if os.name != "posix":
+            # without psutil, unknown processes are kept on the safe side
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            return True
+        return True
+    return psutil.pid_exists(pid)
+
+
+def directory_size(path: str | Path) -> int:
+    """
+    Total size of all files below a directory in bytes
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            with contextlib.suppress(OSError):
+                total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+class ScratchStore:
+    """
+    Per-run scratch directories below a root, limited to a number of bytes
+
+    Parameters
+    ----------
+    root : str or Path, optional
+        Scratch root, preferably on a fast local disk, by default
+        default_scratch_root
+    max_bytes : int, optional
+        Size limit of all runs, by default SCRATCH_BYTES
+    """
+
+    def __init__(
+        self, root: str | Path | None = None, max_bytes: int = SCRATCH_BYTES
+    ):
+        self.root = Path(root or default_scratch_root())
+        self.runs_directory = self.root / "runs"
+        self.runs_directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def runs(self) -> list[Path]:
+        """
+        Directories of all runs, oldest first
+        """
+        runs = [
+            path
+            for path in self.runs_directory.iterdir()
+            if (path / MANIFEST).exists()
+        ]
+        return sorted(runs, key=lambda path: read_manifest(path)["created"])
+
+    def size(self) -> int:
+        """
+        Total size of all runs in bytes
+        """
+        return sum(directory_size(path) for path in self.runs())
+
+    def cache(self) -> FusionCache:
+        """
+        Cache of fusion results in the scratch root
+
+        The cache is limited to what the runs leave of the budget, and
+        evict shrinks it once the runs need the space.
+        """
+        return FusionCache(
+            self.root / CACHE_DIRECTORY,
+            max(0, self.max_bytes - self.size()),
+            keep=self.pinned(),
+        )
+
+    def _pin_target(self, path: str | Path) -> Path | None:
+        # resolved run directory or cached result holding path
+        path = Path(path).resolve()
+        for base in (self.runs_directory, self.root / CACHE_DIRECTORY):
+            base = base.resolve()
+            try:
+                relative = path.relative_to(base)
+            except ValueError:
+                continue
+            if relative.parts:
+                return base / relative.parts[0]
+        return None
+
+    def _pins_path(self) -> Path:
+        # pins of the current process
+        return self.root / PINS_DIRECTORY / f"{os.getpid()}.json"
+
+    def _read_pins(self, path: Path) -> list[str]:
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def _write_pins(self, pins: list[str]):
+        path = self._pins_path()
+        if not pins:
+            with contextlib.suppress(FileNotFoundError):
+                path.unlink()
+            return
+        path.parent.mkdir(exist_ok=True)
+        partial = path.with_suffix(".partial")
+        with open(partial, "w") as f:
+            json.dump(pins, f)
+        os.replace(partial, path)
+
+    def pin(self, path: str | Path) -> Path | None:
+        """
+        Keep the run or cached result holding a file from being evicted
+
+        Meant for files memory-mapped by layers of the viewer. Pins belong
+        to the current process and are counted, every pin is undone by one
+        unpin. Pins of processes that ended are ignored.
+
+        Parameters
+        ----------
+        path : str or Path
+            File in a run directory or a cached result
+
+        Returns
+        -------
+        Path or None
+            Pinned run directory or cached result, None if path is not in
+            the scratch root
+        """
+        target = self._pin_target(path)
+        if target is not None:
+            pins = self._read_pins(self._pins_path())
+            self._write_pins([*pins, str(target)])
+        return target
+
+    def unpin(self, path: str | Path):
+        """
+        Undo one pin of the run or cached result holding a file, see pin
+        """
+        target = self._pin_target(path)
+        pins = self._read_pins(self._pins_path())
+        if target is not None and str(target) in pins:
+            pins.remove(str(target))
+            self._write_pins(pins)
+
+    def pinned(self) -> set[Path]:
+        """
+        Runs and cached results pinned by any running process, resolved
+        """
+        pinned = set()
+        for path in (self.root / PINS_DIRECTORY).glob("*.json"):
+            if not _pid_alive(int(path.stem)):
+                with contextlib.suppress(OSError):
+                    path.unlink()
+                continue
+            pinned.update(Path(pin) for pin in self._read_pins(path))
+        return pinned
+
+    def new_run(
+        self, label: str = "fusion", params: dict[str, Any] | None = None
+    ) -> Path:
+        """
+        Create the directory of a new run
+
+        Runs of dead processes are removed and old runs are evicted first.
+
+        Parameters
+        ----------
+        label : str, optional
+            Kind of run, part of the directory name
+        params : dict, optional
+            Parameters to record in the manifest, arrays are left out
+
+        Returns
+        -------
+        Path
+            Empty directory with a manifest
+        """
+        self.remove_stale()
+        self.evict()
+        name = (
+            f"{time.strftime('%Y%m%d_%H%M%S')}_{label}_"
+            f"{os.getpid()}_{next(_counter)}"
+        )
+        path = self.runs_directory / name
+        path.mkdir(parents=True)
+        manifest = {
+            "created": time.time(),
+            "label": label,
+            "pid": os.getpid(),
+            "status": "running",
+            "parameters": {
+                key: value
+                for key, value in (params or {}).items()
+                if not hasattr(value, "shape")
+            },
+        }
+        _write_manifest(path, manifest)
+        return path
+
+    def finish(self, path: str | Path):
+        """
+        Mark a run as finished, it is kept until evicted
+
+        Runs that wrote nothing but their manifest are removed.
+        """
+        path = Path(path)
+        if not path.exists():
+            return
+        if [child.name for child in path.iterdir()] == [MANIFEST]:
+            self.discard(path)
+            return
+        manifest = read_manifest(path)
+        manifest.update(status="finished", finished=time.time())
+        _write_manifest(path, manifest)
+
+    def discard(self, path: str | Path):
+        """
+        Delete a run, e.g. after it failed or was cancelled
+        """
+        shutil.rmtree(path, ignore_errors=True)
+
+    def remove_stale(self):
+        """
+        Delete runs of processes that ended without finishing them
+        """
+        for path in self.runs():
+            manifest = read_manifest(path)
+            if manifest["status"] == "running" and not _pid_alive(
+                manifest["pid"]
+            ):
+                self.discard(path)
+
+    def evict(self, max_bytes: int | None = None):
+        """
+        Delete the oldest finished runs until all runs fit into max_bytes
+
+        The cache counts against max_bytes as well, its least recently used
+        results are evicted if deleting runs is not enough. Pinned runs and
+        results are kept.
+
+        Parameters
+        ----------
+        max_bytes : int, optional
+            Size to shrink to, by default self.max_bytes
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        runs = self.runs()
+        sizes = {path: directory_size(path) for path in runs}
+        total = sum(sizes.values())
+        pinned = self.pinned()
+        cache = FusionCache(self.root / CACHE_DIRECTORY, keep=pinned)
+        cache_size = cache.size()
+        for path in runs:
+            if total + cache_size <= max_bytes:
+                break
+            if (
+                path.resolve() in pinned
+                or read_manifest(path)["status"] == "running"
+            ):
+                continue
+            self.discard(path)
+            total -= sizes[path]
+        if total + cache_size > max_bytes:
+            cache.evict(max(0, max_bytes - total))
+
+    @contextlib.contextmanager
+    def run(
+        self, label: str = "fusion", params: dict[str, Any] | None = None
+    ) -> Iterator[Path]:
+        """
+        Directory of a run that is finished on success and deleted on error
+
+        Parameters
+        ----------
+        label : str, optional
+            Kind of run, see new_run
+        params : dict, optional
+            Parameters to record in the manifest
+
+        Yields
+        ------
+        Path
+            Directory of the run
+        """
+        path = self.new_run(label, params)
+        try:
+            yield path
+        except BaseException:
+            self.discard(path)
+            raise
+        self.finish(path)
+
+
+def read_manifest(path: str | Path) -> dict[str, Any]:
+    """
+    Manifest of a run, see ScratchStore.new_run
+    """
+    try:
+        with open(Path(path) / MANIFEST) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # unreadable manifests belong to runs that are safe to evict
+        return {"created": 0.0, "pid": -1, "status": "finished"}
+
+
+def _write_manifest(path: Path, manifest: dict[str, Any]):
+    # replace atomically so readers never see a partial manifest
+    partial = path / f"{MANIFEST}.partial"
+    with open(partial, "w") as f:
+        json.dump(manifest, f, indent=2, default=str)
+    os.replace(partial, path / MANIFEST)
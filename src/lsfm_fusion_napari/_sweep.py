@@ -0,0 +1,166 @@
+"""
+Parameter sweeps over a cropped part of the images.
+
+Every combination of the given window sizes and GF kernel sizes is fused on
+the same crop, in parallel FUSE processes, and the results are stacked
+along a new first axis for side-by-side comparison. A cancelled sweep
+terminates the processes instead of waiting for them.
+"""
+
+from __future__ import annotations
+
+import itertools
+import os
+import shutil
+from typing import Any, Generator
+
+import numpy as np
+
+from ._fusion import (
+    POLL_INTERVAL,
+    crop_parameters,
+    run_fusion,
+    run_parallel,
+    validate_parameters,
+)
+
+
+def parse_values(text: str, default: int) -> list[int]:
+    """
+    Parse a comma separated list of integers
+
+    Parameters
+    ----------
+    text : str
+        Values like "49, 59, 69", empty for default
+    default : int
+        Value used if text is empty
+
+    Returns
+    -------
+    list[int]
+        Values without duplicates, in the given order
+    """
+    if not text.strip():
+        return [default]
+    values = [int(value) for value in text.replace(";", ",").split(",")]
+    return list(dict.fromkeys(values))
+
+
+def sweep_combinations(
+    params: dict[str, Any],
+    window_sizes_y: list[int],
+    window_sizes_x: list[int],
+    gf_kernel_sizes: list[int],
+) -> list[dict[str, Any]]:
+    """
+    All combinations of the swept parameters
+
+    Parameters
+    ----------
+    params : dict
+        Parameters as compiled by FusionWidget._get_parameters
+    window_sizes_y, window_sizes_x : list[int]
+        Window sizes along Y and X
+    gf_kernel_sizes : list[int]
+        GF kernel sizes
+
+    Returns
+    -------
+    list[dict]
+        Parameters that differ from params, for every combination
+
+    Raises
+    ------
+    ValueError
+        If a combination is out of range
+    """
+    combinations = [
+        {"window_size": (window_y, window_x), "GF_kernel_size": gf_kernel}
+        for window_y, window_x, gf_kernel in itertools.product(
+            window_sizes_y, window_sizes_x, gf_kernel_sizes
+        )
+    ]
+    for combination in combinations:
+        validate_parameters({**params, **combination})
+    return combinations
+
+
+def fuse_combination(
+    params: dict[str, Any],
+    combination: dict[str, Any],
+    index: int,
+    interval: float = POLL_INTERVAL,
+) -> Generator[tuple[int, int, str], None, np.ndarray]:
+    """
+    Fuse one combination of a sweep with FUSE, see _fusion.run_fusion
+
+    Every combination gets its own subdirectory of tmp_path, so they can
+    be fused in parallel. The subdirectory is removed once the result is
+    read unless intermediates are kept.
+
+    Returns
+    -------
+    np.ndarray
+        Fused image as float32
+    """
+    tmp_path = os.path.join(params["tmp_path"], f"sweep_{index:02d}")
+    params = {**params, **combination, "tmp_path": tmp_path}
+    fused = yield from run_fusion(params, interval)
+    result = np.array(fused, dtype=np.float32)
+    del fused
+    if not params.get("keep_intermediates"):
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return result
+
+
+def run_sweep(
+    params: dict[str, Any],
+    combinations: list[dict[str, Any]],
+    z_range: tuple[int | None, int | None] = (None, None),
+    stride: int = 1,
+    workers: int = 1,
+) -> Generator[tuple[int, int, str], None, np.ndarray]:
+    """
+    Fuse a crop of the images once for every combination of parameters
+
+    Parameters
+    ----------
+    params : dict
+        Parameters as compiled by FusionWidget._get_parameters
+    combinations : list[dict]
+        Parameters to override in every run, see sweep_combinations
+    z_range : tuple[int or None, int or None], optional
+        Start and stop plane of the crop, see _fusion.crop_parameters
+    stride : int, optional
+        Step between the pixels kept along Y and X, by default 1
+    workers : int, optional
+        Number of FUSE processes fusing in parallel, by default 1
+
+    Yields
+    ------
+    tuple[int, int, str]
+        Runs done, total runs and a description
+
+    Returns
+    -------
+    np.ndarray
+        Fused crops stacked along a new first axis, in the order of
+        combinations
+    """
+    total = len(combinations)
+    yield 0, total, "Cropping images"
+    cropped = crop_parameters(params, z_range, stride)
+    results: list[np.ndarray | None] = [None] * total
+    interval = POLL_INTERVAL / max(1, workers)
+    runs = (
+        (index, fuse_combination(cropped, combination, index, interval))
+        for index, combination in enumerate(combinations)
+    )
+    done = 0
+    for finished in run_parallel(runs, workers):
+        if finished is not None:
+            index, results[index] = finished
+            done += 1
+        yield done, total, f"Fused combination {done}/{total}"
+    return np.stack(results)
@@ -0,0 +1,67 @@
+import pytest
+
+# stand-in for FUSE, imported by the FUSE process from sys.path
+FAKE_FUSE = """
+import os
+import time
+
+import numpy as np
+
+
+class FUSE_illu:
+    def train_from_params(self, params):
+        if params.get("log"):
+            # the test counts the runs in the given file
+            with open(params["log"], "a") as f:
+                f.write(params["tmp_path"] + "\\n")
+        if params.get("fail"):
+            raise ValueError("no sample")
+        if params.get("oom"):
+            raise MemoryError("no memory left")
+        if params.get("hang"):
+            # the test waits for the process id in the given file
+            with open(params["hang"], "w") as f:
+                f.write(str(os.getpid()))
+            time.sleep(60)
+        if params.get("blend"):
+            return blend(params["image1"], params["image2"])
+        mean = (params["image1"] + params["image2"]) / 2
+        if params.get("scaled"):
+            # depends on the parameters of a sweep
+            return mean * params["GF_kernel_size"] + params["window_size"][0]
+        return mean
+
+
+def blend(top, bottom):
+    # the top of the first view with the bottom of the second one
+    y = np.linspace(-4, 4, top.shape[1])
+    weight = (1 / (1 + np.exp(2 * y)))[None, :, None]
+    return weight * top + (1 - weight) * bottom
+
+
+FUSE_det = FUSE_illu
+"""
+
+
+@pytest.fixture
+def fake_fuse(tmp_path, monkeypatch):
+    """
+    Let FUSE processes import FAKE_FUSE instead of FUSE
+    """
+    directory = tmp_path / "fake"
+    directory.mkdir()
+    (directory / "FUSE.py").write_text(FAKE_FUSE)
+    # spawned processes get the sys.path of their parent
+    monkeypatch.syspath_prepend(str(directory))
+
+
+def consume(generator):
+    """
+    Exhaust a generator, returning what it yielded and what it returned
+    """
+    progress = []
+    try:
+        while True:
+            progress.append(next(generator))
+    except StopIteration as stop:
+        return progress, stop.value
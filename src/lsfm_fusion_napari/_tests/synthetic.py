@@ -0,0 +1,115 @@
+"""
+Synthetic LSFM volumes for benchmarks and memory tests.
+
+A random sample of blurred blobs is imaged from two opposite sides. Every
+view is sharp and bright close to its side and degrades with depth: the
+intensity decays, the blur increases, and absorbing structures cast stripes
+along the light path. Fusion should combine the good halves of both views.
+"""
+
+from __future__ import annotations
+
+import numpy as np
+from scipy import ndimage
+
+# (Z, Y, X) shapes of the benchmark sizes
+SIZES = {
+    "small": (32, 128, 128),
+    "medium": (64, 512, 512),
+    "large": (128, 1024, 1024),
+}
+
+
+def sample(shape: tuple[int, int, int], seed: int = 0) -> np.ndarray:
+    """
+    Ground truth of blob-like structures with values in [0, 1]
+    """
+    rng = np.random.default_rng(seed)
+    noise = rng.random(shape, dtype=np.float32)
+    blobs = ndimage.gaussian_filter(noise, 2)
+    blobs -= blobs.min()
+    blobs /= max(float(blobs.max()), 1e-6)
+    return blobs**4
+
+
+def _degrade(
+    truth: np.ndarray, axis: int, reverse: bool, rng: np.random.Generator
+) -> np.ndarray:
+    # depth of every voxel along the light path, 0 at the side of the view
+    depth = np.linspace(0, 1, truth.shape[axis], dtype=np.float32)
+    if reverse:
+        depth = depth[::-1]
+    shape = [1, 1, 1]
+    shape[axis] = -1
+    depth = depth.reshape(shape)
+
+    blurred = ndimage.gaussian_filter(truth, 3)
+    view = (1 - depth) * truth + depth * blurred
+    view *= np.exp(-2 * depth)
+
+    # stripes along the light path from absorbers near the side of the view
+    stripe_shape = list(truth.shape)
+    stripe_shape[axis] = 1
+    absorbers = rng.random(stripe_shape, dtype=np.float32) > 0.97
+    view *= 1 - 0.5 * absorbers * np.minimum(depth * 4, 1)
+
+    view += rng.normal(0, 0.01, truth.shape).astype(np.float32)
+    return np.clip(view * 60000, 0, 65535).astype(np.uint16)
+
+
+def dual_illumination(
+    shape: tuple[int, int, int], seed: int = 0
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Two views of one sample illuminated from the top and the bottom
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        uint16 views degrading along Y from either side
+    """
+    rng = np.random.default_rng(seed)
+    truth = sample(shape, seed)
+    return _degrade(truth, 1, False, rng), _degrade(truth, 1, True, rng)
+
+
+def dual_detection(
+    shape: tuple[int, int, int], seed: int = 0
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Two views of one sample detected from the front and the back
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        uint16 views degrading along Z from either side
+    """
+    rng = np.random.default_rng(seed)
+    truth = sample(shape, seed)
+    return _degrade(truth, 0, False, rng), _degrade(truth, 0, True, rng)
+
+
+def fusion_parameters(
+    method: str, images: tuple[np.ndarray, np.ndarray], tmp_path: str
+) -> dict:
+    """
+    Parameters like FusionWidget._get_parameters for two synthetic views
+    """
+    second = 2 if method == "illumination" else 3
+    return {
+        "method": method,
+        "amount": 2,
+        "image1": images[0],
+        "direction1": "Top",
+        f"image{second}": images[1],
+        f"direction{second}": "Bottom" if second == 2 else "Top",
+        "resample_ratio": 2,
+        "window_size": (59, 5),
+        "GF_kernel_size": 49,
+        "require_segmentation": False,
+        "require_registration": False,
+        "require_flip_illu": False,
+        "require_flip_det": False,
+        "keep_intermediates": False,
+        "tmp_path": tmp_path,
+    }
@@ -0,0 +1,90 @@
+"""
+Benchmarks of the hot paths on synthetic volumes.
+
+Run with pytest-benchmark, e.g. through "tox -e benchmark". The sizes are
+chosen with the LSFM_BENCHMARK_SIZES environment variable, a comma separated
+subset of synthetic.SIZES, by default only "small".
+"""
+
+import os
+
+import pytest
+
+from lsfm_fusion_napari._fusion import run_fusion
+from lsfm_fusion_napari._normalization import normalize_percentiles
+from lsfm_fusion_napari._tiling import run_tiled_fusion
+from lsfm_fusion_napari._writer import write_tiff, write_zarr
+
+from .conftest import consume
+from .synthetic import (
+    SIZES,
+    dual_detection,
+    dual_illumination,
+    fusion_parameters,
+)
+
+pytest.importorskip("pytest_benchmark")
+
+BENCHMARK_SIZES = os.environ.get("LSFM_BENCHMARK_SIZES", "small").split(",")
+ROUNDS = 3
+
+
+@pytest.fixture(scope="module", params=BENCHMARK_SIZES)
+def size(request):
+    return SIZES[request.param.strip()]
+
+
+@pytest.fixture(scope="module")
+def views(size):
+    return dual_illumination(size)
+
+
+@pytest.mark.benchmark(group="normalization")
+def test_normalize_percentiles(benchmark, views):
+    benchmark.pedantic(
+        normalize_percentiles, (views[0], 1, 99.9), rounds=ROUNDS
+    )
+
+
+@pytest.mark.benchmark(group="write_tiff")
+def test_write_tiff(benchmark, views, tmp_path):
+    path = str(tmp_path / "image.tiff")
+    benchmark.pedantic(write_tiff, (path, views[0]), rounds=ROUNDS)
+
+
+@pytest.mark.benchmark(group="write_zarr")
+@pytest.mark.parametrize("workers", [1, 4])
+def test_write_zarr(benchmark, views, tmp_path, workers):
+    path = str(tmp_path / "image.zarr")
+    benchmark.pedantic(
+        write_zarr,
+        (path, views[0]),
+        {"workers": workers},
+        rounds=ROUNDS,
+    )
+
+
+@pytest.mark.benchmark(group="fusion")
+@pytest.mark.parametrize("method", ["illumination", "detection"])
+def test_fusion(benchmark, size, method, tmp_path):
+    pytest.importorskip("FUSE")
+    if method == "illumination":
+        images = dual_illumination(size)
+    else:
+        images = dual_detection(size)
+    params = fusion_parameters(method, images, str(tmp_path))
+    benchmark.pedantic(
+        lambda: consume(run_fusion(params)), rounds=1, iterations=1
+    )
+
+
+@pytest.mark.benchmark(group="tiled fusion")
+@pytest.mark.parametrize("workers", [1, 2])
+def test_tiled_fusion(benchmark, views, tmp_path, workers):
+    pytest.importorskip("FUSE")
+    params = fusion_parameters("illumination", views, str(tmp_path))
+    benchmark.pedantic(
+        lambda: consume(run_tiled_fusion(params, workers=workers)),
+        rounds=1,
+        iterations=1,
+    )
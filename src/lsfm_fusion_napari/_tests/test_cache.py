@@ -0,0 +1,133 @@
+import os
+
+import numpy as np
+
+from lsfm_fusion_napari import _cache
+from lsfm_fusion_napari._cache import (
+    FusionCache,
+    cache_key,
+    hash_array,
+    result_arguments,
+    run_cached,
+)
+
+from .conftest import consume
+
+PARAMS = {
+    "method": "illumination",
+    "amount": 2,
+    "direction1": "Top",
+    "direction2": "Bottom",
+    "window_size": (59, 5),
+    "GF_kernel_size": 49,
+    "tmp_path": "/tmp/a",
+}
+
+
+def make_params(**kwargs):
+    image = np.arange(4 * 5 * 6, dtype=np.uint16).reshape(4, 5, 6)
+    return {**PARAMS, "image1": image, "image2": image[::-1], **kwargs}
+
+
+def test_cache_key():
+    """
+    Test that keys change with the images and the result parameters only
+    """
+    key = cache_key(make_params())
+    assert key == cache_key(make_params(tmp_path="/tmp/b"))
+    assert key != cache_key(make_params(GF_kernel_size=59))
+    assert key != cache_key(make_params(image2=np.zeros((4, 5, 6))))
+    assert key != cache_key(make_params(), "run_tiled_fusion", 64)
+    image = np.ones((3, 4))
+    assert hash_array(image) != hash_array(image.astype(np.float32))
+
+
+def test_run_cached(tmp_path):
+    """
+    Test that a second run with the same inputs is loaded from the cache
+    """
+    calls = []
+
+    def run_fusion(params):
+        calls.append(params["GF_kernel_size"])
+        yield 0, 1, "Fusing"
+        return (params["image1"] + params["image2"]).astype(np.float32)
+
+    cache = FusionCache(tmp_path)
+    _, first = consume(run_cached(cache, run_fusion, make_params()))
+    _, second = consume(run_cached(cache, run_fusion, make_params()))
+    consume(run_cached(cache, run_fusion, make_params(GF_kernel_size=59)))
+    assert calls == [49, 59]
+    np.testing.assert_array_equal(first, second)
+    assert not second.flags.writeable
+
+
+def test_result_arguments():
+    """
+    Test that only arguments changing the result are part of the key
+    """
+
+    def run_tiled_fusion(params, slab_size=64, overlap=None, workers=1):
+        yield 0, 1, "Fusing"
+
+    params = make_params()
+    arguments = result_arguments(run_tiled_fusion, params, 64, None, 4)
+    assert arguments == {"slab_size": 64, "overlap": None}
+    assert arguments == result_arguments(run_tiled_fusion, params)
+    assert arguments != result_arguments(run_tiled_fusion, params, 32)
+
+
+def test_evict_least_recently_used(tmp_path):
+    """
+    Test that the least recently used results are evicted first
+    """
+    data = np.zeros(1000, dtype=np.uint8)
+    cache = FusionCache(tmp_path, max_bytes=2500)
+    for key in ("a", "b"):
+        cache.put(key, data)
+    for key, mtime in (("a", 1), ("b", 2)):
+        # make the access order independent of the timer resolution
+        os.utime(tmp_path / f"{key}.npy", (mtime, mtime))
+    cache.get("a")
+    cache.put("c", data)
+    assert "a" in cache
+    assert "b" not in cache
+    assert "c" in cache
+    assert cache.size() <= 2500
+
+
+def test_cache_key_of_mapped_file(tmp_path, monkeypatch):
+    """
+    Test that memory-mapped images are keyed on their file, not read
+    """
+    path = tmp_path / "image.npy"
+    np.save(path, make_params()["image1"])
+    image = np.load(path, mmap_mode="r")
+
+    def hash_array(data):
+        raise AssertionError("mapped file was read")
+
+    monkeypatch.setattr(_cache, "hash_array", hash_array)
+    params = make_params(image1=image, image2=image[::-1])
+    key = cache_key(params)
+    assert key == cache_key(make_params(image1=image, image2=image[::-1]))
+    os.utime(path, (1, 1))
+    assert key != cache_key(params)
+
+
+def test_put_moves_result_file(tmp_path):
+    """
+    Test that a result memory-mapped from a .npy file is moved into the
+    cache instead of copied
+    """
+    path = tmp_path / "fused.npy"
+    np.save(path, np.arange(10, dtype=np.float32))
+    cache = FusionCache(tmp_path / "cache")
+    stored = cache.put("a", np.load(path, mmap_mode="r"))
+    assert not path.exists()
+    np.testing.assert_array_equal(stored, np.arange(10))
+    # views of a file are copied
+    np.save(path, np.arange(10, dtype=np.float32))
+    stored = cache.put("b", np.load(path, mmap_mode="r")[::2])
+    assert path.exists()
+    np.testing.assert_array_equal(stored, np.arange(0, 10, 2))
@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+
+from lsfm_fusion_napari._channels import (
+    channel_count,
+    channels_first,
+    run_multichannel,
+)
+from lsfm_fusion_napari._timelapse import frame_parameters
+
+from .conftest import consume
+from .synthetic import dual_illumination
+
+SHAPE = (3, 32, 32)
+N_CHANNELS = 3
+
+
+def blend(params):
+    # what the fake FUSE computes with "blend", see conftest
+    y = np.linspace(-4, 4, params["image1"].shape[1])
+    weight = (1 / (1 + np.exp(2 * y)))[None, :, None]
+    return weight * params["image1"] + (1 - weight) * params["image2"]
+
+
+def fuse_runs(params):
+    # directories of the timepoints FUSE ran on
+    with open(params["log"]) as f:
+        return f.read().splitlines()
+
+
+@pytest.fixture
+def params(tmp_path, fake_fuse):
+    (tmp_path / "log").touch()
+    # channels differ in their structures and brightness
+    views = [
+        [view * (channel + 1) for view in dual_illumination(SHAPE, channel)]
+        for channel in range(N_CHANNELS)
+    ]
+    yield {
+        "method": "illumination",
+        "amount": 2,
+        "image1": np.stack([view[0] for view in views]),
+        "direction1": "Top",
+        "image2": np.stack([view[1] for view in views]),
+        "direction2": "Bottom",
+        "require_registration": False,
+        "tmp_path": str(tmp_path / "scratch"),
+        "blend": True,
+        "log": str(tmp_path / "log"),
+    }
+
+
+def test_channels_first():
+    """
+    Test that the channel axis is moved to the front by the stored axes
+    """
+    data = np.zeros((5, 2, 8, 9))
+    assert channels_first(data, "ZCYX").shape == (2, 5, 8, 9)
+    assert channels_first(data, "czyx").shape == data.shape
+    # without axes the channels are assumed to be first
+    assert channels_first(data).shape == data.shape
+    assert channels_first(data, "ZYX").shape == data.shape
+
+
+def test_channel_count(params):
+    """
+    Test that all views need the same number of channels
+    """
+    assert channel_count(params) == N_CHANNELS
+    with pytest.raises(ValueError):
+        channel_count({**params, "image2": params["image2"][:2]})
+    with pytest.raises(ValueError):
+        channel_count({**params, "image1": params["image1"][0]})
+
+
+def test_run_multichannel(params):
+    """
+    Test that only the reference channel is fused with FUSE
+    """
+    progress, out = consume(run_multichannel(params, reference=1, workers=2))
+    assert out.shape == (N_CHANNELS, *SHAPE)
+    assert len(fuse_runs(params)) == 1
+    assert fuse_runs(params)[0].endswith("t0001")
+    assert any("reference channel 1" in stage for _, _, stage in progress)
+    for channel in range(N_CHANNELS):
+        expected = blend(frame_parameters(params, channel))
+        error = np.abs(out[channel] - expected).mean()
+        assert error < 0.02 * expected.mean()
+
+
+def test_run_multichannel_invalid_reference(params):
+    """
+    Test that the reference channel must exist
+    """
+    with pytest.raises(ValueError):
+        consume(run_multichannel(params, reference=N_CHANNELS))
+
+
+def test_run_multichannel_refuses_registration(params):
+    """
+    Test that registered views are refused instead of fusing every channel
+    """
+    with pytest.raises(ValueError, match="registered"):
+        consume(run_multichannel({**params, "require_registration": True}))
+    assert fuse_runs(params) == []
+
+
+def test_close_multichannel(params, tmp_path):
+    """
+    Test that closing a multi-channel fusion terminates FUSE on the
+    reference channel
+    """
+    psutil = pytest.importorskip("psutil")
+    path = tmp_path / "pid"
+    fusion = run_multichannel({**params, "hang": str(path)}, workers=2)
+    while not (path.exists() and path.read_text()):
+        next(fusion)
+    pid = int(path.read_text())
+    fusion.close()
+    assert not psutil.pid_exists(pid)
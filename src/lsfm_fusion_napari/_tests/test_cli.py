@@ -0,0 +1,155 @@
+import json
+import sys
+
+import numpy as np
+import pytest
+import tifffile
+
+from lsfm_fusion_napari._cli import (
+    job_memory,
+    load_image,
+    load_job,
+    parse_size,
+    run_job,
+)
+from lsfm_fusion_napari._weights import fit_weights, save_weights
+from lsfm_fusion_napari._writer import read_conversion
+
+
+def test_parse_size():
+    """
+    Test parsing of memory sizes given on the command line
+    """
+    assert parse_size("1024") == 1024
+    assert parse_size("512M") == 512 * 1024**2
+    assert parse_size("1.5g") == int(1.5 * 1024**3)
+    assert parse_size("64GB") == 64 * 1024**3
+    with pytest.raises(ValueError):
+        parse_size("a lot")
+
+
+def test_load_job(tmp_path):
+    """
+    Test that a job file is completed with defaults and relative paths are
+    resolved against its directory
+    """
+    job = {
+        "method": "detection",
+        "amount": 2,
+        "image1": "front.tiff",
+        "direction1": "Top",
+        "image3": "back.tiff",
+        "direction3": "Top",
+        "window_size": [59, 5],
+    }
+    job_path = tmp_path / "sample.json"
+    job_path.write_text(json.dumps(job))
+    params = load_job(job_path)
+    assert params["image1"] == str(tmp_path / "front.tiff")
+    assert params["window_size"] == (59, 5)
+    assert params["GF_kernel_size"] == 49
+    assert params["output"] == str(tmp_path / "sample_fused.tiff")
+
+
+def test_load_image(tmp_path):
+    """
+    Test that uncompressed inputs are memory-mapped and others are read
+    """
+    image = np.arange(4 * 8 * 8, dtype=np.uint16).reshape(4, 8, 8)
+    tifffile.imwrite(tmp_path / "plain.tiff", image)
+    tifffile.imwrite(tmp_path / "packed.tiff", image, compression="zlib")
+    np.save(tmp_path / "plain.npy", image)
+    for name in ("plain.tiff", "plain.npy"):
+        loaded = load_image(str(tmp_path / name))
+        assert isinstance(loaded, np.memmap)
+        np.testing.assert_array_equal(loaded, image)
+    loaded = load_image(str(tmp_path / "packed.tiff"))
+    np.testing.assert_array_equal(loaded, image)
+
+
+def test_load_job_invalid(tmp_path):
+    """
+    Test that jobs with missing images or invalid parameters are rejected
+    """
+    job = {
+        "method": "illumination",
+        "image1": "top.tiff",
+        "direction1": "Top",
+        "GF_kernel_size": 100,
+    }
+    job_path = tmp_path / "sample.json"
+    job_path.write_text(json.dumps(job))
+    with pytest.raises(ValueError):
+        load_job(job_path)
+
+
+def test_load_job_weights_of_registered_views(tmp_path):
+    """
+    Test that jobs saving or applying weights of registered views are
+    rejected when they are loaded
+    """
+    job = {
+        "method": "illumination",
+        "image1": "top.tiff",
+        "direction1": "Top",
+        "image2": "bottom.tiff",
+        "direction2": "Bottom",
+        "require_registration": True,
+        "lateral_resolution": 1,
+        "axial_resolution": 1,
+        "save_weights": "weights.npz",
+    }
+    job_path = tmp_path / "sample.json"
+    job_path.write_text(json.dumps(job))
+    with pytest.raises(ValueError, match="save_weights"):
+        load_job(job_path)
+
+
+def test_run_job_apply_weights(tmp_path):
+    """
+    Test that a job with saved weights is fused without FUSE
+    """
+    rng = np.random.default_rng(0)
+    top, bottom = rng.random((2, 4, 16, 16), dtype=np.float32)
+    np.save(tmp_path / "top.npy", top)
+    np.save(tmp_path / "bottom.npy", bottom)
+    job = {
+        "method": "illumination",
+        "image1": "top.npy",
+        "direction1": "Top",
+        "image2": "bottom.npy",
+        "direction2": "Bottom",
+        "tmp_path": "scratch",
+        "apply_weights": "weights.npz",
+    }
+    save_weights(
+        str(tmp_path / "weights.npz"),
+        fit_weights([top, bottom], (top + bottom) / 2),
+        {**job, "amount": 2},
+    )
+    job_path = tmp_path / "sample.json"
+    job_path.write_text(json.dumps(job))
+    params = load_job(job_path)
+    assert params["apply_weights"] == str(tmp_path / "weights.npz")
+    with pytest.raises(MemoryError):
+        run_job(params, memory_limit=1)
+    output = run_job(params, memory_limit=parse_size("64T"))
+    scale, offset = read_conversion(output)
+    np.testing.assert_allclose(
+        tifffile.imread(output) / scale + offset, (top + bottom) / 2, atol=1e-3
+    )
+
+
+def test_job_memory_leaves_out_mapped_files(tmp_path):
+    """
+    Test that pages of memory-mapped inputs don't count against the limit
+    """
+    if not sys.platform.startswith("linux"):
+        pytest.skip("Only Linux reports file-backed pages")
+    mapped = np.lib.format.open_memmap(
+        tmp_path / "image.npy", mode="w+", dtype=np.uint8, shape=(64 << 20,)
+    )
+    mapped[:] = 1
+    baseline = job_memory()
+    assert int(mapped.sum(dtype=np.int64)) == mapped.size
+    assert job_memory() - baseline < mapped.nbytes / 4
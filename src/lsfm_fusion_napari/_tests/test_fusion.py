@@ -0,0 +1,183 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+from lsfm_fusion_napari._fusion import (
+    crop_parameters,
+    load_image,
+    mapped_file,
+    open_image,
+    run_fusion,
+    share_image,
+    validate_parameters,
+)
+
+from .conftest import consume
+
+
+@pytest.fixture
+def params(tmp_path):
+    image = np.arange(10 * 12 * 16, dtype=np.uint16).reshape(10, 12, 16)
+    yield {
+        "method": "illumination",
+        "amount": 2,
+        "image1": image,
+        "direction1": "Top",
+        "image2": image + 1,
+        "direction2": "Bottom",
+        "resample_ratio": 2,
+        "window_size": (59, 5),
+        "GF_kernel_size": 49,
+        "require_segmentation": False,
+        "require_registration": False,
+        "require_flip_illu": False,
+        "require_flip_det": False,
+        "keep_intermediates": False,
+        "tmp_path": str(tmp_path),
+    }
+
+
+def test_validate_parameters(params):
+    """
+    Test that missing images and out-of-range parameters are rejected
+    """
+    validate_parameters(params)
+    with pytest.raises(ValueError):
+        validate_parameters({**params, "image2": None})
+    with pytest.raises(ValueError):
+        validate_parameters({**params, "window_size": (5, 59)})
+    with pytest.raises(ValueError):
+        validate_parameters({**params, "require_registration": True})
+
+
+def test_crop_parameters(params, tmp_path):
+    """
+    Test that previews get a Z range of the images, subsampled in Y and X
+    """
+    cropped = crop_parameters(params, (2, 6), 4)
+    assert cropped["image1"].shape == (4, 3, 4)
+    np.testing.assert_array_equal(
+        cropped["image2"], params["image2"][2:6, ::4, ::4]
+    )
+    assert cropped["image1"].flags.c_contiguous
+    assert cropped["tmp_path"] == str(tmp_path / "preview")
+    # the parameters of the full run are untouched
+    assert params["image1"].shape == (10, 12, 16)
+    with pytest.raises(ValueError):
+        crop_parameters(params, (6, 2), 1)
+
+
+def test_load_image(tmp_path):
+    """
+    Test that lazy images are read into memory and others kept as they are
+    """
+    import dask.array as da
+    import zarr
+
+    image = np.arange(10 * 12 * 16, dtype=np.uint16).reshape(10, 12, 16)
+    assert load_image(image) is image
+    mapped = np.lib.format.open_memmap(
+        tmp_path / "image.npy", mode="w+", dtype=image.dtype, shape=image.shape
+    )
+    assert load_image(mapped) is mapped
+
+    stored = zarr.open(
+        str(tmp_path / "image.zarr"),
+        mode="w",
+        shape=image.shape,
+        chunks=(3, 12, 16),
+        dtype=image.dtype,
+    )
+    stored[:] = image
+    for lazy in (stored, da.from_zarr(stored)):
+        loaded = load_image(lazy)
+        assert type(loaded) is np.ndarray
+        np.testing.assert_array_equal(loaded, image)
+
+
+def test_share_image(params, tmp_path):
+    """
+    Test that memory maps are shared by file and other arrays by memory
+    """
+    image = params["image1"]
+    mapped = np.lib.format.open_memmap(
+        tmp_path / "image.npy", mode="w+", dtype=image.dtype, shape=image.shape
+    )
+    mapped[:] = image
+    view = mapped[2:7, ::-3, 1::2]
+    assert mapped_file(image) is None
+    assert mapped_file(view)[0] == str(tmp_path / "image.npy")
+
+    handles = []
+    reference = share_image(view, handles)
+    assert reference[0] == "file"
+    assert not handles
+    np.testing.assert_array_equal(open_image(reference, handles), view)
+
+    reference = share_image(image[::2], handles)
+    assert reference[0] == "shared"
+    assert len(handles) == 1
+    shared = open_image(reference, handles)
+    np.testing.assert_array_equal(shared, image[::2])
+    del shared
+    for handle in handles:
+        handle.close()
+    handles[0].unlink()
+
+
+def test_run_fusion(params, fake_fuse):
+    """
+    Test that FUSE runs in a child process whose result is memory-mapped
+    """
+    progress, output_image = consume(run_fusion(params, interval=0.05))
+    stages = list(dict.fromkeys(stage for _, _, stage in progress))
+    assert stages == ["Preparing inputs", "Fusing", "Finished"]
+    assert progress[-1][:2] == (2, 2)
+    assert isinstance(output_image, np.memmap)
+    np.testing.assert_array_equal(
+        output_image, (params["image1"] + params["image2"]) / 2
+    )
+
+    mapped = np.lib.format.open_memmap(
+        params["tmp_path"] + "/image.npy",
+        mode="w+",
+        dtype=np.uint16,
+        shape=(2, *params["image1"].shape),
+    )
+    mapped[:] = [params["image1"], params["image2"]]
+    _, output_image = consume(
+        run_fusion(
+            {**params, "image1": mapped[0], "image2": mapped[1]},
+            interval=0.05,
+        )
+    )
+    np.testing.assert_array_equal(
+        output_image, (params["image1"] + params["image2"]) / 2
+    )
+
+    with pytest.raises(RuntimeError, match="ValueError: no sample"):
+        consume(run_fusion({**params, "fail": True}, interval=0.05))
+    with pytest.raises(MemoryError, match="no memory left"):
+        consume(run_fusion({**params, "oom": True}, interval=0.05))
+
+
+def test_run_fusion_cancel(params, fake_fuse, tmp_path):
+    """
+    Test that closing a fusion terminates FUSE while it trains
+    """
+    psutil = pytest.importorskip("psutil")
+    path = tmp_path / "pid"
+    fusion = run_fusion({**params, "hang": str(path)}, interval=0.05)
+    start = time.perf_counter()
+    while not (path.exists() and path.read_text()):
+        next(fusion)
+        assert time.perf_counter() - start < 30
+    pid = int(path.read_text())
+    assert psutil.pid_exists(pid)
+    start = time.perf_counter()
+    fusion.close()
+    assert time.perf_counter() - start < 10
+    assert not psutil.pid_exists(pid)
+    assert pid != os.getpid()
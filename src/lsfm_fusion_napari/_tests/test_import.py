@@ -0,0 +1,36 @@
+import subprocess
+import sys
+
+# generous budget, importing the package should only take milliseconds
+IMPORT_TIME_BUDGET = 1.0  # seconds
+
+HEAVY_MODULES = ("FUSE", "torch", "aicsimageio", "napari", "qtpy")
+
+SCRIPT = f"""
+import sys
+import time
+
+start = time.perf_counter()
+import lsfm_fusion_napari
+print(time.perf_counter() - start)
+print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))
+"""
+
+
+def test_import_time():
+    """
+    Test that importing the package stays within the time budget and does
+    not import any heavy dependency
+
+    The import runs in a fresh interpreter so modules imported by other
+    tests don't distort the measurement.
+    """
+    result = subprocess.run(
+        [sys.executable, "-c", SCRIPT],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    import_time, imported = result.stdout.splitlines()
+    assert float(import_time) < IMPORT_TIME_BUDGET
+    assert imported == ""
@@ -0,0 +1,138 @@
+"""
+Peak memory of normalization, export and fusion.
+
+Every test measures the peak allocation of one call and asserts a ceiling
+as a multiple of the input size, so changes that add hidden full-volume
+copies fail here. Chunks are made small so that the volumes span many of
+them.
+"""
+
+import os
+import tracemalloc
+
+import numpy as np
+import pytest
+
+from lsfm_fusion_napari import _normalization
+from lsfm_fusion_napari._normalization import normalize_percentiles
+from lsfm_fusion_napari._tiling import iter_tiled
+from lsfm_fusion_napari._writer import write_tiff, write_zarr
+
+from .synthetic import dual_illumination, fusion_parameters
+
+SHAPE = (64, 256, 256)
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(_normalization, "CHUNK_BYTES", 256 * 1024)
+
+
+@pytest.fixture(scope="module")
+def image():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 4000, SHAPE, dtype=np.uint16)
+
+
+def peak_allocation(function, *args, **kwargs):
+    """
+    Result of a call and the peak of memory allocated during it in bytes
+    """
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    try:
+        result = function(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+@pytest.mark.parametrize(
+    "input_dtype, kwargs, ceiling",
+    [
+        # the output alone takes twice the input
+        ("uint16", {"dtype": "float32"}, 2.2),
+        ("uint16", {"dtype": "uint16"}, 1.2),
+        # percentiles of floats partition a copy of the input
+        ("float32", {"dtype": "float32"}, 1.2),
+        ("float32", {"dtype": "float32", "in_place": True}, 1.1),
+    ],
+)
+def test_normalization_memory(image, input_dtype, kwargs, ceiling):
+    """
+    Test that normalization allocates little beyond its output
+    """
+    data = image.astype(input_dtype)
+    _, peak = peak_allocation(normalize_percentiles, data, 1, 99, **kwargs)
+    assert peak <= ceiling * data.nbytes
+
+
+@pytest.mark.parametrize("dtype", ["uint16", "float32"])
+def test_write_tiff_memory(image, tmp_path, dtype):
+    """
+    Test that TIFF export streams the volume instead of converting it
+    """
+    data = image.astype(dtype)
+    _, peak = peak_allocation(write_tiff, str(tmp_path / "image.tiff"), data)
+    assert peak <= 0.1 * data.nbytes
+
+
+def test_write_zarr_memory(image, tmp_path):
+    """
+    Test that Zarr export holds only a few chunks at a time
+    """
+    data = image.astype(np.float32)
+    _, peak = peak_allocation(
+        write_zarr,
+        str(tmp_path / "image.zarr"),
+        data,
+        chunks=(16, 64, 64),
+        workers=2,
+    )
+    # every chunk of a downsampled level is read from eight chunks
+    assert peak <= 0.3 * data.nbytes
+
+
+def test_tiled_fusion_memory(image, tmp_path):
+    """
+    Test that slab-wise fusion holds slabs, not volumes, in memory
+    """
+
+    def fuse(slabs, index):
+        yield
+        return slabs["image1"].astype(np.float32)
+
+    out = np.lib.format.open_memmap(
+        tmp_path / "fused.npy", mode="w+", dtype=np.float32, shape=SHAPE
+    )
+    _, peak = peak_allocation(
+        lambda: list(iter_tiled({"image1": image}, fuse, out, 8, 4))
+    )
+    # a slab of 16 planes is a quarter of the volume, as float32 a half
+    assert peak <= 0.6 * image.nbytes
+
+
+def test_fusion_memory(tmp_path):
+    """
+    Test that a small fusion run stays within a multiple of its inputs
+
+    FUSE may allocate outside of Python's allocators, so the resident
+    memory of the process is sampled instead of traced.
+    """
+    pytest.importorskip("FUSE")
+    import psutil
+
+    from lsfm_fusion_napari._fusion import run_fusion
+    from lsfm_fusion_napari._profiling import RunProfile, profile_run
+
+    views = dual_illumination(SHAPE)
+    params = fusion_parameters("illumination", views, str(tmp_path))
+    baseline = psutil.Process(os.getpid()).memory_info().rss
+    profile = RunProfile("memory test", sample_interval=0.01)
+    fusion = profile_run(profile, run_fusion, params)
+    for _ in fusion:
+        pass
+    peak = profile.to_dict()["peak_rss_bytes"] - baseline
+    input_bytes = sum(view.nbytes for view in views)
+    assert peak <= 16 * input_bytes
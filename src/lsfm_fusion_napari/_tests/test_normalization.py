@@ -0,0 +1,140 @@
+import numpy as np
+import pytest
+
+from lsfm_fusion_napari import _normalization
+from lsfm_fusion_napari._normalization import (
+    normalize_percentiles,
+    percentiles,
+)
+
+Q = [0.0, 0.37, 50.0, 95.0, 99.99, 100.0]
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.int16])
+def test_percentiles_histogram(dtype):
+    """
+    Test that the histogram path matches np.percentile for small integers
+    """
+    info = np.iinfo(dtype)
+    data = np.random.default_rng(0).integers(
+        info.min, info.max, (10, 20, 30), dtype=dtype, endpoint=True
+    )
+    np.testing.assert_allclose(percentiles(data, Q), np.percentile(data, Q))
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64, np.int32])
+def test_percentiles_partition(dtype):
+    """
+    Test that the partition path matches np.percentile
+    """
+    data = (np.random.default_rng(0).normal(size=(10, 20, 30)) * 100).astype(
+        dtype
+    )
+    np.testing.assert_allclose(
+        percentiles(data, Q), np.percentile(data, Q), rtol=1e-6
+    )
+
+
+def test_normalize_percentiles(monkeypatch):
+    """
+    Test that chunked normalization matches the full-volume computation
+    """
+    # force several chunks
+    monkeypatch.setattr(_normalization, "CHUNK_BYTES", 1000)
+    data = np.random.default_rng(0).integers(
+        0, 4000, (20, 30, 40), dtype=np.uint16
+    )
+    lower_v, upper_v = np.percentile(data, [1, 95])
+    expected = (np.clip(data, lower_v, upper_v) - lower_v) / (
+        upper_v - lower_v
+    )
+    output = normalize_percentiles(data, 1, 95)
+    assert output.dtype == np.float32
+    np.testing.assert_allclose(output, expected, atol=1e-6)
+
+
+def test_normalize_constant():
+    """
+    Test that constant images are mapped to 0
+    """
+    output = normalize_percentiles(np.full((4, 5), 7, dtype=np.uint16), 0, 95)
+    assert not output.any()
+
+
+def test_normalize_dask():
+    """
+    Test that dask data is normalized lazily and percentiles of the sketch
+    are within the tolerance
+    """
+    da = pytest.importorskip("dask.array")
+    data = np.random.default_rng(0).normal(size=(20, 30, 40))
+    lazy = da.from_array(data, chunks=(3, 30, 40))
+    tolerance = 1e-4
+    np.testing.assert_allclose(
+        percentiles(lazy, Q[1:-1], tolerance),
+        np.percentile(data, Q[1:-1]),
+        atol=tolerance * np.ptp(data),
+    )
+    output = normalize_percentiles(lazy, 1, 95, tolerance)
+    assert isinstance(output, da.Array)
+    assert output.dtype == np.float32
+    np.testing.assert_allclose(
+        output.compute(), normalize_percentiles(data, 1, 95), atol=1e-3
+    )
+
+
+def test_normalize_memmap(tmp_path):
+    """
+    Test that memory-mapped data is normalized into a memory map on disk
+    """
+    data = np.random.default_rng(0).integers(
+        0, 4000, (20, 30, 40), dtype=np.uint16
+    )
+    np.save(tmp_path / "data.npy", data)
+    mapped = np.load(tmp_path / "data.npy", mmap_mode="r")
+    output = normalize_percentiles(mapped, 1, 95, directory=str(tmp_path))
+    assert isinstance(output, np.memmap)
+    assert output.filename.startswith(str(tmp_path))
+    np.testing.assert_array_equal(output, normalize_percentiles(data, 1, 95))
+
+
+@pytest.mark.parametrize("dtype", ["float16", "uint16"])
+def test_normalize_output_dtype(dtype):
+    """
+    Test conversion of the normalized data to smaller types
+    """
+    data = np.random.default_rng(0).normal(size=(20, 30, 40))
+    expected = normalize_percentiles(data, 1, 95)
+    output = normalize_percentiles(data, 1, 95, dtype=dtype)
+    assert output.dtype == dtype
+    if dtype == "uint16":
+        np.testing.assert_allclose(output / 65535, expected, atol=1e-5)
+    else:
+        np.testing.assert_allclose(output, expected, atol=1e-3)
+
+
+def test_normalize_in_place():
+    """
+    Test that in-place normalization reuses the input buffer
+    """
+    data = np.random.default_rng(0).normal(size=(20, 30, 40))
+    data = data.astype(np.float32)
+    expected = normalize_percentiles(data, 1, 95)
+    output = normalize_percentiles(data, 1, 95, in_place=True)
+    assert output is data
+    np.testing.assert_array_equal(output, expected)
+
+
+def test_normalize_multiscale():
+    """
+    Test that all levels are normalized with the first level's percentiles
+    """
+    data = np.random.default_rng(0).normal(size=(20, 30, 40))
+    levels = [data, data[::2, ::2, ::2] + 1]
+    output = normalize_percentiles(levels, 1, 95)
+    assert len(output) == 2
+    np.testing.assert_array_equal(
+        output[0], normalize_percentiles(data, 1, 95)
+    )
+    # the offset of the second level survives normalization
+    assert output[1].mean() > output[0][::2, ::2, ::2].mean()
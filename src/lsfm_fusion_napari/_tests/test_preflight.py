@@ -0,0 +1,103 @@
+import dask.array as da
+import numpy as np
+
+from lsfm_fusion_napari._preflight import (
+    Estimate,
+    estimate,
+    fits,
+    format_bytes,
+    largest_slab_size,
+)
+
+SHAPE = (600, 32, 32)
+
+
+def make_params(**kwargs):
+    # the estimate only needs shapes and dtypes
+    image = np.broadcast_to(np.uint16(0), SHAPE)
+    return {
+        "method": "illumination",
+        "amount": 2,
+        "image1": image,
+        "image2": image,
+        "resample_ratio": 2,
+        "window_size": (59, 5),
+        "GF_kernel_size": 49,
+        "require_segmentation": False,
+        "require_registration": False,
+        "keep_intermediates": False,
+        **kwargs,
+    }
+
+
+def test_estimate(tmp_path):
+    """
+    Test that the estimate grows with the options that add volumes
+    """
+    base = estimate(make_params())
+    float_volume = 4 * int(np.prod(SHAPE))
+    assert base.memory >= 3 * float_volume
+    # the intermediates of FUSE and the result of its process
+    assert base.disk == 4 * float_volume
+    assert estimate(make_params(require_segmentation=True)).memory > (
+        base.memory
+    )
+    assert estimate(make_params(resample_ratio=1)).memory > base.memory
+    # in-memory inputs are copied into the FUSE process, mapped ones not
+    mapped = np.memmap(tmp_path / "image", np.uint16, mode="w+", shape=SHAPE)
+    assert estimate(make_params(image1=mapped)).memory == (
+        base.memory - mapped.nbytes
+    )
+    assert estimate(make_params(image1=mapped.astype(np.float32))).memory > (
+        base.memory
+    )
+
+
+def test_estimate_tiled():
+    """
+    Test that tiled fusion needs memory per slab and worker only
+    """
+    params = make_params()
+    monolithic = estimate(params)
+    tiled = estimate(params, (20, 10, 1))
+    assert tiled.memory < monolithic.memory / 3
+    assert estimate(params, (20, 10, 2)).memory == 2 * tiled.memory
+
+
+def test_estimate_stacked():
+    """
+    Test that time-lapse fusion adds its output, the weights and the
+    frames weighed in parallel to the fusion of one frame
+    """
+    stack = np.broadcast_to(np.uint16(0), (5, *SHAPE))
+    params = make_params(image1=stack, image2=stack, tmp_path="/tmp/a")
+    frame = estimate(make_params())
+    float_volume = 4 * int(np.prod(SHAPE))
+    stacked = estimate(params, stacked=2)
+    # the weights of both views and the five fused frames on disk
+    assert stacked.disk == frame.disk + (2 + 5) * float_volume
+    assert stacked.memory == frame.memory
+    lazy = da.zeros((5, *SHAPE), dtype=np.uint16)
+    params = make_params(image1=lazy, image2=lazy, tmp_path="/tmp/a")
+    # two frames of both views are read at once
+    assert estimate(params, stacked=2).memory >= 4 * lazy[0].nbytes
+
+
+def test_largest_slab_size():
+    """
+    Test that the largest slab size fits and the next one does not
+    """
+    params = make_params()
+    available = Estimate(estimate(params, (100, None, 1)).memory, 2**40)
+    slab_size = largest_slab_size(params, available)
+    assert fits(estimate(params, (slab_size, None, 1)), available)
+    assert not fits(estimate(params, (slab_size + 1, None, 1)), available)
+    assert largest_slab_size(params, Estimate(0, 2**40)) is None
+
+
+def test_format_bytes():
+    """
+    Test the units of sizes shown in the widget
+    """
+    assert format_bytes(512) == "512.0 B"
+    assert format_bytes(3 * 1024**3) == "3.0 GB"
@@ -0,0 +1,77 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pytest
+
+from lsfm_fusion_napari._profiling import RunProfile, profile_run
+
+
+def test_profile_run(tmp_path):
+    """
+    Test that every yielded stage is recorded with time and memory
+    """
+
+    def run_fusion(size):
+        yield 0, 2, "Preparing inputs"
+        time.sleep(0.05)
+        yield 1, 2, "Fusing"
+        image = np.ones(size, dtype=np.uint8)
+        yield 2, 2, "Finished"
+        return image
+
+    profile = RunProfile("test")
+    fusion = profile_run(profile, run_fusion, size=64 * 1024**2)
+    progress = []
+    try:
+        while True:
+            progress.append(next(fusion))
+    except StopIteration as stop:
+        assert stop.value.shape == (64 * 1024**2,)
+    assert len(progress) == 3
+    stages = profile.stages
+    assert [stage["stage"] for stage in stages] == [
+        "Preparing inputs",
+        "Fusing",
+        "Finished",
+    ]
+    assert stages[0]["wall_time_s"] >= 0.05
+    assert stages[1]["peak_rss_bytes"] >= 64 * 1024**2
+
+    with profile.stage("Adding layer"):
+        pass
+    path = profile.save(tmp_path / "profiles" / "test.json")
+    with open(path) as f:
+        record = json.load(f)
+    assert record["label"] == "test"
+    assert len(record["stages"]) == 4
+    assert record["wall_time_s"] >= 0.05
+    assert "Adding layer" in profile.summary()
+
+
+@pytest.mark.parametrize("wait", [True, False])
+def test_cpu_time_of_children(wait):
+    """
+    Test that the CPU time of child processes is recorded, whether they
+    ended or still run at the end of the stage
+    """
+    pytest.importorskip("psutil")
+    if wait and os.name != "posix":
+        pytest.skip("Only POSIX reports the CPU time of ended children")
+    busy = "import time\nend = time.process_time() + 0.5\n"
+    busy += "while time.process_time() < end: pass\n"
+    if not wait:
+        busy += "time.sleep(60)\n"
+    profile = RunProfile("test")
+    with profile.stage("Fusing"):
+        child = subprocess.Popen([sys.executable, "-c", busy])
+        if wait:
+            child.wait()
+        else:
+            time.sleep(2)
+    child.kill()
+    child.wait()
+    assert profile.stages[0]["cpu_time_s"] >= 0.4
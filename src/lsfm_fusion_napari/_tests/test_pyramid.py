@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from lsfm_fusion_napari import _normalization
+from lsfm_fusion_napari._pyramid import build_pyramid, run_with_pyramid
+from lsfm_fusion_napari._writer import downsample
+
+from .conftest import consume
+
+
+@pytest.fixture
+def image():
+    rng = np.random.default_rng(0)
+    return rng.random((21, 40, 35), dtype=np.float32)
+
+
+def test_build_pyramid_levels(image, monkeypatch):
+    """
+    Test that block-wise levels equal downsampling the whole volume
+    """
+    # a few planes per block
+    monkeypatch.setattr(_normalization, "CHUNK_BYTES", 4 * 40 * 35 * 4)
+    _, (levels, limits) = consume(build_pyramid(image, levels=3))
+    assert levels[0] is image
+    assert [level.shape for level in levels] == [
+        (21, 40, 35),
+        (11, 20, 18),
+        (6, 10, 9),
+    ]
+    expected = downsample(image, (2, 2, 2))
+    np.testing.assert_allclose(levels[1], expected, rtol=1e-6)
+    np.testing.assert_allclose(
+        levels[2], downsample(expected, (2, 2, 2)), rtol=1e-6
+    )
+    assert limits == (float(image.min()), float(image.max()))
+
+
+def test_build_pyramid_single_level(image, monkeypatch):
+    """
+    Test that small images keep one level and still get contrast limits
+    """
+    monkeypatch.setattr(_normalization, "CHUNK_BYTES", 1024)
+    _, (levels, limits) = consume(build_pyramid(image))
+    assert len(levels) == 1
+    assert limits == (float(image.min()), float(image.max()))
+
+
+def test_build_pyramid_constant():
+    """
+    Test that constant images get a non-empty contrast range
+    """
+    _, (_, limits) = consume(build_pyramid(np.zeros((4, 8, 8), np.uint16)))
+    assert limits == (0, 1)
+
+
+def test_run_with_pyramid(image):
+    """
+    Test that the progress of the run is followed by that of the pyramid
+    """
+
+    def run(data):
+        yield 1, 1, "Fusing"
+        return data
+
+    fusion = run_with_pyramid(run, image)
+    progress = []
+    try:
+        while True:
+            progress.append(next(fusion))
+    except StopIteration as stop:
+        levels, _ = stop.value
+    assert progress[0] == (1, 1, "Fusing")
+    assert len(progress) == 2
+    assert levels[0] is image
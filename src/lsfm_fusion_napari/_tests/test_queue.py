@@ -0,0 +1,67 @@
+import pytest
+
+from lsfm_fusion_napari._queue import (
+    CANCELLED,
+    DONE,
+    FAILED,
+    QUEUED,
+    RUNNING,
+    JobQueue,
+)
+
+
+def test_next_job_respects_limit():
+    """
+    Test that jobs are handed out in order while fewer than limit run
+    """
+    queue = JobQueue(limit=2)
+    jobs = [queue.add(f"sample {index}", {}) for index in range(3)]
+    started = []
+    while (job := queue.next_job()) is not None:
+        queue.start(job)
+        started.append(job)
+    assert started == jobs[:2]
+    assert jobs[2].status == QUEUED
+
+    queue.finish(jobs[0])
+    assert jobs[0].status == DONE
+    assert queue.next_job() is jobs[2]
+
+
+def test_invalid_transitions():
+    """
+    Test that jobs can't be started twice or finished as running
+    """
+    queue = JobQueue()
+    job = queue.add("sample", {})
+    queue.start(job)
+    with pytest.raises(ValueError):
+        queue.start(job)
+    with pytest.raises(ValueError):
+        queue.finish(job, RUNNING)
+    with pytest.raises(ValueError):
+        queue.remove(job)
+    with pytest.raises(ValueError):
+        queue.limit = 0
+
+
+def test_clear_finished():
+    """
+    Test that only jobs that won't change anymore are cleared
+    """
+    queue = JobQueue()
+    done, failed, cancelled, running, queued = (
+        queue.add(label, {})
+        for label in ("done", "failed", "cancelled", "running", "queued")
+    )
+    for job, status in (
+        (done, DONE),
+        (failed, FAILED),
+        (cancelled, CANCELLED),
+    ):
+        queue.start(job)
+        queue.finish(job, status, "message")
+    queue.start(running)
+    queue.clear_finished()
+    assert queue.jobs == [running, queued]
+    assert failed.describe().endswith(": failed - message")
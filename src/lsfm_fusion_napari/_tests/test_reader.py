@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+import tifffile
+
+from lsfm_fusion_napari._reader import napari_get_reader
+from lsfm_fusion_napari._writer import write_tiff, write_zarr
+
+
+def test_get_reader_unsupported():
+    """
+    Test that the reader declines files it can't read
+    """
+    assert napari_get_reader("image.png") is None
+    assert napari_get_reader(["image.tiff", "image.png"]) is None
+
+
+def test_read_tiff_memmap(tmp_path):
+    """
+    Test that uncompressed TIFF files are memory-mapped
+    """
+    data = np.arange(3 * 16 * 24, dtype=np.uint16).reshape(3, 16, 24)
+    path = str(tmp_path / "image.tiff")
+    write_tiff(path, data)
+    reader = napari_get_reader(path)
+    [(layer_data, add_kwargs, layer_type)] = reader(path)
+    assert isinstance(layer_data, np.memmap)
+    assert add_kwargs["name"] == "image"
+    assert layer_type == "image"
+    np.testing.assert_array_equal(layer_data, data)
+
+
+def test_read_tiff_compressed_scale(tmp_path):
+    """
+    Test that compressed TIFF files are read lazily with their voxel size
+    """
+    da = pytest.importorskip("dask.array")
+    data = np.arange(3 * 16 * 24, dtype=np.uint16).reshape(3, 16, 24)
+    path = str(tmp_path / "image.ome.tiff")
+    tifffile.imwrite(
+        path,
+        data,
+        ome=True,
+        compression="zlib",
+        metadata={
+            "axes": "ZYX",
+            "PhysicalSizeZ": 2.5,
+            "PhysicalSizeY": 0.5,
+            "PhysicalSizeX": 0.5,
+        },
+    )
+    [(layer_data, add_kwargs, _)] = napari_get_reader(path)(path)
+    assert isinstance(layer_data, da.Array)
+    assert add_kwargs["name"] == "image"
+    assert add_kwargs["scale"] == [2.5, 0.5, 0.5]
+    np.testing.assert_array_equal(layer_data.compute(), data)
+
+
+def test_read_zarr_multiscale(tmp_path):
+    """
+    Test that OME-Zarr stores are read as multiscale layers
+    """
+    data = np.random.default_rng(0).random((4, 40, 30), dtype=np.float32)
+    path = str(tmp_path / "image.zarr")
+    write_zarr(path, data, chunks=(2, 16, 16), levels=2)
+    [(layer_data, add_kwargs, _)] = napari_get_reader(path)(path)
+    assert add_kwargs["multiscale"]
+    assert [level.shape for level in layer_data] == [
+        (4, 40, 30),
+        (2, 20, 15),
+    ]
+    np.testing.assert_array_equal(layer_data[0].compute(), data)
+
+
+@pytest.mark.parametrize("extension", [".ome.tiff", ".zarr"])
+def test_written_scale_is_read(tmp_path, extension):
+    """
+    Test that the voxel size of a written layer is read back
+    """
+    data = np.zeros((4, 40, 30), dtype=np.uint16)
+    path = str(tmp_path / f"image{extension}")
+    if extension == ".zarr":
+        write_zarr(path, data, {"scale": [2.5, 0.5, 0.5]}, levels=2)
+    else:
+        write_tiff(path, data, {"scale": [2.5, 0.5, 0.5]})
+    [(_, add_kwargs, _)] = napari_get_reader(path)(path)
+    assert add_kwargs["scale"] == [2.5, 0.5, 0.5]
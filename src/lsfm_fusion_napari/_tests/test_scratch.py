@@ -0,0 +1,118 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from lsfm_fusion_napari._scratch import MANIFEST, ScratchStore, read_manifest
+
+
+def test_new_run_manifest(tmp_path):
+    """
+    Test that runs get their own directory with a manifest
+    """
+    store = ScratchStore(tmp_path)
+    path = store.new_run("preview", {"GF_kernel_size": 49, "image1": b""})
+    manifest = read_manifest(path)
+    assert path.parent == tmp_path / "runs"
+    assert manifest["status"] == "running"
+    assert manifest["label"] == "preview"
+    assert manifest["parameters"]["GF_kernel_size"] == 49
+
+    (path / "result.npy").write_bytes(b"0")
+    store.finish(path)
+    assert read_manifest(path)["status"] == "finished"
+    # runs that wrote nothing are not kept
+    empty = store.new_run()
+    store.finish(empty)
+    assert not empty.exists()
+
+
+def test_run_discarded_on_error(tmp_path):
+    """
+    Test that failing runs are deleted
+    """
+    store = ScratchStore(tmp_path)
+    with pytest.raises(RuntimeError), store.run() as path:
+        (path / "intermediate.npy").write_bytes(b"0")
+        raise RuntimeError
+    assert not path.exists()
+    assert store.runs() == []
+
+
+def test_evict_oldest_finished(tmp_path):
+    """
+    Test that the oldest finished runs are evicted first
+    """
+    store = ScratchStore(tmp_path, max_bytes=2500)
+    paths = []
+    for _ in range(3):
+        with store.run() as path:
+            (path / "intermediate.npy").write_bytes(bytes(1000))
+        paths.append(path)
+    running = store.new_run()
+    assert not paths[0].exists()
+    assert paths[1].exists() and paths[2].exists()
+    assert running.exists()
+
+
+def test_remove_stale(tmp_path):
+    """
+    Test that runs left behind by dead processes are deleted
+    """
+    store = ScratchStore(tmp_path)
+    path = store.new_run()
+    manifest = read_manifest(path)
+    manifest["pid"] = 2**22 + 1
+    (path / MANIFEST).write_text(json.dumps(manifest))
+    store.new_run()
+    assert not path.exists()
+
+
+def test_cache_shares_budget(tmp_path):
+    """
+    Test that cached results count against the scratch budget and are
+    evicted once the runs need the space
+    """
+    store = ScratchStore(tmp_path, max_bytes=2500)
+    with store.run() as path:
+        (path / "intermediate.npy").write_bytes(bytes(1000))
+    cache = store.cache()
+    assert cache.max_bytes <= 1500
+    cache.put("a", np.zeros(1000, dtype=np.uint8))
+    running = store.new_run()
+    (running / "intermediate.npy").write_bytes(bytes(2000))
+    store.evict()
+    assert not path.exists()
+    assert "a" not in cache
+    assert running.exists()
+
+
+def test_pinned_runs_are_kept(tmp_path):
+    """
+    Test that pinned runs and cached results are not evicted until unpinned
+    and that pins of ended processes are ignored
+    """
+    store = ScratchStore(tmp_path, max_bytes=0)
+    with store.run() as path:
+        (path / "fused.npy").write_bytes(bytes(1000))
+    cache = store.cache()
+    cache.put("a", np.zeros(1000, dtype=np.uint8))
+    assert store.pin(path / "fused.npy") == path.resolve()
+    store.pin(path / "fused.npy")
+    store.pin(tmp_path / "cache" / "a.npy")
+    assert store.pin(tmp_path / "elsewhere.npy") is None
+    store.evict()
+    assert path.exists()
+    assert "a" in cache
+    store.unpin(path / "fused.npy")
+    store.evict()
+    assert path.exists()
+    store.unpin(path / "fused.npy")
+    store.evict()
+    assert not path.exists()
+    assert "a" in cache
+    pins = tmp_path / "pins"
+    os.replace(pins / f"{os.getpid()}.json", pins / f"{2**22 + 1}.json")
+    store.evict()
+    assert "a" not in cache
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from lsfm_fusion_napari._sweep import (
+    parse_values,
+    run_sweep,
+    sweep_combinations,
+)
+
+
+@pytest.fixture
+def params(tmp_path):
+    image = np.arange(6 * 8 * 8, dtype=np.float32).reshape(6, 8, 8)
+    yield {
+        "method": "illumination",
+        "amount": 2,
+        "image1": image,
+        "direction1": "Top",
+        "image2": image + 1,
+        "direction2": "Bottom",
+        "resample_ratio": 2,
+        "window_size": (59, 5),
+        "GF_kernel_size": 49,
+        "tmp_path": str(tmp_path),
+    }
+
+
+def test_parse_values():
+    """
+    Test that empty lists fall back to the current value
+    """
+    assert parse_values("39, 59,79, 59", 49) == [39, 59, 79]
+    assert parse_values("  ", 49) == [49]
+    with pytest.raises(ValueError):
+        parse_values("39, a", 49)
+
+
+def test_sweep_combinations(params):
+    """
+    Test that every combination is generated and validated
+    """
+    combinations = sweep_combinations(params, [39, 59], [5], [29, 49, 69])
+    assert len(combinations) == 6
+    assert combinations[0] == {"window_size": (39, 5), "GF_kernel_size": 29}
+    with pytest.raises(ValueError):
+        sweep_combinations(params, [59], [5], [49, 99])
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_run_sweep(params, fake_fuse, workers):
+    """
+    Test that the fused crops are stacked in the order of the combinations
+    """
+    combinations = sweep_combinations(params, [39, 59], [5], [29, 49])
+    sweep = run_sweep(
+        {**params, "scaled": True}, combinations, (1, 5), 2, workers
+    )
+    progress = []
+    try:
+        while True:
+            progress.append(next(sweep))
+    except StopIteration as stop:
+        stack = stop.value
+    assert progress[-1][:2] == (4, 4)
+    assert stack.shape == (4, 4, 4, 4)
+    mean = params["image1"][1:5, ::2, ::2] + 0.5
+    for index, combination in enumerate(combinations):
+        expected = (
+            mean * combination["GF_kernel_size"]
+            + combination["window_size"][0]
+        )
+        np.testing.assert_allclose(stack[index], expected)
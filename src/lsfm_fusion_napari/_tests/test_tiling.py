@@ -0,0 +1,133 @@
+import os
+
+import numpy as np
+import pytest
+from scipy.ndimage import uniform_filter1d
+
+from lsfm_fusion_napari._tiling import (
+    default_overlap,
+    default_slab_size,
+    iter_tiled,
+    run_tiled_fusion,
+    slab_bounds,
+    slab_weights,
+    validate_tiling,
+)
+
+from .synthetic import fusion_parameters
+
+PARAMS = {"window_size": (59, 5), "GF_kernel_size": 49}
+
+
+def smoothed(slabs):
+    # stand-in for a fusion with a filter of radius 4 along Z
+    mean = (slabs["image1"] + slabs["image2"]) / 2
+    return uniform_filter1d(mean, 9, axis=0, mode="nearest")
+
+
+def smooth_mean(slabs, index):
+    # yields while it works like _tiling.fuse_slab
+    yield 0, 1, "Fusing"
+    return smoothed(slabs)
+
+
+@pytest.mark.parametrize(
+    "length, slab_size, overlap", [(100, 30, 10), (97, 64, 7), (5, 64, 10)]
+)
+def test_slab_weights_sum_to_one(length, slab_size, overlap):
+    """
+    Test that the blending weights of all slabs add up to one per plane
+    """
+    total = np.zeros(length)
+    for bounds in slab_bounds(length, slab_size):
+        read_start, read_stop, weights = slab_weights(bounds, length, overlap)
+        total[read_start:read_stop] += weights
+    np.testing.assert_allclose(total, 1)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_iter_tiled_matches_monolithic(workers):
+    """
+    Test that slab-wise fusion matches fusing the whole volume when the
+    overlap covers the filter
+    """
+    rng = np.random.default_rng(0)
+    images = {
+        "image1": rng.random((100, 8, 9)),
+        "image2": rng.random((100, 8, 9)),
+    }
+    out = np.zeros((100, 8, 9), dtype=np.float32)
+    progress = list(iter_tiled(images, smooth_mean, out, 30, 10, workers))
+    assert progress[-1] == (4, 4)
+    np.testing.assert_allclose(out, smoothed(images), atol=1e-6)
+
+
+def test_validate_tiling():
+    """
+    Test that incompatible tiling parameters are rejected
+    """
+    validate_tiling(PARAMS, 64, None)
+    with pytest.raises(ValueError):
+        validate_tiling(PARAMS, 32, None)
+    with pytest.raises(ValueError):
+        validate_tiling({**PARAMS, "require_registration": True}, 64, 10)
+    with pytest.raises(ValueError):
+        validate_tiling({**PARAMS, "method": "detection"}, 64, 10)
+
+
+def test_default_slab_geometry():
+    """
+    Test that the overlap covers the filter across Z and the default slabs
+    are valid for every GF kernel size
+    """
+    assert default_overlap(PARAMS) == 49
+    for kernel_size in (29, 49, 89):
+        params = {**PARAMS, "GF_kernel_size": kernel_size}
+        slab_size = default_slab_size(params)
+        assert slab_size >= 2 * kernel_size + 1
+        validate_tiling(params, None, None)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_run_tiled_fusion(fake_fuse, tmp_path, workers):
+    """
+    Test that slabs are fused by FUSE processes and their directories are
+    removed once blended
+    """
+    rng = np.random.default_rng(0)
+    images = [rng.random((40, 8, 9)), rng.random((40, 8, 9))]
+    params = fusion_parameters("illumination", images, str(tmp_path))
+    fusion = run_tiled_fusion(params, 16, 4, workers)
+    try:
+        while True:
+            next(fusion)
+    except StopIteration as stop:
+        fused = stop.value
+    np.testing.assert_allclose(fused, (images[0] + images[1]) / 2, atol=1e-6)
+    assert not [name for name in os.listdir(tmp_path) if "slab" in name]
+
+
+def test_close_tiled_fusion(fake_fuse, tmp_path):
+    """
+    Test that closing a tiled fusion terminates the FUSE processes of all
+    slabs being fused
+    """
+    psutil = pytest.importorskip("psutil")
+
+    def fusing():
+        # spawned FUSE processes, not the resource tracker
+        return [
+            child
+            for child in psutil.Process().children()
+            if "spawn_main" in " ".join(child.cmdline())
+        ]
+
+    images = [np.zeros((40, 8, 9)), np.zeros((40, 8, 9))]
+    params = fusion_parameters("illumination", images, str(tmp_path))
+    path = tmp_path / "pid"
+    fusion = run_tiled_fusion({**params, "hang": str(path)}, 16, 4, 2)
+    while not (path.exists() and path.read_text()):
+        next(fusion)
+    assert fusing()
+    fusion.close()
+    assert not fusing()
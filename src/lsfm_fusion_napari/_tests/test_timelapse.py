@@ -0,0 +1,133 @@
+import time
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from lsfm_fusion_napari import _weights
+from lsfm_fusion_napari._timelapse import (
+    frame_count,
+    frame_parameters,
+    keyframes,
+    run_timelapse,
+)
+
+from .conftest import consume
+from .synthetic import dual_illumination
+
+SHAPE = (3, 32, 32)
+N_FRAMES = 5
+
+
+def blend(params):
+    # what the fake FUSE computes with "blend", see conftest
+    y = np.linspace(-4, 4, params["image1"].shape[1])
+    weight = (1 / (1 + np.exp(2 * y)))[None, :, None]
+    return weight * params["image1"] + (1 - weight) * params["image2"]
+
+
+def fuse_runs(params):
+    # directories of the timepoints FUSE ran on
+    with open(params["log"]) as f:
+        return f.read().splitlines()
+
+
+@pytest.fixture
+def params(tmp_path, fake_fuse):
+    (tmp_path / "log").touch()
+    views = [dual_illumination(SHAPE, seed) for seed in range(N_FRAMES)]
+    yield {
+        "method": "illumination",
+        "amount": 2,
+        "image1": np.stack([view[0] for view in views]),
+        "direction1": "Top",
+        "image2": np.stack([view[1] for view in views]),
+        "direction2": "Bottom",
+        "require_registration": False,
+        "tmp_path": str(tmp_path / "scratch"),
+        "blend": True,
+        "log": str(tmp_path / "log"),
+    }
+
+
+def test_keyframes():
+    """
+    Test that keyframes are spaced by the interval, or only the first
+    """
+    assert keyframes(5) == [0]
+    assert keyframes(5, 2) == [0, 2, 4]
+    with pytest.raises(ValueError):
+        keyframes(5, -1)
+
+
+def test_frame_parameters(params):
+    """
+    Test that every timepoint gets its volumes and its own directory
+    """
+    assert frame_count(params) == N_FRAMES
+    framed = frame_parameters(params, 3)
+    np.testing.assert_array_equal(framed["image2"], params["image2"][3])
+    assert framed["tmp_path"].endswith("t0003")
+    with pytest.raises(ValueError):
+        frame_count({**params, "image2": params["image2"][:2]})
+    with pytest.raises(ValueError):
+        frame_count({**params, "image1": params["image1"][0]})
+
+
+@pytest.mark.parametrize("every, fused", [(0, 1), (2, 3)])
+def test_run_timelapse_reuses_keyframes(params, every, fused):
+    """
+    Test that only keyframes are fused and the other frames match them
+    """
+    progress, out = consume(run_timelapse(params, every, workers=2))
+    assert out.shape == (N_FRAMES, *SHAPE)
+    assert len(fuse_runs(params)) == fused
+    assert progress[-1][:2] == (N_FRAMES, N_FRAMES)
+    for frame in range(N_FRAMES):
+        expected = blend(frame_parameters(params, frame))
+        error = np.abs(out[frame] - expected).mean()
+        assert error < 0.02 * expected.mean()
+
+
+def test_run_timelapse_refuses_registration(params):
+    """
+    Test that registered views are refused instead of fusing every frame
+    """
+    with pytest.raises(ValueError, match="registered"):
+        consume(run_timelapse({**params, "require_registration": True}))
+    assert fuse_runs(params) == []
+
+
+def test_close_timelapse(params, tmp_path):
+    """
+    Test that closing a time-lapse fusion terminates FUSE on the keyframe
+    """
+    psutil = pytest.importorskip("psutil")
+    path = tmp_path / "pid"
+    fusion = run_timelapse({**params, "hang": str(path)}, workers=2)
+    while not (path.exists() and path.read_text()):
+        next(fusion)
+    pid = int(path.read_text())
+    start = time.perf_counter()
+    fusion.close()
+    assert time.perf_counter() - start < 10
+    assert not psutil.pid_exists(pid)
+
+
+def test_close_timelapse_while_fitting(params, monkeypatch):
+    """
+    Test that closing a time-lapse fusion stops fitting the keyframe
+    weights between blocks of voxels
+    """
+    # one row of a plane per block
+    monkeypatch.setattr(_weights, "SOLVE_VOXELS", SHAPE[2])
+    path = Path(params["tmp_path"]) / "weights_0000.npy"
+    fusion = run_timelapse(params)
+    while not path.exists():
+        next(fusion)
+    next(fusion)
+    fusion.close()
+    weights = np.load(path)
+    # the first rows are fitted, the last plane is never reached
+    np.testing.assert_allclose(weights[:, 0, 0].sum(axis=0), 1, rtol=1e-5)
+    assert not weights[:, -1].any()
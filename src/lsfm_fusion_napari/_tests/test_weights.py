@@ -0,0 +1,233 @@
+import numpy as np
+import pytest
+
+from lsfm_fusion_napari import _weights
+from lsfm_fusion_napari._weights import (
+    apply_weights,
+    check_metadata,
+    fit_weights,
+    iter_fit_weights,
+    load_weights,
+    read_metadata,
+    residual,
+    reusable,
+    run_and_save_weights,
+    run_apply_weights,
+    save_weights,
+)
+
+from .conftest import consume
+from .synthetic import dual_illumination
+
+SHAPE = (4, 64, 48)
+
+
+def top_weight(shape):
+    # smooth transition from the first to the second view along Y
+    y = np.linspace(-4, 4, shape[1])
+    weight = 1 / (1 + np.exp(2 * y))
+    return np.broadcast_to(weight[None, :, None], shape).astype(np.float32)
+
+
+def test_fit_weights_recovers_blend():
+    """
+    Test that the weights of a known blend are recovered and reused
+    """
+    first, second = dual_illumination(SHAPE)
+    weight = top_weight(SHAPE)
+    fused = weight * first + (1 - weight) * second
+    weights = fit_weights([first, second], fused)
+    assert weights.shape == (2, *SHAPE)
+    np.testing.assert_allclose(weights.sum(axis=0), 1, atol=1e-5)
+    assert weights.min() >= 0
+    assert np.abs(weights[0] - weight).mean() < 0.05
+    assert residual(weights, [first, second], fused) < 0.02
+
+    # another sample blended the same way
+    first, second = dual_illumination(SHAPE, seed=1)
+    expected = weight * first + (1 - weight) * second
+    out = np.zeros(SHAPE, np.float32)
+    assert apply_weights(weights, [first, second], out) is out
+    assert np.abs(out - expected).mean() < 0.02 * expected.mean()
+
+
+def test_fit_weights_four_views():
+    """
+    Test that weights of more than two views add up to one
+    """
+    views = [*dual_illumination(SHAPE), *dual_illumination(SHAPE, seed=1)]
+    fused = sum(
+        share * view.astype(np.float32)
+        for share, view in zip((0.4, 0.3, 0.2, 0.1), views)
+    )
+    weights = fit_weights(views, fused)
+    np.testing.assert_allclose(weights.sum(axis=0), 1, atol=1e-5)
+    assert residual(weights, views, fused) < 0.02
+
+
+def test_fit_weights_in_chunks(tmp_path, monkeypatch):
+    """
+    Test that solving a few rows at a time into a memory map gives the
+    weights of solving whole planes
+    """
+    first, second = dual_illumination(SHAPE)
+    weight = top_weight(SHAPE)
+    fused = weight * first + (1 - weight) * second
+    expected = fit_weights([first, second], fused)
+    monkeypatch.setattr(_weights, "SOLVE_VOXELS", 5 * SHAPE[2])
+    path = tmp_path / "weights.npy"
+    out = np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.float32, shape=(2, *SHAPE)
+    )
+    assert fit_weights([first, second], fused, out=out) is out
+    np.testing.assert_allclose(out, expected, atol=1e-6)
+
+
+def test_invalid_views():
+    """
+    Test that views must match each other and the weights
+    """
+    first, second = dual_illumination(SHAPE)
+    with pytest.raises(ValueError):
+        fit_weights([first], first)
+    with pytest.raises(ValueError):
+        fit_weights([first, second[:2]], first)
+    weights = fit_weights([first, second], first)
+    with pytest.raises(ValueError):
+        apply_weights(weights, [first, second, first])
+    with pytest.raises(ValueError):
+        apply_weights(weights, [first[:2], second[:2]])
+
+
+def test_close_fit_weights(monkeypatch):
+    """
+    Test that closing a fit stops it between blocks of voxels
+    """
+    # one row of a plane per block
+    monkeypatch.setattr(_weights, "SOLVE_VOXELS", SHAPE[2])
+    first, second = dual_illumination(SHAPE)
+    out = np.full((2, *SHAPE), np.nan, dtype=np.float32)
+    fitting = iter_fit_weights([first, second], first, out)
+    assert [next(fitting) for _ in range(3)][-1][:2] == (0, SHAPE[0])
+    fitting.close()
+    assert not np.isnan(out[:, 0, :3]).any()
+    assert np.isnan(out[:, 0, 3:]).all() and np.isnan(out[:, 1:]).all()
+
+
+def test_reusable():
+    """
+    Test that weights of registered or flipped views aren't reused
+    """
+    assert reusable({"require_registration": False})
+    assert not reusable({"require_registration": True})
+    assert not reusable({"require_flip_det": True})
+    assert not reusable({"require_flip_illu": True})
+
+
+def blend_parameters(first, second, tmp_path=""):
+    return {
+        "tmp_path": str(tmp_path),
+        "method": "illumination",
+        "amount": 2,
+        "image1": first,
+        "direction1": "Top",
+        "image2": second,
+        "direction2": "Bottom",
+        "require_registration": False,
+        "require_flip_illu": False,
+        "require_flip_det": False,
+    }
+
+
+def test_save_and_apply_weights(tmp_path):
+    """
+    Test that saved weights fuse a repeat acquisition like the original
+    """
+    weight = top_weight(SHAPE)
+
+    def run(params):
+        yield 0, 1, "Fusing"
+        return weight * params["image1"] + (1 - weight) * params["image2"]
+
+    path = str(tmp_path / "weights.npz")
+    params = blend_parameters(*dual_illumination(SHAPE), tmp_path / "fit")
+    _, fused = consume(run_and_save_weights(path, params, run, params))
+    assert not (tmp_path / "fit" / "weights.npy").exists()
+    weights, metadata = load_weights(path)
+    assert weights.dtype == np.float16
+    assert isinstance(weights, np.memmap) and weights.mode == "r"
+    with np.load(path) as f:
+        np.testing.assert_array_equal(weights, f["weights"])
+    assert metadata["directions"] == ["Top", "Bottom"]
+    assert metadata["shape"] == list(SHAPE)
+    assert read_metadata(path) == metadata
+    assert (
+        residual(weights, [params["image1"], params["image2"]], fused) < 0.02
+    )
+
+    repeat = blend_parameters(
+        *dual_illumination(SHAPE, seed=1), tmp_path / "apply"
+    )
+    _, output = consume(run_apply_weights(repeat, path))
+    _, expected = consume(run(repeat))
+    assert np.abs(output - expected).mean() < 0.02 * expected.mean()
+
+
+def test_close_run_and_save_weights(tmp_path, monkeypatch):
+    """
+    Test that closing a run while fitting its weights stops the fit and
+    removes the scratch weights
+    """
+    monkeypatch.setattr(_weights, "SOLVE_VOXELS", SHAPE[2])
+    first, second = dual_illumination(SHAPE)
+
+    def run(params):
+        yield 0, 1, "Fusing"
+        return first
+
+    path = tmp_path / "weights.npz"
+    params = blend_parameters(first, second, tmp_path / "fit")
+    saving = run_and_save_weights(str(path), params, run, params)
+    progress = [next(saving) for _ in range(3)]
+    assert progress[-1] == (0, SHAPE[0], "Fitting weights")
+    saving.close()
+    assert not (tmp_path / "fit" / "weights.npy").exists()
+    assert not path.exists()
+    with pytest.raises(ValueError):
+        next(
+            run_and_save_weights(
+                str(path), {**params, "require_flip_det": True}, run, params
+            )
+        )
+
+
+def test_check_metadata(tmp_path):
+    """
+    Test that weights only apply to images fused the same way
+    """
+    first, second = dual_illumination(SHAPE)
+    params = blend_parameters(first, second)
+    path = str(tmp_path / "weights.npz")
+    save_weights(path, fit_weights([first, second], first), params)
+    metadata = read_metadata(path)
+    check_metadata(metadata, params)
+    with pytest.raises(ValueError):
+        check_metadata(metadata, {**params, "direction1": "Bottom"})
+    with pytest.raises(ValueError):
+        check_metadata(metadata, {**params, "require_flip_illu": True})
+    with pytest.raises(ValueError):
+        check_metadata(
+            metadata, {**params, "image1": first[:2], "image2": second[:2]}
+        )
+    with pytest.raises(ValueError):
+        check_metadata(
+            metadata,
+            {**params, "method": "detection", "image3": second},
+        )
+    # registered views can't be blended voxel by voxel
+    with pytest.raises(ValueError):
+        save_weights(
+            path,
+            fit_weights([first, second], first),
+            {**params, "require_registration": True},
+        )
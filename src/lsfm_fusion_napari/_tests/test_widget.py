@@ -1,6 +1,13 @@
+from types import SimpleNamespace
+
+import numpy as np
 import pytest
+from napari.layers import Image
 
+from lsfm_fusion_napari._fusion import run_fusion
+from lsfm_fusion_napari._scratch import ScratchStore
 from lsfm_fusion_napari._widget import (
+    SCRATCH_ROOT,
     FusionWidget,
 )
 
@@ -9,6 +16,7 @@ from lsfm_fusion_napari._widget import (
 def create_widget(make_napari_viewer):
     yield FusionWidget(make_napari_viewer())
 
+
 def test_widget_creation(create_widget):
     """
     Test if the widget is created correctly
@@ -20,3 +28,150 @@ def test_widget_creation(create_widget):
         Instance of the main widget
     """
     assert isinstance(create_widget, FusionWidget)
+
+
+def test_widget_idle_state(create_widget):
+    """
+    Test that no fusion is running after the widget is created
+
+    Parameters
+    ----------
+    create_widget : FusionWidget
+        Instance of the main widget
+    """
+    assert create_widget.worker is None
+    assert create_widget.btn_process.isEnabled()
+    assert not create_widget.btn_cancel.isEnabled()
+    # cancelling without a running fusion is a no-op
+    create_widget._cancel_on_click()
+    assert create_widget.worker is None
+
+
+def test_registration_disables_reuse(create_widget):
+    """
+    Test that options reusing the weights of a fusion are disabled for
+    registered or flipped views
+    """
+    widget = create_widget
+    widget.timelapse_box.setChecked(True)
+    widget.checkbox_req_registration.setChecked(True)
+    assert not widget.timelapse_box.isEnabled()
+    assert not widget.timelapse_box.isChecked()
+    assert not widget.checkbox_save_weights.isEnabled()
+    widget.checkbox_req_registration.setChecked(False)
+    assert widget.channels_box.isEnabled()
+    widget.checkbox_req_flip_det.setChecked(True)
+    assert not widget.channels_box.isEnabled()
+
+
+def test_job_queue_idle(create_widget):
+    """
+    Test that the queue starts empty and pausing it stops new jobs
+
+    Parameters
+    ----------
+    create_widget : FusionWidget
+        Instance of the main widget
+    """
+    widget = create_widget
+    # without input nothing is queued
+    widget._enqueue_on_click()
+    assert widget.job_queue.jobs == []
+    widget._run_queue_on_click()
+    assert widget.queue_active
+    assert widget.btn_run_queue.text() == "Pause queue"
+    widget._run_queue_on_click()
+    assert not widget.queue_active
+    assert widget.job_workers == {}
+
+
+def test_cancel_terminates_fuse(create_widget, fake_fuse, tmp_path, qtbot):
+    """
+    Test that cancelling stops FUSE while it trains
+
+    Parameters
+    ----------
+    create_widget : FusionWidget
+        Instance of the main widget
+    """
+    psutil = pytest.importorskip("psutil")
+    widget = create_widget
+    image = np.zeros((4, 8, 8), dtype=np.uint16)
+    path = tmp_path / "pid"
+    params = {
+        "method": "illumination",
+        "amount": 2,
+        "image1": image,
+        "image2": image,
+        "tmp_path": str(tmp_path / "scratch"),
+        "hang": str(path),
+    }
+    assert widget._start_worker(run_fusion, (params,), print, cached=False)
+    qtbot.waitUntil(
+        lambda: path.exists() and bool(path.read_text()), timeout=30000
+    )
+    pid = int(path.read_text())
+    widget._cancel_on_click()
+    qtbot.waitUntil(lambda: widget.worker is None, timeout=10000)
+    assert not psutil.pid_exists(pid)
+    assert widget.label_progress.text() == "Fusion cancelled"
+
+
+def test_layers_pin_scratch_runs(create_widget, tmp_path):
+    """
+    Test that runs whose files back layers are kept until the layers are
+    removed
+
+    Parameters
+    ----------
+    create_widget : FusionWidget
+        Instance of the main widget
+    """
+    widget = create_widget
+    store = ScratchStore(tmp_path, max_bytes=0)
+    with store.run() as run:
+        np.save(run / "fused.npy", np.zeros((4, 8, 8), dtype=np.float32))
+    # drawing layers needs OpenGL, so the layer is not added to the viewer
+    layer = Image(
+        np.load(run / "fused.npy", mmap_mode="r"),
+        metadata={SCRATCH_ROOT: str(tmp_path)},
+    )
+    # the layer is pinned in the root it was written to, not the current one
+    widget.label_tmp_path.setText(str(tmp_path / "elsewhere"))
+    widget._pin_layer(layer)
+    store.evict()
+    assert run.exists()
+    widget._unpin_layer(layer)
+    store.evict()
+    assert not run.exists()
+
+
+def test_fusion_placed_on_inputs(create_widget):
+    """
+    Test that fused layers get the scale and translate of their inputs
+
+    Parameters
+    ----------
+    create_widget : FusionWidget
+        Instance of the main widget
+    """
+    widget = create_widget
+    # drawing layers needs OpenGL, so the viewer only records them
+    layer = Image(
+        np.zeros((8, 16, 16)), scale=(2, 0.5, 0.5), translate=(10, 0, 0)
+    )
+    added = []
+    widget.viewer = SimpleNamespace(
+        layers={"raw": layer},
+        add_image=lambda data, **kwargs: added.append(kwargs),
+    )
+    widget.label_illu1.setText("raw")
+    # fused at the second pyramid level
+    placement = widget._source_placement({"image1": np.zeros((8, 8, 8))})
+    np.testing.assert_allclose(placement[0], (2, 1, 1))
+    np.testing.assert_allclose(placement[1], (10, 0, 0))
+    widget._on_fusion_returned(
+        ([np.zeros((3, 8, 8, 8))], (0, 1)), placement=placement
+    )
+    np.testing.assert_allclose(added[0]["scale"], (1, 2, 1, 1))
+    np.testing.assert_allclose(added[0]["translate"], (0, 10, 0, 0))
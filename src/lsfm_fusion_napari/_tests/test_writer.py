@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+import tifffile
+
+from lsfm_fusion_napari._writer import (
+    downsample,
+    read_conversion,
+    write_tiff,
+    write_zarr,
+)
+
+
+@pytest.mark.parametrize(
+    "shape, axes",
+    [((16, 24), "YX"), ((3, 16, 24), "ZYX"), ((2, 3, 16, 24), "TZYX")],
+)
+def test_write_tiff(tmp_path, shape, axes):
+    """
+    Test that volumes are written as BigTIFF with the right dimension order
+    """
+    data = np.arange(np.prod(shape), dtype=np.uint16).reshape(shape)
+    path = str(tmp_path / "image.tiff")
+    assert write_tiff(path, data) == [path]
+    with tifffile.TiffFile(path) as tif:
+        assert tif.is_bigtiff
+        assert tif.is_ome
+        assert tif.series[0].axes == axes
+        np.testing.assert_array_equal(tif.asarray(), data)
+
+
+def test_write_tiff_invalid_ndim(tmp_path):
+    """
+    Test that data without a supported dimension order is rejected
+    """
+    with pytest.raises(ValueError):
+        write_tiff(str(tmp_path / "image.tiff"), np.zeros(5, np.uint16))
+
+
+def test_write_tiff_rescales_floats(tmp_path):
+    """
+    Test that float data is rescaled to the uint16 range and can be
+    recovered from the stored scale and offset
+    """
+    data = np.linspace(0, 1, 3 * 16 * 24, dtype=np.float32).reshape(3, 16, 24)
+    path = str(tmp_path / "image.tiff")
+    write_tiff(path, data)
+    stored = tifffile.imread(path)
+    assert stored.min() == 0
+    assert stored.max() == 65535
+    scale, offset = read_conversion(path)
+    np.testing.assert_allclose(stored / scale + offset, data, atol=1e-5)
+
+
+def test_write_tiff_keeps_fitting_integers(tmp_path):
+    """
+    Test that integer data within the uint16 range is stored unchanged
+    """
+    data = np.arange(3 * 16 * 24, dtype=np.int32).reshape(3, 16, 24) + 7
+    path = str(tmp_path / "image.tiff")
+    write_tiff(path, data)
+    np.testing.assert_array_equal(tifffile.imread(path), data)
+    assert read_conversion(path) == (1.0, 0.0)
+
+
+def test_write_zarr(tmp_path):
+    """
+    Test that OME-Zarr stores hold the full data and a halved pyramid level
+    """
+    zarr = pytest.importorskip("zarr")
+    data = np.random.default_rng(0).integers(
+        0, 4000, (5, 40, 30), dtype=np.uint16
+    )
+    path = str(tmp_path / "image.zarr")
+    assert write_zarr(path, data, chunks=(2, 16, 16), levels=2) == [path]
+    group = zarr.open_group(path, mode="r")
+    np.testing.assert_array_equal(group["0"][:], data)
+    assert group["1"].shape == (3, 20, 15)
+    assert group["1"][0, 0, 0] == np.rint(data[:2, :2, :2].mean())
+    multiscales = group.attrs["multiscales"][0]
+    assert [axis["name"] for axis in multiscales["axes"]] == ["z", "y", "x"]
+    assert [dataset["path"] for dataset in multiscales["datasets"]] == [
+        "0",
+        "1",
+    ]
+
+
+def test_downsample_odd_shape():
+    """
+    Test that odd axes are padded by repeating the last element
+    """
+    block = np.arange(9, dtype=np.float32).reshape(3, 3)
+    np.testing.assert_array_equal(
+        downsample(block, (2, 2)), [[2.0, 3.5], [6.5, 8.0]]
+    )
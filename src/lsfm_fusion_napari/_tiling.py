@@ -0,0 +1,367 @@
+"""
+Slab-wise fusion of volumes that don't fit into memory.
+
+The inputs are split along Z into slabs that overlap their neighbours.
+Every slab is fused on its own and blended into the output with linear
+weights across the overlaps, which add up to one everywhere. The output is
+a memory map on disk, so only the slabs being fused are held in memory.
+Slabs are fused by run_fusion in child processes, so a cancelled run
+terminates them instead of waiting for them.
+
+Only illumination fusion without registration can be tiled. Detection
+fusion blends the views along Z and registration transforms whole volumes,
+and slabs would cut both.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import os
+import shutil
+import time
+from functools import partial
+from pathlib import Path
+from typing import Any, Callable, Generator, Iterator
+
+import numpy as np
+
+from ._fusion import POLL_INTERVAL, image_keys, run_fusion, run_parallel
+
+# smallest default number of Z planes fused at once, see default_slab_size
+SLAB_SIZE = 64
+
+
+def default_overlap(params: dict[str, Any]) -> int:
+    """
+    Overlap between slabs whose context half covers the fusion filters
+
+    The only filter FUSE applies across Z is the guided filter smoothing the
+    fusion boundary, window_size spans Y and X within a plane.
+
+    Parameters
+    ----------
+    params : dict
+        Parameters as compiled by FusionWidget._get_parameters
+
+    Returns
+    -------
+    int
+        Number of planes shared by neighbouring slabs on each side
+    """
+    return params["GF_kernel_size"]
+
+
+def default_slab_size(
+    params: dict[str, Any], overlap: int | None = None
+) -> int:
+    """
+    Number of planes every slab contributes by default
+
+    SLAB_SIZE, or more if the overlap needs it, so every slab contributes
+    more planes than it reads for context on both sides.
+
+    Parameters
+    ----------
+    params : dict
+        Parameters as compiled by FusionWidget._get_parameters
+    overlap : int, optional
+        Overlap on each side, by default default_overlap
+
+    Returns
+    -------
+    int
+        Slab size of at least 2 * overlap + 1
+    """
+    if overlap is None:
+        overlap = default_overlap(params)
+    return max(SLAB_SIZE, 2 * overlap + 1)
+
+
+def validate_tiling(
+    params: dict[str, Any], slab_size: int | None, overlap: int | None
+):
+    """
+    Check if a fusion can run slab-wise with the given slab geometry
+
+    Parameters
+    ----------
+    params : dict
+        Parameters as compiled by FusionWidget._get_parameters
+    slab_size : int or None
+        Number of planes every slab contributes, None for
+        default_slab_size
+    overlap : int or None
+        Overlap on each side, None for default_overlap
+
+    Raises
+    ------
+    ValueError
+        If the parameters are incompatible with slab-wise fusion
+    """
+    if params.get("require_registration"):
+        raise ValueError("Tiled fusion does not support registration")
+    # detection fusion blends the views along Z, which slabs would cut
+    if params.get("method") == "detection":
+        raise ValueError("Tiled fusion does not support detection fusion")
+    if overlap is None:
+        overlap = default_overlap(params)
+    if slab_size is None:
+        slab_size = default_slab_size(params, overlap)
+    if slab_size < 1 or overlap < 0:
+        raise ValueError("Slab size must be positive, overlap not negative")
+    if slab_size < overlap:
+        raise ValueError("Slab size must be at least the overlap")
+
+
+def slab_bounds(length: int, slab_size: int) -> list[tuple[int, int]]:
+    """
+    Split an axis into consecutive slabs
+
+    Parameters
+    ----------
+    length : int
+        Length of the axis
+    slab_size : int
+        Length of every slab but the last
+
+    Returns
+    -------
+    list[tuple[int, int]]
+        Start and stop of every slab
+    """
+    return [
+        (start, min(start + slab_size, length))
+        for start in range(0, length, slab_size)
+    ]
+
+
+def slab_weights(
+    bounds: tuple[int, int], length: int, overlap: int
+) -> tuple[int, int, np.ndarray]:
+    """
+    Range read for a slab and its blending weight for every plane
+
+    The weights ramp linearly across the central half of the overlap with
+    each neighbour, so the weights of all slabs add up to one for every
+    plane. The outer half of the overlap only provides context and gets no
+    weight, which hides artifacts at the borders of the slab.
+
+    Parameters
+    ----------
+    bounds : tuple[int, int]
+        Start and stop of the slab, see slab_bounds
+    length : int
+        Length of the axis
+    overlap : int
+        Overlap on each side
+
+    Returns
+    -------
+    tuple[int, int, np.ndarray]
+        Start and stop of the planes to read and their weights
+    """
+    start, stop = bounds
+    read_start = max(0, start - overlap)
+    read_stop = min(length, stop + overlap)
+    weights = np.ones(read_stop - read_start, dtype=np.float32)
+    if overlap == 0:
+        return read_start, read_stop, weights
+    centers = np.arange(read_start, read_stop) + 0.5
+    half = overlap / 2
+    if start > 0:
+        ramp = (centers - (start - half)) / overlap
+        weights = np.minimum(weights, np.clip(ramp, 0, 1))
+    if stop < length:
+        ramp = (stop + half - centers) / overlap
+        weights = np.minimum(weights, np.clip(ramp, 0, 1))
+    return read_start, read_stop, weights
+
+
+def _blend(out: np.ndarray, fused: np.ndarray, start: int, weights):
+    if fused.shape != (len(weights), *out.shape[1:]):
+        raise ValueError(
+            f"Fused slab has shape {fused.shape}, expected "
+            f"{(len(weights), *out.shape[1:])}"
+        )
+    weights = weights.reshape((-1,) + (1,) * (out.ndim - 1))
+    if fused.dtype == np.float32 and fused.flags.writeable:
+        # the fused slab is not used afterwards, so no weighted copy
+        fused *= weights
+    else:
+        fused = weights * fused
+    out[start : start + len(weights)] += fused
+
+
+def iter_tiled(
+    images: dict[str, Any],
+    fuse: Callable[[dict[str, Any], int], Generator[Any, None, np.ndarray]],
+    out: np.ndarray,
+    slab_size: int,
+    overlap: int,
+    workers: int = 1,
+) -> Iterator[tuple[int, int]]:
+    """
+    Fuse images slab by slab and blend the slabs into out
+
+    Parameters
+    ----------
+    images : dict
+        Input volumes by name, may be lazy or memory-mapped
+    fuse : callable
+        Called with the slabs of all images by name and the slab index,
+        returns a generator that yields while the slab is fused and returns
+        the fused slab, see fuse_slab
+    out : np.ndarray
+        Zero-initialized output with the shape of the inputs
+    slab_size : int
+        Number of planes every slab contributes
+    overlap : int
+        Overlap on each side
+    workers : int, optional
+        Number of slabs fused in parallel, by default 1
+
+    Yields
+    ------
+    tuple[int, int]
+        Number of slabs done and total number of slabs, also while slabs
+        are fused
+    """
+    length = out.shape[0]
+    slabs = [
+        slab_weights(bounds, length, overlap)
+        for bounds in slab_bounds(length, slab_size)
+    ]
+
+    # slabs are views, so lazy and memory-mapped images are read by fuse
+    def runs():
+        for index, (read_start, read_stop, _) in enumerate(slabs):
+            views = {
+                name: image[read_start:read_stop]
+                for name, image in images.items()
+            }
+            yield index, fuse(views, index)
+
+    done = 0
+    # closed explicitly, so a cancelled run terminates FUSE right away
+    with contextlib.closing(run_parallel(runs(), workers)) as fusions:
+        for finished in fusions:
+            if finished is not None:
+                index, fused = finished
+                read_start, _, weights = slabs[index]
+                _blend(out, fused, read_start, weights)
+                # not held while the next slab is fused
+                del finished, fused
+                done += 1
+            yield done, len(slabs)
+
+
+def fuse_slab(
+    params: dict[str, Any],
+    slab_images: dict[str, Any],
+    index: int,
+    interval: float = POLL_INTERVAL,
+) -> Generator[tuple[int, int, str], None, np.ndarray]:
+    """
+    Fuse one slab with FUSE, see _fusion.run_fusion
+
+    Every slab gets its own subdirectory of tmp_path for intermediates, so
+    slabs can be fused in parallel. The subdirectory is removed once the
+    slab is read unless intermediates are kept.
+
+    Parameters
+    ----------
+    params : dict
+        Parameters without images
+    slab_images : dict
+        Slabs of all images by parameter name
+    index : int
+        Index of the slab
+    interval : float, optional
+        Seconds between two yields while the slab is fused, by default
+        POLL_INTERVAL
+
+    Yields
+    ------
+    tuple[int, int, str]
+        Progress of run_fusion
+
+    Returns
+    -------
+    np.ndarray
+        Fused slab as float32
+    """
+    tmp_path = os.path.join(params["tmp_path"], f"slab_{index:04d}")
+    params = {**params, **slab_images, "tmp_path": tmp_path}
+    fused = yield from run_fusion(params, interval)
+    slab = np.array(fused, dtype=np.float32)
+    del fused
+    if not params.get("keep_intermediates"):
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return slab
+
+
+def run_tiled_fusion(
+    params: dict[str, Any],
+    slab_size: int | None = None,
+    overlap: int | None = None,
+    workers: int = 1,
+) -> Generator[tuple[int, int, str], None, np.ndarray]:
+    """
+    Run a fusion slab by slab, yielding the progress after every slab
+
+    Works like _fusion.run_fusion, but the fused image is a float32 memory
+    map in tmp_path.
+
+    Parameters
+    ----------
+    params : dict
+        Parameters as compiled by FusionWidget._get_parameters
+    slab_size : int, optional
+        Number of planes every slab contributes, by default
+        default_slab_size
+    overlap : int, optional
+        Overlap on each side, by default default_overlap
+    workers : int, optional
+        Number of FUSE processes fusing slabs in parallel, by default 1
+
+    Yields
+    ------
+    tuple[int, int, str]
+        Slabs done, total slabs and a description
+
+    Returns
+    -------
+    np.ndarray
+        Fused image
+    """
+    validate_tiling(params, slab_size, overlap)
+    if overlap is None:
+        overlap = default_overlap(params)
+    if slab_size is None:
+        slab_size = default_slab_size(params, overlap)
+    names = [
+        f"image{index}"
+        for index in image_keys(params["method"], params["amount"])
+    ]
+    images = {name: params[name] for name in names}
+    slab_params = {k: v for k, v in params.items() if k not in names}
+
+    path = Path(params["tmp_path"]) / time.strftime("fused_%Y%m%d_%H%M%S.npy")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    out = np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.float32, shape=images[names[0]].shape
+    )
+    yield 0, 1, "Preparing slabs"
+    for done, total in iter_tiled(
+        images,
+        partial(
+            fuse_slab, slab_params, interval=POLL_INTERVAL / max(1, workers)
+        ),
+        out,
+        slab_size,
+        overlap,
+        workers,
+    ):
+        yield done, total, f"Fused slab {done}/{total}"
+    out.flush()
+    return out
@@ -0,0 +1,355 @@
+"""
+Fusion of time-lapse acquisitions along their first (T) axis.
+
+Keyframes are fused with FUSE, which computes the registration and
+segmentation of the sample. The blend weights of a keyframe are then
+fitted to its result and reused for the following frames up to the next
+keyframe, see _weights. Reusing weighs the views of those frames in
+parallel threads without running FUSE again. Registered or flipped views
+can't be reused that way, see _weights.validate_reuse, so their time-lapse
+fusion is refused rather than running FUSE on every frame.
+
+FUSE runs in child processes like in _fusion.run_fusion. Closing a fusion
+terminates them and leaves frames being weighed to finish in the
+background, so cancelling never waits for a frame.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import itertools
+import os
+import shutil
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Any, Generator, Sequence
+
+import numpy as np
+
+from ._fusion import (
+    POLL_INTERVAL,
+    image_keys,
+    load_image,
+    run_fusion,
+)
+from ._weights import (
+    apply_weights,
+    iter_fit_weights,
+    iter_residual,
+    validate_reuse,
+    view_images,
+)
+
+# keyframe interval that fuses only the first frame with FUSE
+FIRST_ONLY = 0
+
+
+def frame_count(params: dict[str, Any]) -> int:
+    """
+    Number of timepoints of a time-lapse fusion
+
+    Raises
+    ------
+    ValueError
+        If the images are not 4D or differ in their number of timepoints
+    """
+    images = view_images(params)
+    if any(image.ndim != 4 for image in images):
+        raise ValueError("Time-lapse fusion requires (T, Z, Y, X) images")
+    counts = {image.shape[0] for image in images}
+    if len(counts) != 1:
+        raise ValueError("All images must have the same number of timepoints")
+    return counts.pop()
+
+
+def frame_parameters(
+    params: dict[str, Any], frame: int, load: bool = False
+) -> dict[str, Any]:
+    """
+    Parameters of the fusion of one timepoint
+
+    Every timepoint gets its own subdirectory of tmp_path, so timepoints
+    can be fused in parallel.
+
+    Parameters
+    ----------
+    params : dict
+        Parameters with (T, Z, Y, X) images
+    frame : int
+        Index of the timepoint
+    load : bool, optional
+        Read the volumes of the timepoint into memory, by default they are
+        left as views or lazy arrays
+
+    Returns
+    -------
+    dict
+        Parameters with (Z, Y, X) images
+    """
+    framed = dict(params)
+    for index in image_keys(params["method"], params["amount"]):
+        image = params[f"image{index}"][frame]
+        framed[f"image{index}"] = load_image(image) if load else image
+    framed["tmp_path"] = os.path.join(params["tmp_path"], f"t{frame:04d}")
+    return framed
+
+
+def keyframes(n_frames: int, every: int = FIRST_ONLY) -> list[int]:
+    """
+    Timepoints fused with FUSE
+
+    Parameters
+    ----------
+    n_frames : int
+        Number of timepoints
+    every : int, optional
+        Interval between keyframes, by default only the first timepoint
+
+    Returns
+    -------
+    list[int]
+        Indices of the keyframes in ascending order
+    """
+    if every < 0:
+        raise ValueError("The keyframe interval must not be negative")
+    if every == FIRST_ONLY:
+        return [0]
+    return list(range(0, n_frames, every))
+
+
+def fuse_volume(
+    params: dict[str, Any], out: np.ndarray, interval: float = POLL_INTERVAL
+) -> Generator[tuple[int, int, str], None, None]:
+    """
+    Fuse the volumes of one timepoint with FUSE, see frame_parameters
+
+    The directory of the timepoint is removed once its result is copied to
+    out unless intermediates are kept.
+
+    Parameters
+    ----------
+    params : dict
+        Parameters of the timepoint
+    out : np.ndarray
+        float32 volume the result is written to
+    interval : float, optional
+        Seconds between two yields while FUSE runs, by default
+        POLL_INTERVAL
+
+    Yields
+    ------
+    tuple[int, int, str]
+        Progress of _fusion.run_fusion
+    """
+    fused = yield from run_fusion(params, interval)
+    out[...] = fused
+    del fused
+    if not params.get("keep_intermediates"):
+        shutil.rmtree(params["tmp_path"], ignore_errors=True)
+
+
+def _quietly(
+    generator: Generator[Any, None, Any],
+) -> Generator[None, None, Any]:
+    # yields None for every value of a generator and returns its result,
+    # closing it if closed
+    with contextlib.closing(generator):
+        while True:
+            try:
+                next(generator)
+            except StopIteration as stop:
+                return stop.value
+            yield None
+
+
+def _weigh_frame(
+    params: dict[str, Any], frame: int, weights: np.ndarray, out: np.ndarray
+):
+    # reads the views of a timepoint and writes their weighted sum to out
+    framed = frame_parameters(params, frame, load=True)
+    apply_weights(weights, view_images(framed), out[frame])
+
+
+def weigh_frames(
+    params: dict[str, Any],
+    frames: Sequence[int],
+    weights: np.ndarray,
+    out: np.ndarray,
+    workers: int = 1,
+) -> Generator[int | None, None, None]:
+    """
+    Weigh the views of frames in parallel threads, see _weights
+
+    At most workers frames are read at once. Closing the generator cancels
+    the frames not started yet, the ones being weighed finish in the
+    background.
+
+    Parameters
+    ----------
+    params : dict
+        Parameters with images stacked along their first axis
+    frames : sequence of int
+        Indices of the frames
+    weights : np.ndarray
+        Weights of shape (views, Z, Y, X)
+    out : np.ndarray
+        Output the frames are written to, indexed like the images
+    workers : int, optional
+        Number of frames weighed in parallel, by default 1
+
+    Yields
+    ------
+    int or None
+        Index of every weighed frame, None every POLL_INTERVAL seconds
+        while frames are weighed
+    """
+    workers = max(1, workers)
+    frames = iter(frames)
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        pending = {}
+        while True:
+            for frame in itertools.islice(frames, workers - len(pending)):
+                future = executor.submit(
+                    _weigh_frame, params, frame, weights, out
+                )
+                pending[future] = frame
+            if not pending:
+                return
+            done, _ = wait(
+                pending, timeout=POLL_INTERVAL, return_when=FIRST_COMPLETED
+            )
+            if not done:
+                yield None
+            for future in done:
+                future.result()
+                yield pending.pop(future)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def fuse_keyframe(
+    params: dict[str, Any],
+    key: int,
+    frames: Sequence[int],
+    out: np.ndarray,
+    workers: int = 1,
+) -> Generator[tuple[int, float | None] | None, None, None]:
+    """
+    Fuse a keyframe with FUSE and weigh the views of other frames like it
+
+    Parameters
+    ----------
+    params : dict
+        Parameters with images stacked along their first axis
+    key : int
+        Index of the keyframe
+    frames : sequence of int
+        Indices of the frames fused with the weights of the keyframe
+    out : np.ndarray
+        Output the fused frames are written to, indexed like the images
+    workers : int, optional
+        Number of frames weighed in parallel threads, by default 1
+
+    Yields
+    ------
+    tuple[int, float or None] or None
+        Index of every fused frame, for the keyframe with the relative
+        error of its weights, see _weights.residual. None while FUSE runs,
+        the weights are fitted or frames are weighed.
+    """
+    framed = frame_parameters(params, key)
+    # closed explicitly, so a cancelled keyframe terminates FUSE right away
+    with contextlib.closing(fuse_volume(framed, out[key])) as fusion:
+        for _ in fusion:
+            yield None
+    views = view_images(framed)
+    # the weights take as much space as the views, so they are kept on disk
+    path = os.path.join(params["tmp_path"], f"weights_{key:04d}.npy")
+    weights = np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.float32, shape=(len(views), *out.shape[1:])
+    )
+    # fitted and checked in blocks, so a cancelled fit stops right away
+    yield from _quietly(iter_fit_weights(views, out[key], weights))
+    error = yield from _quietly(iter_residual(weights, views, out[key]))
+    del framed, views
+    yield key, error
+    weighing = weigh_frames(params, frames, weights, out, workers)
+    with contextlib.closing(weighing):
+        for frame in weighing:
+            yield None if frame is None else (frame, None)
+    del weights
+    if not params.get("keep_intermediates"):
+        with contextlib.suppress(OSError):
+            os.remove(path)
+
+
+def run_timelapse(
+    params: dict[str, Any], every: int = FIRST_ONLY, workers: int = 1
+) -> Generator[tuple[int, int, str], None, np.ndarray]:
+    """
+    Fuse every timepoint of (T, Z, Y, X) images
+
+    Works like _fusion.run_fusion, but the fused images are stacked into a
+    float32 memory map in tmp_path.
+
+    Parameters
+    ----------
+    params : dict
+        Parameters as compiled by FusionWidget._get_parameters, with
+        (T, Z, Y, X) images
+    every : int, optional
+        Interval between the keyframes fused with FUSE, by default only
+        the first timepoint is
+    workers : int, optional
+        Number of timepoints fused in parallel, by default 1
+
+    Yields
+    ------
+    tuple[int, int, str]
+        Timepoints done, total timepoints and a description
+
+    Returns
+    -------
+    np.ndarray
+        Fused images of shape (T, Z, Y, X)
+
+    Raises
+    ------
+    ValueError
+        If the weights of the keyframes can't be reused, see
+        _weights.validate_reuse
+    """
+    validate_reuse(params)
+    n_frames = frame_count(params)
+    keys = keyframes(n_frames, every)
+    path = Path(params["tmp_path"]) / time.strftime(
+        "fused_timelapse_%Y%m%d_%H%M%S.npy"
+    )
+    path.parent.mkdir(parents=True, exist_ok=True)
+    out = np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.float32, shape=params["image1"].shape
+    )
+    yield 0, n_frames, "Preparing timepoints"
+
+    done = 0
+    for key, stop in zip(keys, [*keys[1:], n_frames]):
+        frames = range(key + 1, stop)
+        stage = f"Fusing keyframe {key}"
+        fusion = fuse_keyframe(params, key, frames, out, workers)
+        with contextlib.closing(fusion):
+            for fused in fusion:
+                if fused is not None:
+                    frame, error = fused
+                    done += 1
+                    if error is None:
+                        stage = f"Fused timepoint {done}/{n_frames}"
+                    else:
+                        stage = (
+                            f"Fused keyframe {frame}, its weights reproduce "
+                            f"it to {error:.1%}"
+                        )
+                yield done, n_frames, stage
+    out.flush()
+    return out
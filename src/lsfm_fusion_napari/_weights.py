@@ -0,0 +1,539 @@
+"""
+Blend weights of a fusion, fitted to its result and reused on other data.
+
+FUSE does not expose the boundaries and masks it computes, but its result
+is, voxel by voxel, close to a convex combination of the input views. The
+weights of that combination are fitted by least squares over a local
+window in every plane, so a single FUSE run is enough to fuse further
+images of the same sample, e.g. other timepoints, by weighting their views
+the same way. FUSE doesn't expose how it registers or flips views either,
+so the weights of registered or flipped views can't be reused, see
+validate_reuse.
+
+Weights can be saved to a .npz file together with the parameters that
+must match wherever they are applied, so repeat acquisitions of the same
+mount are fused without running FUSE. They are written plane by plane and
+memory-mapped when loaded, so neither holds all weights in memory.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import struct
+import zipfile
+from typing import Any, Callable, Generator, Sequence
+
+import numpy as np
+from scipy import ndimage
+
+from ._fusion import image_keys
+
+# width in pixels of the window the weights are fitted over
+WINDOW = 15
+
+# version of the format written by save_weights
+WEIGHTS_VERSION = 1
+
+# pull of the weights towards equal weighting where views are alike,
+# relative to the mean local variance of their differences
+RIDGE = 1e-3
+
+# voxels whose normal equations are solved at once
+SOLVE_VOXELS = 1 << 16
+
+
+def validate_reuse(params: dict[str, Any]):
+    """
+    Check that the weights of a fusion with these parameters can be reused
+
+    Registration and flipping transform the views before they are
+    combined, and FUSE doesn't expose the transforms, so the weights of
+    registered or flipped views only apply to the views of that very run.
+
+    Raises
+    ------
+    ValueError
+        If the views are registered or flipped
+    """
+    if params.get("require_registration"):
+        raise ValueError(
+            "FUSE doesn't expose the transforms of registered views, so "
+            "their fusion can't be reused"
+        )
+    if params.get("require_flip_illu") or params.get("require_flip_det"):
+        raise ValueError(
+            "FUSE doesn't expose how it flips the views, so the fusion of "
+            "flipped views can't be reused"
+        )
+
+
+def reusable(params: dict[str, Any]) -> bool:
+    """
+    Check if the weights of a fusion with these parameters can be reused,
+    see validate_reuse
+    """
+    try:
+        validate_reuse(params)
+    except ValueError:
+        return False
+    return True
+
+
+def view_images(params: dict[str, Any]) -> list:
+    """
+    Images of a fusion in the order of their weights
+    """
+    return [
+        params[f"image{index}"]
+        for index in image_keys(params["method"], params["amount"])
+    ]
+
+
+def _fit_plane(
+    planes: list[np.ndarray], fused: np.ndarray, window: int, out: np.ndarray
+) -> Generator[None, None, None]:
+    # writes the weights of one plane to out of shape (views, Y, X), every
+    # view is expressed relative to the last one. The local sums of the
+    # normal equations are float32 planes, the equations are solved for a
+    # few rows at a time, yielding after each
+    n = len(planes) - 1
+    diffs = [plane - planes[-1] for plane in planes[:-1]]
+    target = fused - planes[-1]
+    sums = {}
+    for i in range(n):
+        sums[i, n] = ndimage.uniform_filter(diffs[i] * target, window)
+        for j in range(i + 1):
+            sums[i, j] = ndimage.uniform_filter(diffs[i] * diffs[j], window)
+    del diffs, target
+    trace = sum(float(sums[i, i].mean(dtype=np.float64)) for i in range(n))
+    ridge = RIDGE * max(trace, 1)
+    rows = max(1, SOLVE_VOXELS // fused.shape[1])
+    for start in range(0, fused.shape[0], rows):
+        block = slice(start, start + rows)
+        shape = sums[0, 0][block].shape
+        gram = np.empty((*shape, n, n))
+        rhs = np.empty((*shape, n))
+        for i in range(n):
+            rhs[..., i] = sums[i, n][block]
+            for j in range(i + 1):
+                gram[..., i, j] = gram[..., j, i] = sums[i, j][block]
+        gram += ridge * np.eye(n)
+        rhs += ridge / (n + 1)
+        weights = np.linalg.solve(gram, rhs[..., None])[..., 0]
+        weights = np.concatenate(
+            [weights, 1 - weights.sum(axis=-1, keepdims=True)], axis=-1
+        )
+        np.clip(weights, 0, None, out=weights)
+        weights /= np.maximum(weights.sum(axis=-1, keepdims=True), 1e-6)
+        out[:, block] = np.moveaxis(weights, -1, 0)
+        yield
+
+
+def _check_shapes(images: Sequence, fused) -> tuple[int, ...]:
+    # shape of the volumes of a fit, see fit_weights
+    if len(images) < 2:
+        raise ValueError("At least two views are needed")
+    shape = tuple(fused.shape)
+    if fused.ndim != 3 or any(tuple(i.shape) != shape for i in images):
+        raise ValueError("Views and result must be volumes of one shape")
+    return shape
+
+
+def iter_fit_weights(
+    images: Sequence, fused, out: np.ndarray, window: int = WINDOW
+) -> Generator[tuple[int, int, str], None, None]:
+    """
+    Fit weights like fit_weights, yielding between blocks of at most
+    SOLVE_VOXELS voxels
+
+    Closing the generator stops the fit, so it can be cancelled at any
+    time.
+
+    Parameters
+    ----------
+    images : sequence of array-like
+        Views of the fusion, see fit_weights
+    fused : array-like
+        Result of fusing the views
+    out : np.ndarray
+        float32 array of shape (views, Z, Y, X) the weights are written to
+    window : int, optional
+        Width of the window the weights are fitted over, by default WINDOW
+
+    Yields
+    ------
+    tuple[int, int, str]
+        Index of the plane being fitted, number of planes and a description
+    """
+    shape = _check_shapes(images, fused)
+    for z in range(shape[0]):
+        planes = [np.asarray(image[z], dtype=np.float32) for image in images]
+        plane = np.asarray(fused[z], dtype=np.float32)
+        for _ in _fit_plane(planes, plane, window, out[:, z]):
+            yield z, shape[0], "Fitting weights"
+
+
+def fit_weights(
+    images: Sequence,
+    fused,
+    window: int = WINDOW,
+    out: np.ndarray | None = None,
+) -> np.ndarray:
+    """
+    Fit the voxel-wise weights that combine the views into a fused image
+
+    The weights are non-negative and add up to one in every voxel. They
+    are fitted plane by plane, so only one plane of every image is held in
+    memory besides the weights, which can be written to a memory map.
+
+    Parameters
+    ----------
+    images : sequence of array-like
+        Views of the fusion in the order of view_images, all of the same
+        (Z, Y, X) shape
+    fused : array-like
+        Result of fusing the views
+    window : int, optional
+        Width of the window the weights are fitted over, by default WINDOW
+    out : np.ndarray, optional
+        float32 array of shape (views, Z, Y, X) to write the weights to, by
+        default a new one
+
+    Returns
+    -------
+    np.ndarray
+        float32 weights of shape (views, Z, Y, X)
+    """
+    shape = _check_shapes(images, fused)
+    if out is None:
+        out = np.empty((len(images), *shape), dtype=np.float32)
+    for _ in iter_fit_weights(images, fused, out, window):
+        pass
+    return out
+
+
+def apply_weights(
+    weights: np.ndarray, images: Sequence, out: np.ndarray | None = None
+) -> np.ndarray:
+    """
+    Combine views with fitted weights, see fit_weights
+
+    Parameters
+    ----------
+    weights : np.ndarray
+        Weights of shape (views, Z, Y, X)
+    images : sequence of array-like
+        Views of the same shape and order as the weights were fitted to
+    out : np.ndarray, optional
+        float32 array to write the result to, by default a new one
+
+    Returns
+    -------
+    np.ndarray
+        Weighted sum of the views as float32
+    """
+    if len(images) != len(weights):
+        raise ValueError(
+            f"The weights combine {len(weights)} views, not {len(images)}"
+        )
+    if any(tuple(image.shape) != weights.shape[1:] for image in images):
+        raise ValueError("The views don't match the shape of the weights")
+    if out is None:
+        out = np.empty(weights.shape[1:], dtype=np.float32)
+    for z in range(weights.shape[1]):
+        plane = np.zeros(weights.shape[2:], dtype=np.float32)
+        for weight, image in zip(weights[:, z], images):
+            plane += weight * np.asarray(image[z], dtype=np.float32)
+        out[z] = plane
+    return out
+
+
+def iter_residual(
+    weights: np.ndarray, images: Sequence, fused
+) -> Generator[tuple[int, int, str], None, float]:
+    """
+    Compute the residual like residual, yielding after every plane
+
+    Yields
+    ------
+    tuple[int, int, str]
+        Index of the plane being compared, number of planes and a
+        description
+
+    Returns
+    -------
+    float
+        Relative root mean square error, see residual
+    """
+    error = 0.0
+    norm = 0.0
+    for z in range(weights.shape[1]):
+        target = np.asarray(fused[z], dtype=np.float32)
+        plane = apply_weights(
+            weights[:, z : z + 1], [image[z : z + 1] for image in images]
+        )[0]
+        error += float(np.square(plane - target, dtype=np.float64).sum())
+        norm += float(np.square(target, dtype=np.float64).sum())
+        yield z, weights.shape[1], "Checking weights"
+    return float(np.sqrt(error / max(norm, 1e-12)))
+
+
+def residual(weights: np.ndarray, images: Sequence, fused) -> float:
+    """
+    Root mean square error of the weighted views relative to the fusion
+
+    Small values mean the weights reproduce the fusion they were fitted to.
+    """
+    checking = iter_residual(weights, images, fused)
+    while True:
+        try:
+            next(checking)
+        except StopIteration as stop:
+            return stop.value
+
+
+def weights_metadata(params: dict[str, Any], shape: tuple[int, ...]) -> dict:
+    """
+    Parameters that must match wherever weights are applied
+    """
+    keys = image_keys(params["method"], params["amount"])
+    return {
+        "version": WEIGHTS_VERSION,
+        "method": params["method"],
+        "amount": params["amount"],
+        "directions": [params[f"direction{index}"] for index in keys],
+        "require_registration": bool(params.get("require_registration")),
+        "require_flip_illu": bool(params.get("require_flip_illu")),
+        "require_flip_det": bool(params.get("require_flip_det")),
+        "shape": [int(size) for size in shape],
+    }
+
+
+def save_weights(path: str, weights, params: dict[str, Any]):
+    """
+    Save fitted weights with the parameters of their fusion
+
+    The weights are stored as float16, which keeps three decimals of
+    weights between 0 and 1 and halves the file size. They are written to
+    an uncompressed .npz file plane by plane, so weights in a memory map
+    are never held in memory as a whole.
+
+    Parameters
+    ----------
+    path : str
+        Path of the .npz file
+    weights : array-like
+        Weights as returned by fit_weights
+    params : dict
+        Parameters of the fusion the weights were fitted to
+    """
+    validate_reuse(params)
+    metadata = weights_metadata(params, weights.shape[1:])
+    header = {
+        "descr": np.lib.format.dtype_to_descr(np.dtype(np.float16)),
+        "fortran_order": False,
+        "shape": tuple(int(size) for size in weights.shape),
+    }
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_STORED) as archive:
+        with archive.open("weights.npy", "w", force_zip64=True) as f:
+            np.lib.format.write_array_header_1_0(f, header)
+            for view in weights:
+                for plane in view:
+                    f.write(np.asarray(plane, dtype=np.float16).tobytes())
+        with archive.open("metadata.npy", "w") as f:
+            np.lib.format.write_array(f, np.array(json.dumps(metadata)))
+
+
+def read_metadata(path: str) -> dict:
+    """
+    Parameters saved with weights, without reading the weights
+    """
+    with np.load(path) as f:
+        metadata = json.loads(str(f["metadata"]))
+    if metadata.get("version") != WEIGHTS_VERSION:
+        raise ValueError(f"Unsupported weights file {path}")
+    return metadata
+
+
+def _map_member(path: str, name: str) -> np.ndarray | None:
+    # read-only memory map of an array stored uncompressed in a .npz file,
+    # None if it is compressed or in a format numpy can't map
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo(name)
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(path, "rb") as f:
+        # the local file header is 30 bytes followed by the name and the
+        # extra field, whose lengths are its last two fields
+        f.seek(info.header_offset)
+        name_length, extra_length = struct.unpack("<HH", f.read(30)[26:])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            header = np.lib.format.read_array_header_1_0(f)
+        elif version == (2, 0):
+            header = np.lib.format.read_array_header_2_0(f)
+        else:
+            return None
+        offset = f.tell()
+    shape, fortran_order, dtype = header
+    if dtype.hasobject:
+        return None
+    return np.memmap(
+        path,
+        dtype=dtype,
+        mode="r",
+        offset=offset,
+        shape=shape,
+        order="F" if fortran_order else "C",
+    )
+
+
+def load_weights(path: str) -> tuple[np.ndarray, dict]:
+    """
+    Load weights saved with save_weights
+
+    The weights are memory-mapped read-only, like np.load with
+    mmap_mode="r", and only read plane by plane as they are applied.
+
+    Returns
+    -------
+    tuple[np.ndarray, dict]
+        Weights of shape (views, Z, Y, X) and the parameters saved with
+        them, see weights_metadata
+    """
+    metadata = read_metadata(path)
+    weights = _map_member(path, "weights.npy")
+    if weights is None:
+        with np.load(path) as f:
+            weights = f["weights"]
+    return weights, metadata
+
+
+def check_metadata(metadata: dict, params: dict[str, Any]):
+    """
+    Check that saved weights apply to the images of a fusion
+
+    Raises
+    ------
+    ValueError
+        If the method, views, directions, registration, flips or shape
+        differ
+    """
+    if (params["method"], params["amount"]) != (
+        metadata["method"],
+        metadata["amount"],
+    ):
+        raise ValueError(
+            f"The weights are for {metadata['method']} fusion of "
+            f"{metadata['amount']} images"
+        )
+    images = view_images(params)
+    expected = weights_metadata(params, tuple(images[0].shape))
+    for key in (
+        "directions",
+        "require_registration",
+        "require_flip_illu",
+        "require_flip_det",
+    ):
+        if expected[key] != metadata[key]:
+            raise ValueError(f"The weights differ in {key.replace('_', ' ')}")
+    if any(list(image.shape) != metadata["shape"] for image in images):
+        raise ValueError(
+            f"The weights are for images of shape {tuple(metadata['shape'])}"
+        )
+
+
+def run_apply_weights(
+    params: dict[str, Any], path: str
+) -> Generator[tuple[int, int, str], None, np.ndarray]:
+    """
+    Fuse images with saved weights instead of FUSE
+
+    Yields and returns like _fusion.run_fusion.
+
+    Parameters
+    ----------
+    params : dict
+        Parameters as compiled by FusionWidget._get_parameters
+    path : str
+        Path of weights saved with save_weights
+    """
+    yield 0, 2, "Loading weights"
+    weights, metadata = load_weights(path)
+    check_metadata(metadata, params)
+    yield 1, 2, "Applying weights"
+    # the result is written to tmp_path like the result of run_fusion
+    os.makedirs(params["tmp_path"], exist_ok=True)
+    path = os.path.join(params["tmp_path"], "fused.npy")
+    output_image = np.lib.format.open_memmap(
+        path, mode="w+", dtype=np.float32, shape=weights.shape[1:]
+    )
+    apply_weights(weights, view_images(params), out=output_image)
+    output_image.flush()
+    del output_image, weights
+    yield 2, 2, "Finished"
+    return np.load(path, mmap_mode="r")
+
+
+def run_and_save_weights(
+    path: str,
+    params: dict[str, Any],
+    run: Callable[..., Generator[tuple[int, int, str], None, Any]],
+    *args,
+    **kwargs,
+) -> Generator[tuple[int, int, str], None, Any]:
+    """
+    Run a fusion generator, then fit and save the weights of its result
+
+    The parameters are checked with validate_reuse before the run. The
+    weights are fitted into a memory map in the run's tmp_path in blocks,
+    see iter_fit_weights, and it is removed once they are saved or the
+    generator is closed.
+
+    Parameters
+    ----------
+    path : str
+        Path of the .npz file, see save_weights
+    params : dict
+        Parameters of the fusion
+    run : callable
+        Generator function like _fusion.run_fusion
+    *args, **kwargs
+        Arguments of run
+
+    Yields
+    ------
+    tuple[int, int, str]
+        Progress of run, then of fitting the weights
+
+    Returns
+    -------
+    Any
+        Return value of run
+
+    Raises
+    ------
+    ValueError
+        If the weights of the fusion can't be reused
+    """
+    validate_reuse(params)
+    output_image = yield from run(*args, **kwargs)
+    views = view_images(params)
+    scratch = os.path.join(params["tmp_path"], "weights.npy")
+    os.makedirs(params["tmp_path"], exist_ok=True)
+    weights = np.lib.format.open_memmap(
+        scratch,
+        mode="w+",
+        dtype=np.float32,
+        shape=(len(views), *output_image.shape),
+    )
+    try:
+        yield from iter_fit_weights(views, output_image, weights)
+        save_weights(path, weights, params)
+    finally:
+        del weights
+        os.remove(scratch)
+    yield 1, 1, f"Weights saved to {path}"
+    return output_image
@@ -1,6 +1,5 @@
 import logging
 import warnings
-from pathlib import Path
 import os
 
 from qtpy.QtWidgets import (
@@ -18,17 +17,97 @@ from qtpy.QtWidgets import (
     QFileDialog,
     QSizePolicy,
     QSlider,
+    QProgressBar,
+    QMessageBox,
+    QListWidget,
 )
 from qtpy.QtCore import Qt
 
 import napari
-from FUSE import FUSE_illu, FUSE_det
+from napari.qt.threading import create_worker
 
+from ._cache import run_cached
+from ._channels import channel_count, channels_first, run_multichannel
 from ._dialog import GuidedDialog
-from ._writer import save_dialog, write_tiff
+from ._fusion import (
+    FUSION_STAGES,
+    image_keys,
+    mapped_file,
+    run_fusion,
+    run_preview,
+    validate_parameters,
+)
+from ._normalization import OUTPUT_DTYPES, TOLERANCE, normalize_percentiles
+from ._preflight import (
+    available_resources,
+    estimate,
+    fits,
+    format_bytes,
+    largest_slab_size,
+)
+from ._profiling import RunProfile, profile_run
+from ._pyramid import run_with_pyramid
+from ._queue import CANCELLED, DONE, FAILED, RUNNING, JobQueue
+from ._scratch import SCRATCH_BYTES, ScratchStore, default_scratch_root
+from ._sweep import parse_values, run_sweep, sweep_combinations
+from ._tiling import run_tiled_fusion, validate_tiling
+from ._timelapse import (
+    FIRST_ONLY,
+    frame_count,
+    keyframes,
+    run_timelapse,
+)
+from ._weights import (
+    check_metadata,
+    read_metadata,
+    reusable,
+    run_and_save_weights,
+    run_apply_weights,
+    validate_reuse,
+)
+from ._writer import write_tiff, write_zarr
 import numpy as np
 
 
+# name of the layer showing the latest preview
+PREVIEW_LAYER = "fusion preview"
+SWEEP_LAYER = "parameter sweep"
+# layer metadata key of the scratch root the layer data was written to
+SCRATCH_ROOT = "scratch_root"
+
+
+def save_dialog(parent):
+    """
+    Opens a dialog to select a location to save a file
+
+    Parameters
+    ----------
+    parent : QWidget
+        Parent widget for the dialog
+
+    Returns
+    -------
+    str
+        Path of selected file, empty if the dialog was cancelled
+    """
+    dialog = QFileDialog()
+    filepath, selected_filter = dialog.getSaveFileName(
+        parent,
+        "Select location for the file to be created",
+        filter="TIFF files (*.tif *.tiff);;OME-Zarr (*.zarr)",
+    )
+    if not filepath or filepath.endswith((".tiff", ".tif", ".zarr")):
+        return filepath
+    if "zarr" in selected_filter:
+        return filepath + ".zarr"
+    return filepath + ".tiff"
+
+
+def _forward(run):
+    # create_worker needs a generator function, not a generator
+    return (yield from run)
+
+
 class IntensityNormalization(QGroupBox):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -68,6 +147,20 @@ class IntensityNormalization(QGroupBox):
         sld_upper_percentage.valueChanged.connect(self.upper_changed)
         vbox.addWidget(sld_upper_percentage)
 
+        # only used for data that is not held in memory
+        vbox.addWidget(QLabel("tolerance (dask / memory-mapped data)"))
+        self.lineedit_tolerance = QLineEdit(str(TOLERANCE))
+        vbox.addWidget(self.lineedit_tolerance)
+
+        vbox.addWidget(QLabel("output type"))
+        self.cbx_dtype = QComboBox()
+        self.cbx_dtype.addItems(OUTPUT_DTYPES)
+        vbox.addWidget(self.cbx_dtype)
+
+        # replacing drops the original data instead of keeping both volumes
+        self.chk_replace = QCheckBox("replace image")
+        vbox.addWidget(self.chk_replace)
+
         btn_run = QPushButton("run")
         btn_run.clicked.connect(self.run_intensity_normalization)
         vbox.addWidget(btn_run)
@@ -98,15 +191,50 @@ class IntensityNormalization(QGroupBox):
         if any(layer.name == self.name for layer in self.viewer.layers):
             layer = self.viewer.layers[self.name]
             input_image = layer.data
+            if layer.multiscale:
+                # all levels with the percentiles of the full resolution
+                input_image = list(input_image)
         else:
             print("Error: The image %s don't exist!" % (self.name))
             return
 
-        lower_v = np.percentile(input_image, self.lower_percentage)
-        upper_v = np.percentile(input_image, self.upper_percentage)
-        img = np.clip(input_image, lower_v, upper_v)
-        output = (img - lower_v) / (upper_v - lower_v)
-        self.viewer.add_image(output, name=self.name)
+        try:
+            tolerance = float(self.lineedit_tolerance.text())
+        except ValueError:
+            print("Error: Invalid tolerance!")
+            return
+        if not (0 < tolerance < 1):
+            print("Error: The tolerance must be between 0 and 1!")
+            return
+
+        dtype = self.cbx_dtype.currentText()
+        replace = self.chk_replace.isChecked()
+        store = self.parent._get_scratch_store(
+            self.parent.label_tmp_path.text()
+        )
+        if store is None:
+            return
+        # memory maps of out-of-core data are written to a scratch run, so
+        # they count against the budget and are evicted like intermediates
+        with store.run("normalization") as directory:
+            output = normalize_percentiles(
+                input_image,
+                self.lower_percentage,
+                self.upper_percentage,
+                tolerance=tolerance,
+                directory=str(directory),
+                dtype=dtype,
+                in_place=replace,
+            )
+        limits = (0, np.iinfo(np.uint16).max) if dtype == "uint16" else (0, 1)
+        if replace:
+            layer.data = output
+            layer.contrast_limits_range = limits
+            layer.contrast_limits = limits
+        else:
+            self.viewer.add_image(
+                output, name=self.name, contrast_limits=limits
+            )
 
 
 class FusionWidget(QWidget):
@@ -117,12 +245,22 @@ class FusionWidget(QWidget):
         self.viewer = viewer
         self.logger: logging.Logger
         self._initialize_logger()
-        self.layer_names = "fusion_widget"
+        self.layer_names = [layer.name for layer in self.viewer.layers]
 
         self.logger.debug("Initializing FusionWidget")
 
         self.guided_dialog = GuidedDialog(self)
         self.image_config_is_valid = False
+        self.worker = None
+        self.scratch_store = None
+        self.scratch_run = None
+        self.profile = None
+        # queued fusions run independently of the worker above
+        self.job_queue = JobQueue()
+        self.job_workers = {}
+        # scale and translate of the results of queued jobs, by job id
+        self.job_placements = {}
+        self.queue_active = False
 
         self._initialize_ui()
 
@@ -149,6 +287,11 @@ class FusionWidget(QWidget):
 
         def wrapper(self, func, event):
             self.guided_dialog.close()
+            if self.worker is not None:
+                self.worker.quit()
+            self.queue_active = False
+            for worker in self.job_workers.values():
+                worker.quit()
             self.logger.debug("Exiting")
             return func(event)
 
@@ -172,6 +315,19 @@ class FusionWidget(QWidget):
             event.value.metadata["old_name"] = event.value.name
 
         self.viewer.layers.events.inserted.connect(write_old_name_to_metadata)
+
+        # scratch runs and cached results backing layers are never evicted
+        self._layer_pins = {}
+
+        def pin_layer(event):
+            layer = event.value
+            self._pin_layer(layer)
+            layer.events.data.connect(lambda _: self._pin_layer(layer))
+
+        self.viewer.layers.events.inserted.connect(pin_layer)
+        self.viewer.layers.events.removed.connect(
+            lambda event: self._unpin_layer(event.value)
+        )
         for layer in self.viewer.layers:
             layer.metadata["old_name"] = layer.name
             layer.events.name.connect(self._update_layer_label)
@@ -236,23 +392,48 @@ class FusionWidget(QWidget):
         label_req_flip_illu = QLabel("Require flipping along illumination:")
         label_req_flip_det = QLabel("Require flipping along detection:")
         label_keep_tmp = QLabel("Keep temporary files:")
-        path = Path(__file__).parent.parent.parent / "intermediates"
-        os.makedirs(path, exist_ok=True)
-        self.label_tmp_path = QLabel(str(path))
+        label_use_cache = QLabel("Reuse cached results:")
+        label_scratch_budget = QLabel("Scratch budget (GB):")
+        label_pyramid_level = QLabel("Pyramid level:")
+        self.label_tmp_path = QLabel(default_scratch_root())
         self.label_tmp_path.setWordWrap(True)
         self.label_tmp_path.setMaximumWidth(350)
 
         # QPushButtons
         btn_input = QPushButton("Input")
         btn_path = QPushButton("Set temp path")
-        btn_process = QPushButton("Process")
+        self.btn_process = QPushButton("Process")
+        self.btn_cancel = QPushButton("Cancel")
+        self.btn_cancel.setEnabled(False)
         btn_save = QPushButton("Save")
 
         btn_input.clicked.connect(self.guided_dialog.show)
         btn_path.clicked.connect(self.get_path)
-        btn_process.clicked.connect(self._process_on_click)
+        self.btn_process.clicked.connect(self._process_on_click)
+        self.btn_cancel.clicked.connect(self._cancel_on_click)
         btn_save.clicked.connect(self._save_on_click)
 
+        # progress of the running fusion
+        self.label_progress = QLabel("")
+        self.label_estimate = QLabel("")
+        self.label_estimate.setWordWrap(True)
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setRange(0, len(FUSION_STAGES) - 1)
+        self.progress_bar.setValue(0)
+        self.progress_bar.setVisible(False)
+
+        # statistics of the last run, collapsed by default
+        self.profile_box = QGroupBox("Run statistics")
+        self.profile_box.setCheckable(True)
+        self.profile_box.setChecked(False)
+        self.label_profile = QLabel("No run yet")
+        self.label_profile.setStyleSheet("font-family: monospace")
+        self.label_profile.setVisible(False)
+        self.profile_box.toggled.connect(self.label_profile.setVisible)
+        profile_layout = QVBoxLayout()
+        profile_layout.addWidget(self.label_profile)
+        self.profile_box.setLayout(profile_layout)
+
         # QCheckBoxes
         self.checkbox_req_segmentation = QCheckBox()
         self.checkbox_req_registration = QCheckBox()
@@ -261,7 +442,15 @@ class FusionWidget(QWidget):
         )
         self.checkbox_req_flip_illu = QCheckBox()
         self.checkbox_req_flip_det = QCheckBox()
+        for checkbox in (
+            self.checkbox_req_registration,
+            self.checkbox_req_flip_illu,
+            self.checkbox_req_flip_det,
+        ):
+            checkbox.stateChanged.connect(self._toggle_reuse)
         self.checkbox_keep_tmp = QCheckBox()
+        self.checkbox_use_cache = QCheckBox()
+        self.checkbox_use_cache.setChecked(True)
 
         # QLineEdits
         self.lineedit_resample_ratio = QLineEdit()
@@ -279,6 +468,9 @@ class FusionWidget(QWidget):
         self.lineedit_gf_kernel_size.setText("49")
         self.lineedit_lateral_resolution.setText("1")
         self.lineedit_axial_resolution.setText("1")
+        self.lineedit_scratch_budget = QLineEdit(str(SCRATCH_BYTES // 1024**3))
+        # level of multiscale inputs to fuse, 0 is full resolution
+        self.lineedit_pyramid_level = QLineEdit("0")
 
         self.input_box = QGroupBox("Input")
         input_layout = QGridLayout()
@@ -326,8 +518,146 @@ class FusionWidget(QWidget):
         parameters_layout.addWidget(self.checkbox_req_flip_det, 8, 2)
         parameters_layout.addWidget(label_keep_tmp, 9, 0, 1, 2)
         parameters_layout.addWidget(self.checkbox_keep_tmp, 9, 2)
+        parameters_layout.addWidget(label_use_cache, 10, 0, 1, 2)
+        parameters_layout.addWidget(self.checkbox_use_cache, 10, 2)
+        parameters_layout.addWidget(label_scratch_budget, 11, 0, 1, 2)
+        parameters_layout.addWidget(self.lineedit_scratch_budget, 11, 2)
+        parameters_layout.addWidget(label_pyramid_level, 12, 0, 1, 2)
+        parameters_layout.addWidget(self.lineedit_pyramid_level, 12, 2)
         parameters.setLayout(parameters_layout)
 
+        # slab-wise fusion for volumes that don't fit into memory
+        self.tiling_box = QGroupBox("Tiled processing")
+        self.tiling_box.setCheckable(True)
+        self.tiling_box.setChecked(False)
+        self.tiling_box.setToolTip(
+            "Only for illumination fusion without registration, slabs "
+            "would cut the blending of detection fusion along Z and the "
+            "registration of whole volumes"
+        )
+        self.lineedit_slab_size = QLineEdit()
+        self.lineedit_slab_size.setPlaceholderText("auto")
+        self.lineedit_overlap = QLineEdit()
+        self.lineedit_overlap.setPlaceholderText("auto")
+        self.lineedit_tile_workers = QLineEdit("1")
+        tiling_layout = QGridLayout()
+        tiling_layout.addWidget(QLabel("Slab size (Z):"), 0, 0, 1, 2)
+        tiling_layout.addWidget(self.lineedit_slab_size, 0, 2)
+        tiling_layout.addWidget(QLabel("Overlap:"), 1, 0, 1, 2)
+        tiling_layout.addWidget(self.lineedit_overlap, 1, 2)
+        tiling_layout.addWidget(QLabel("Parallel slabs:"), 2, 0, 1, 2)
+        tiling_layout.addWidget(self.lineedit_tile_workers, 2, 2)
+        self.tiling_box.setLayout(tiling_layout)
+
+        # 4D images fused timepoint by timepoint, FUSE runs on keyframes
+        self.timelapse_box = QGroupBox("Time-lapse")
+        self.timelapse_box.setCheckable(True)
+        self.timelapse_box.setChecked(False)
+        self.lineedit_keyframe_interval = QLineEdit()
+        self.lineedit_keyframe_interval.setPlaceholderText("first only")
+        self.lineedit_timelapse_workers = QLineEdit("2")
+        timelapse_layout = QGridLayout()
+        timelapse_layout.addWidget(QLabel("Keyframe every:"), 0, 0, 1, 2)
+        timelapse_layout.addWidget(self.lineedit_keyframe_interval, 0, 2)
+        timelapse_layout.addWidget(QLabel("Parallel timepoints:"), 1, 0, 1, 2)
+        timelapse_layout.addWidget(self.lineedit_timelapse_workers, 1, 2)
+        self.timelapse_box.setLayout(timelapse_layout)
+
+        # multi-channel images, FUSE runs on the reference channel only
+        self.channels_box = QGroupBox("Multi-channel")
+        self.channels_box.setCheckable(True)
+        self.channels_box.setChecked(False)
+        self.lineedit_reference_channel = QLineEdit("0")
+        self.lineedit_channel_workers = QLineEdit("2")
+        channels_layout = QGridLayout()
+        channels_layout.addWidget(QLabel("Reference channel:"), 0, 0, 1, 2)
+        channels_layout.addWidget(self.lineedit_reference_channel, 0, 2)
+        channels_layout.addWidget(QLabel("Parallel channels:"), 1, 0, 1, 2)
+        channels_layout.addWidget(self.lineedit_channel_workers, 1, 2)
+        self.channels_box.setLayout(channels_layout)
+
+        # blend weights fitted to a fusion, reused for repeat acquisitions
+        weights_box = QGroupBox("Saved weights")
+        self.checkbox_save_weights = QCheckBox("Save weights of the fusion")
+        # these reuse the weights of a fusion, see _weights.validate_reuse
+        for widget in (
+            self.timelapse_box,
+            self.channels_box,
+            self.checkbox_save_weights,
+        ):
+            widget.setToolTip(
+                "Not available for registered or flipped views, FUSE "
+                "doesn't expose how it transforms them"
+            )
+        self.btn_apply_weights = QPushButton("Apply saved weights")
+        self.btn_apply_weights.clicked.connect(self._apply_weights_on_click)
+        weights_layout = QVBoxLayout()
+        weights_layout.addWidget(self.checkbox_save_weights)
+        weights_layout.addWidget(self.btn_apply_weights)
+        weights_box.setLayout(weights_layout)
+
+        # quick runs on a part of the images to tune the parameters
+        preview_box = QGroupBox("Preview")
+        self.lineedit_preview_z_start = QLineEdit()
+        self.lineedit_preview_z_start.setPlaceholderText("first")
+        self.lineedit_preview_z_stop = QLineEdit()
+        self.lineedit_preview_z_stop.setPlaceholderText("last")
+        self.lineedit_preview_stride = QLineEdit("4")
+        self.btn_preview = QPushButton("Preview")
+        self.btn_preview.clicked.connect(self._preview_on_click)
+        preview_layout = QGridLayout()
+        preview_layout.addWidget(QLabel("Z range:"), 0, 0)
+        preview_layout.addWidget(self.lineedit_preview_z_start, 0, 1)
+        preview_layout.addWidget(self.lineedit_preview_z_stop, 0, 2)
+        preview_layout.addWidget(QLabel("Stride (Y, X):"), 1, 0, 1, 2)
+        preview_layout.addWidget(self.lineedit_preview_stride, 1, 2)
+        preview_layout.addWidget(self.btn_preview, 2, 0, 1, -1)
+        # every combination of the values is fused on the same crop
+        self.lineedit_sweep_window_size_Y = QLineEdit()
+        self.lineedit_sweep_window_size_X = QLineEdit()
+        self.lineedit_sweep_gf_kernel_size = QLineEdit()
+        for lineedit in (
+            self.lineedit_sweep_window_size_Y,
+            self.lineedit_sweep_window_size_X,
+            self.lineedit_sweep_gf_kernel_size,
+        ):
+            lineedit.setPlaceholderText("current value")
+        self.lineedit_sweep_workers = QLineEdit("2")
+        self.btn_sweep = QPushButton("Sweep parameters")
+        self.btn_sweep.clicked.connect(self._sweep_on_click)
+        preview_layout.addWidget(QLabel("Sweep window size:"), 3, 0)
+        preview_layout.addWidget(self.lineedit_sweep_window_size_Y, 3, 1)
+        preview_layout.addWidget(self.lineedit_sweep_window_size_X, 3, 2)
+        preview_layout.addWidget(QLabel("Sweep GF kernel size:"), 4, 0, 1, 2)
+        preview_layout.addWidget(self.lineedit_sweep_gf_kernel_size, 4, 2)
+        preview_layout.addWidget(QLabel("Parallel runs:"), 5, 0, 1, 2)
+        preview_layout.addWidget(self.lineedit_sweep_workers, 5, 2)
+        preview_layout.addWidget(self.btn_sweep, 6, 0, 1, -1)
+        preview_box.setLayout(preview_layout)
+
+        # fusions of several configurations, run in the background
+        queue_box = QGroupBox("Job queue")
+        btn_enqueue = QPushButton("Add to queue")
+        btn_enqueue.clicked.connect(self._enqueue_on_click)
+        self.btn_run_queue = QPushButton("Run queue")
+        self.btn_run_queue.clicked.connect(self._run_queue_on_click)
+        btn_remove_job = QPushButton("Remove job")
+        btn_remove_job.clicked.connect(self._remove_job_on_click)
+        btn_clear_jobs = QPushButton("Clear finished")
+        btn_clear_jobs.clicked.connect(self._clear_jobs_on_click)
+        self.lineedit_queue_limit = QLineEdit("1")
+        self.list_jobs = QListWidget()
+        self.list_jobs.setMaximumHeight(120)
+        queue_layout = QGridLayout()
+        queue_layout.addWidget(btn_enqueue, 0, 0)
+        queue_layout.addWidget(self.btn_run_queue, 0, 1)
+        queue_layout.addWidget(QLabel("Concurrent jobs:"), 1, 0)
+        queue_layout.addWidget(self.lineedit_queue_limit, 1, 1)
+        queue_layout.addWidget(self.list_jobs, 2, 0, 1, -1)
+        queue_layout.addWidget(btn_remove_job, 3, 0)
+        queue_layout.addWidget(btn_clear_jobs, 3, 1)
+        queue_box.setLayout(queue_layout)
+
         vadvanced_parameter = QVBoxLayout()
         self.intensity_normalization = IntensityNormalization(self)
         vadvanced_parameter.addWidget(self.intensity_normalization)
@@ -341,9 +671,20 @@ class FusionWidget(QWidget):
         # layout.addWidget(input1, 1, 0, 1, -1)
         # layout.addWidget(input2, 2, 0, 1, -1)
         layout.addWidget(parameters, 3, 0, 1, -1)
-        layout.addWidget(self.label_tmp_path, 4, 0, 1, -1)
-        layout.addWidget(btn_process, 5, 0)
-        layout.addWidget(btn_save, 5, 1)
+        layout.addWidget(self.tiling_box, 4, 0, 1, -1)
+        layout.addWidget(self.timelapse_box, 5, 0, 1, -1)
+        layout.addWidget(self.channels_box, 6, 0, 1, -1)
+        layout.addWidget(weights_box, 7, 0, 1, -1)
+        layout.addWidget(preview_box, 8, 0, 1, -1)
+        layout.addWidget(self.label_tmp_path, 9, 0, 1, -1)
+        layout.addWidget(self.btn_process, 10, 0)
+        layout.addWidget(btn_save, 10, 1)
+        layout.addWidget(self.progress_bar, 11, 0)
+        layout.addWidget(self.btn_cancel, 11, 1)
+        layout.addWidget(self.label_progress, 12, 0, 1, -1)
+        layout.addWidget(self.label_estimate, 13, 0, 1, -1)
+        layout.addWidget(self.profile_box, 14, 0, 1, -1)
+        layout.addWidget(queue_box, 15, 0, 1, -1)
 
         widget = QWidget()
         widget.setLayout(layout)
@@ -389,9 +730,37 @@ class FusionWidget(QWidget):
                 self.image_config_is_valid = False
                 break
 
+    def _pin_layer(self, layer):
+        # pins the files the layer maps in the scratch root it was written
+        # to, replacing the pins of its previous data
+        self._unpin_layer(layer)
+        root = layer.metadata.get(SCRATCH_ROOT)
+        if root is None:
+            return
+        data = getattr(layer, "data", None)
+        levels = data if getattr(layer, "multiscale", False) else [data]
+        files = [
+            region[0]
+            for region in map(mapped_file, levels)
+            if region is not None
+        ]
+        if not files:
+            return
+        store = ScratchStore(root)
+        pinned = [path for path in files if store.pin(path) is not None]
+        if pinned:
+            self._layer_pins[id(layer)] = (store, pinned)
+            self.logger.debug("Pinned scratch files of %s", layer.name)
+
+    def _unpin_layer(self, layer):
+        store, pinned = self._layer_pins.pop(id(layer), (None, []))
+        for path in pinned:
+            store.unpin(path)
+
     def get_path(self):
         path = QFileDialog.getExistingDirectory(self, "Select Directory")
-        self.label_tmp_path.setText(path)
+        if path:
+            self.label_tmp_path.setText(path)
 
     def _toggle_registration(self, event):
         if event == Qt.Checked:
@@ -405,6 +774,27 @@ class FusionWidget(QWidget):
             self.lineedit_lateral_resolution.setVisible(False)
             self.lineedit_axial_resolution.setVisible(False)
 
+    def _toggle_reuse(self, _):
+        # time-lapse, multi-channel fusion and saved weights reuse the
+        # weights of a fusion, which registered or flipped views can't
+        reuse = reusable(
+            {
+                "require_registration": (
+                    self.checkbox_req_registration.isChecked()
+                ),
+                "require_flip_illu": self.checkbox_req_flip_illu.isChecked(),
+                "require_flip_det": self.checkbox_req_flip_det.isChecked(),
+            }
+        )
+        for widget in (
+            self.timelapse_box,
+            self.channels_box,
+            self.checkbox_save_weights,
+        ):
+            if not reuse:
+                widget.setChecked(False)
+            widget.setEnabled(reuse)
+
     def _set_input_visible(self, numbers, visible):
         if isinstance(numbers, int):
             numbers = [numbers]
@@ -478,18 +868,27 @@ class FusionWidget(QWidget):
                 return
             layername = layernames[index]
         self.logger.debug(f"Selected layer: {layername}")
-        data = self.viewer.layers[self.viewer.layers.index(layername)].data
+        layer = self.viewer.layers[self.viewer.layers.index(layername)]
+        # multiscale layers are saved at full resolution
+        data = layer.data[0] if layer.multiscale else layer.data
         self.logger.debug(f"Data shape: {data.shape}")
         self.logger.debug(f"Data dtype: {data.dtype}")
         filepath = save_dialog(self)
-        if filepath == ".tiff" or filepath == ".tif":
+        if not filepath:
             self.logger.info("No file selected")
             return
         self.logger.debug(f"Filepath: {filepath}")
-        write_tiff(filepath, data)
+        meta = {"scale": list(layer.scale)}
+        if filepath.endswith(".zarr"):
+            write_zarr(filepath, data, meta)
+        else:
+            write_tiff(filepath, data, meta)
         self.logger.info("Data saved")
 
     def _process_on_click(self):
+        if self.worker is not None:
+            self.logger.error("A fusion is already running")
+            return
         params = self._get_parameters()
         if params is None:
             return
@@ -500,13 +899,755 @@ class FusionWidget(QWidget):
         }
         self.logger.debug(filtered_dict)
 
-        if params["method"] == "illumination":
-            model = FUSE_illu()
+        run = self._get_admitted_run(params)
+        if run is None:
+            return
+        weights_path = None
+        if self.checkbox_save_weights.isChecked():
+            weights_path = self._get_weights_path(params, run)
+            if weights_path is None:
+                return
+        function, args = self._fusion_call(params, *run)
+        placement = self._source_placement(params, channels=run[2])
+        if self._start_worker(
+            function,
+            args,
+            lambda result: self._on_fusion_returned(
+                result, placement=placement, scratch_root=params["tmp_path"]
+            ),
+            pyramid=True,
+            weights_path=weights_path,
+        ):
+            self.logger.info("Fusion started")
+
+    def _get_weights_path(self, params, run):
+        # file the weights of the fusion are saved to, None if they can't
+        # be saved
+        _, timelapse, channels = run
+        if timelapse is not None or channels is not None:
+            self.logger.error("Weights can only be saved for single volumes")
+            return None
+        try:
+            validate_reuse(params)
+        except ValueError as e:
+            self.logger.error("Weights can't be saved: %s", e)
+            return None
+        path, _ = QFileDialog.getSaveFileName(
+            self, "Save fusion weights", "", "Fusion weights (*.npz)"
+        )
+        if not path:
+            self.logger.info("No file selected")
+            return None
+        return path
+
+    def _apply_weights_on_click(self):
+        if self.worker is not None:
+            self.logger.error("A fusion is already running")
+            return
+        params = self._get_parameters()
+        if params is None:
+            return
+        path, _ = QFileDialog.getOpenFileName(
+            self, "Apply fusion weights", "", "Fusion weights (*.npz)"
+        )
+        if not path:
+            self.logger.info("No file selected")
+            return
+        try:
+            check_metadata(read_metadata(path), params)
+        except (OSError, KeyError, ValueError) as e:
+            self.logger.error("Invalid weights: %s", e)
+            return
+        placement = self._source_placement(params)
+        # applying is cheaper than looking up the cache
+        if self._start_worker(
+            run_apply_weights,
+            (params, path),
+            lambda result: self._on_fusion_returned(
+                result, placement=placement, scratch_root=params["tmp_path"]
+            ),
+            pyramid=True,
+            cached=False,
+        ):
+            self.logger.info("Applying saved weights")
+
+    def _get_admitted_run(self, params):
+        # tiling, time-lapse and multi-channel settings chosen in the
+        # widget, the tiling possibly changed by the resource check, None
+        # if not admitted
+        if self.timelapse_box.isChecked() and self.channels_box.isChecked():
+            self.logger.error(
+                "Time-lapse and multi-channel fusion can't be combined"
+            )
+            return None
+        if self.timelapse_box.isChecked():
+            timelapse = self._get_timelapse(params)
+            if timelapse is None:
+                return None
+            # the stacked output, the weights and the timepoints fused or
+            # weighed in parallel
+            admitted, _ = self._check_resources(
+                params, None, offer_tiling=False, stacked=timelapse[1]
+            )
+            return (None, timelapse, None) if admitted else None
+        if self.channels_box.isChecked():
+            channels = self._get_channels(params)
+            if channels is None:
+                return None
+            # like time-lapse fusion with the reference as the keyframe
+            admitted, _ = self._check_resources(
+                params, None, offer_tiling=False, stacked=channels[1]
+            )
+            return (None, None, channels) if admitted else None
+        tiling = None
+        if self.tiling_box.isChecked():
+            tiling = self._get_tiling(params)
+            if tiling is None:
+                return None
+        admitted, tiling = self._check_resources(params, tiling)
+        return (tiling, None, None) if admitted else None
+
+    def _get_timelapse(self, params):
+        if self.tiling_box.isChecked():
+            self.logger.error(
+                "Tiled processing of time-lapse images is not supported"
+            )
+            return None
+        try:
+            every_text = self.lineedit_keyframe_interval.text().strip()
+            every = int(every_text) if every_text else FIRST_ONLY
+            workers = int(self.lineedit_timelapse_workers.text())
+        except ValueError:
+            self.logger.error("Invalid time-lapse parameters")
+            return None
+        try:
+            validate_reuse(params)
+        except ValueError as e:
+            self.logger.error("Time-lapse fusion is not possible: %s", e)
+            return None
+        try:
+            keyframes(frame_count(params), every)
+        except ValueError as e:
+            self.logger.error(str(e))
+            return None
+        return every, max(1, workers)
+
+    def _get_channels(self, params):
+        # moves the channel axis of the images in params to the front
+        if self.tiling_box.isChecked():
+            self.logger.error(
+                "Tiled processing of multi-channel images is not supported"
+            )
+            return None
+        try:
+            reference = int(self.lineedit_reference_channel.text())
+            workers = int(self.lineedit_channel_workers.text())
+        except ValueError:
+            self.logger.error("Invalid multi-channel parameters")
+            return None
+        labels = [
+            self.label_illu1,
+            self.label_illu2,
+            self.label_illu3,
+            self.label_illu4,
+        ]
+        for index in image_keys(params["method"], params["amount"]):
+            layer = self.viewer.layers[labels[index - 1].text()]
+            params[f"image{index}"] = channels_first(
+                params[f"image{index}"], layer.metadata.get("axes")
+            )
+        try:
+            validate_reuse(params)
+        except ValueError as e:
+            self.logger.error("Multi-channel fusion is not possible: %s", e)
+            return None
+        try:
+            n_channels = channel_count(params)
+        except ValueError as e:
+            self.logger.error(str(e))
+            return None
+        if not 0 <= reference < n_channels:
+            self.logger.error(
+                "Reference channel must be between 0 and %d", n_channels - 1
+            )
+            return None
+        return reference, max(1, workers)
+
+    def _fusion_call(self, params, tiling, timelapse=None, channels=None):
+        if channels is not None:
+            self.logger.debug("Multi-channel: %s", channels)
+            return run_multichannel, (params, *channels)
+        if timelapse is not None:
+            self.logger.debug("Time-lapse: %s", timelapse)
+            return run_timelapse, (params, *timelapse)
+        if tiling is not None:
+            self.logger.debug("Tiling: %s", tiling)
+            return run_tiled_fusion, (params, *tiling)
+        return run_fusion, (params,)
+
+    def _check_resources(
+        self, params, tiling, offer_tiling=True, stacked=None
+    ):
+        # compare the estimated needs of the run with what is available
+        os.makedirs(params["tmp_path"], exist_ok=True)
+        needed = estimate(params, tiling, stacked)
+        available = available_resources(params["tmp_path"])
+        self.label_estimate.setText(
+            f"Estimated memory: {format_bytes(needed.memory)} "
+            f"({format_bytes(available.memory)} available), "
+            f"disk: {format_bytes(needed.disk)} "
+            f"({format_bytes(available.disk)} free)"
+        )
+        self.logger.debug("Estimated %s, available %s", needed, available)
+        if fits(needed, available):
+            return True, tiling
+
+        if tiling is None and offer_tiling:
+            try:
+                validate_tiling(params, None, None)
+            except ValueError:
+                slab_size = None
+            else:
+                slab_size = largest_slab_size(params, available)
+            if slab_size is not None:
+                answer = QMessageBox.question(
+                    self,
+                    "Not enough resources",
+                    "The fusion is not expected to fit into the available "
+                    "memory or disk space.\n"
+                    f"Switch to tiled processing with slabs of {slab_size} "
+                    "planes?",
+                )
+                if answer == QMessageBox.Yes:
+                    self.tiling_box.setChecked(True)
+                    self.lineedit_slab_size.setText(str(slab_size))
+                    self.lineedit_overlap.clear()
+                    self.lineedit_tile_workers.setText("1")
+                    return True, (slab_size, None, 1)
+        self.logger.error(
+            "The fusion is not expected to fit into the available memory or "
+            "disk space"
+        )
+        return False, tiling
+
+    def _preview_on_click(self):
+        if self.worker is not None:
+            self.logger.error("A fusion is already running")
+            return
+        params = self._get_parameters()
+        if params is None:
+            return
+        crop = self._get_crop(params)
+        if crop is None:
+            return
+        z_range, stride, scale, translate = crop
+        if self._start_worker(
+            run_preview,
+            (params, z_range, stride),
+            lambda output_image: self._on_preview_returned(
+                output_image, scale, translate, params["tmp_path"]
+            ),
+        ):
+            self.logger.info("Preview started")
+
+    def _sweep_on_click(self):
+        if self.worker is not None:
+            self.logger.error("A fusion is already running")
+            return
+        params = self._get_parameters()
+        if params is None:
+            return
+        crop = self._get_crop(params)
+        if crop is None:
+            return
+        z_range, stride, scale, translate = crop
+        try:
+            values = (
+                parse_values(
+                    self.lineedit_sweep_window_size_Y.text(),
+                    params["window_size"][0],
+                ),
+                parse_values(
+                    self.lineedit_sweep_window_size_X.text(),
+                    params["window_size"][1],
+                ),
+                parse_values(
+                    self.lineedit_sweep_gf_kernel_size.text(),
+                    params["GF_kernel_size"],
+                ),
+            )
+            workers = int(self.lineedit_sweep_workers.text())
+        except ValueError:
+            self.logger.error("Invalid sweep values")
+            return
+        try:
+            combinations = sweep_combinations(params, *values)
+        except ValueError as e:
+            self.logger.error(str(e))
+            return
+        self.logger.debug("Sweep combinations: %s", combinations)
+        if self._start_worker(
+            run_sweep,
+            (params, combinations, z_range, stride, max(1, workers)),
+            lambda output_image: self._on_sweep_returned(
+                output_image,
+                scale,
+                translate,
+                combinations,
+                params["tmp_path"],
+            ),
+        ):
+            self.logger.info("Sweep of %d runs started", len(combinations))
+
+    def _get_crop(self, params):
+        try:
+            z_range = tuple(
+                int(lineedit.text()) if lineedit.text().strip() else None
+                for lineedit in (
+                    self.lineedit_preview_z_start,
+                    self.lineedit_preview_z_stop,
+                )
+            )
+            stride = int(self.lineedit_preview_stride.text())
+        except ValueError:
+            self.logger.error("Invalid preview range or stride")
+            return None
+        if stride < 1:
+            self.logger.error("Stride must be positive")
+            return None
+
+        # place the crop on top of the region it was computed from
+        level_scale, level_translate = self._source_placement(params)
+        z_start = z_range[0] or 0
+        if z_start < 0:
+            z_start += params["image1"].shape[0]
+        scale = level_scale * [1, stride, stride]
+        translate = level_translate + [z_start * level_scale[0], 0, 0]
+        return z_range, stride, scale, translate
+
+    def _source_placement(self, params, channels=None):
+        # scale and translate of the Z, Y and X axes that place a fusion of
+        # params on top of its first input layer, the scale of lower
+        # pyramid levels follows from their shape
+        reference = self.viewer.layers[self.label_illu1.text()]
+        order = list(range(reference.ndim))
+        axes = reference.metadata.get("axes")
+        if (
+            channels is not None
+            and axes
+            and len(axes) == reference.ndim
+            and "C" in axes.upper()
+        ):
+            # the channel axis was moved first, see _get_channels
+            order.insert(0, order.pop(axes.upper().index("C")))
+        scale = np.asarray(reference.scale)[order][-3:]
+        shape = np.asarray(reference.data.shape)[order][-3:]
+        translate = np.asarray(reference.translate)[order][-3:]
+        return scale * shape / params["image1"].shape[-3:], translate
+
+    def _prepare_run(
+        self, function, args, pyramid=False, weights_path=None, cached=True
+    ):
+        # wraps a fusion function into its scratch run, the cache, the
+        # weight fitting, the pyramid and the profile, returns None for an
+        # invalid budget
+        # the first argument of every fusion function is params, its
+        # tmp_path is the scratch root until the run gets its own directory
+        params, *args = args
+        store = self._get_scratch_store(params["tmp_path"])
+        if store is None:
+            return None
+        label = function.__name__.removeprefix("run_")
+        run = store.new_run(label, params)
+        self.logger.debug("Scratch directory: %s", run)
+        run_params = {**params, "tmp_path": str(run)}
+        args = (run_params, *args)
+        if cached and self.checkbox_use_cache.isChecked():
+            function, args = run_cached, (store.cache(), function, *args)
+        if weights_path is not None:
+            # also for cached results, which weren't fitted before
+            function, args = run_and_save_weights, (
+                weights_path,
+                run_params,
+                function,
+                *args,
+            )
+        if pyramid:
+            # cached is the full resolution, the pyramid is rebuilt
+            function, args = run_with_pyramid, (function, *args)
+        profile = RunProfile(run.name)
+        function, args = profile_run, (profile, function, *args)
+        return function, args, store, run, profile
+
+    def _get_scratch_store(self, root):
+        # store with the budget set in the widget, None if it is invalid
+        try:
+            budget = float(self.lineedit_scratch_budget.text())
+        except ValueError:
+            self.logger.error("Invalid scratch budget")
+            return None
+        return ScratchStore(root, int(budget * 1024**3))
+
+    def _finish_run(self, store, run, profile):
+        # cancelled runs stop without ending their last stage
+        profile.stop()
+        path = profile.save(store.root / "profiles" / f"{run.name}.json")
+        self.label_profile.setText(profile.summary())
+        self.logger.debug("Run statistics written to %s", path)
+        # no-op for runs that were discarded
+        store.finish(run)
+
+    def _start_worker(
+        self,
+        function,
+        args,
+        on_returned,
+        pyramid=False,
+        weights_path=None,
+        cached=True,
+    ):
+        prepared = self._prepare_run(
+            function, args, pyramid, weights_path, cached
+        )
+        if prepared is None:
+            return False
+        function, args, self.scratch_store, self.scratch_run, self.profile = (
+            prepared
+        )
+        # FUSE runs in a separate thread to keep the viewer responsive
+        self.worker = self._create_worker(function, args)
+        self.worker.yielded.connect(self._on_fusion_progress)
+        self.worker.returned.connect(
+            lambda output_image: self._on_worker_returned(
+                output_image, on_returned
+            )
+        )
+        self.worker.errored.connect(self._on_fusion_errored)
+        self.worker.aborted.connect(self._on_fusion_aborted)
+        self.worker.finished.connect(self._on_fusion_finished)
+
+        self.btn_process.setEnabled(False)
+        self.btn_preview.setEnabled(False)
+        self.btn_sweep.setEnabled(False)
+        self.btn_apply_weights.setEnabled(False)
+        self.btn_cancel.setEnabled(True)
+        self.progress_bar.setValue(0)
+        self.progress_bar.setVisible(True)
+        self.worker.start()
+        return True
+
+    def _create_worker(self, function, args):
+        # the widget closes the generator once the worker stopped, which
+        # terminates the FUSE process of a cancelled fusion, see run_fusion.
+        # Connected first, so the process is gone before the scratch run of
+        # the fusion is discarded
+        run = function(*args)
+        worker = create_worker(_forward, run, _start_thread=False)
+        worker.aborted.connect(run.close)
+        worker.finished.connect(run.close)
+        return worker
+
+    def _cancel_on_click(self):
+        if self.worker is None:
+            return
+        # fusions stop within a second, tiles, timepoints and pyramid
+        # levels that are being processed are finished first
+        self.worker.quit()
+        self.btn_cancel.setEnabled(False)
+        self.label_progress.setText("Cancelling...")
+        self.logger.info("Cancel requested")
+
+    def _on_fusion_progress(self, progress):
+        step, total, stage = progress
+        self.progress_bar.setRange(0, total)
+        self.progress_bar.setValue(step)
+        # stages are reported again while they run
+        if stage != self.label_progress.text():
+            self.label_progress.setText(stage)
+            self.logger.debug("Fusion stage: %s", stage)
+
+    def _on_worker_returned(self, output_image, on_returned):
+        with self.profile.stage("Adding layer"):
+            on_returned(output_image)
+
+    def _on_fusion_returned(
+        self, result, name=None, placement=None, scratch_root=None
+    ):
+        # the pyramid and contrast limits are computed by the worker, the
+        # result is placed on top of its inputs, see _source_placement, and
+        # records the scratch root its files are pinned in
+        levels, limits = result
+        kwargs = {
+            "name": name,
+            "contrast_limits": limits,
+            "metadata": {SCRATCH_ROOT: scratch_root},
+        }
+        if placement is not None:
+            scale, translate = placement
+            # time-lapse and multi-channel results have a leading axis
+            leading = levels[0].ndim - len(scale)
+            kwargs["scale"] = [1] * leading + list(scale)
+            kwargs["translate"] = [0] * leading + list(translate)
+        if len(levels) == 1:
+            self.viewer.add_image(levels[0], **kwargs)
+        else:
+            self.viewer.add_image(levels, multiscale=True, **kwargs)
+        self.logger.info("Fusion finished")
+
+    def _on_preview_returned(self, output_image, scale, translate, root):
+        # every preview replaces the previous one, the scratch root is set
+        # before the data so the new data is pinned in it
+        metadata = {SCRATCH_ROOT: root}
+        if PREVIEW_LAYER in self.viewer.layers:
+            layer = self.viewer.layers[PREVIEW_LAYER]
+            layer.metadata.update(metadata)
+            layer.data = output_image
+            layer.scale = scale
+            layer.translate = translate
+            layer.reset_contrast_limits()
+        else:
+            self.viewer.add_image(
+                output_image,
+                name=PREVIEW_LAYER,
+                scale=scale,
+                translate=translate,
+                metadata=metadata,
+            )
+        self.logger.info("Preview finished")
+
+    def _on_sweep_returned(
+        self, output_image, scale, translate, combinations, root
+    ):
+        # the first axis steps through the combinations, the metadata is
+        # set before the data so the new data is pinned in the scratch root
+        scale = [1, *scale]
+        translate = [0, *translate]
+        metadata = {"sweep": combinations, SCRATCH_ROOT: root}
+        if SWEEP_LAYER in self.viewer.layers:
+            layer = self.viewer.layers[SWEEP_LAYER]
+            layer.metadata.update(metadata)
+            layer.data = output_image
+            layer.scale = scale
+            layer.translate = translate
+            layer.reset_contrast_limits()
+        else:
+            self.viewer.add_image(
+                output_image,
+                name=SWEEP_LAYER,
+                scale=scale,
+                translate=translate,
+                metadata=metadata,
+            )
+        for index, combination in enumerate(combinations):
+            self.logger.info(
+                "Sweep %d: window size %s, GF kernel size %s",
+                index,
+                combination["window_size"],
+                combination["GF_kernel_size"],
+            )
+        self.logger.info("Sweep finished")
+
+    def _on_fusion_errored(self, error):
+        self.label_progress.setText("Fusion failed")
+        self.logger.error("Fusion failed: %s", error)
+        self.scratch_store.discard(self.scratch_run)
+
+    def _on_fusion_aborted(self):
+        self.label_progress.setText("Fusion cancelled")
+        self.logger.info("Fusion cancelled")
+        self.scratch_store.discard(self.scratch_run)
+
+    def _on_fusion_finished(self):
+        self._finish_run(self.scratch_store, self.scratch_run, self.profile)
+        self.worker = None
+        self.btn_process.setEnabled(True)
+        self.btn_preview.setEnabled(True)
+        self.btn_sweep.setEnabled(True)
+        self.btn_apply_weights.setEnabled(True)
+        self.btn_cancel.setEnabled(False)
+        self.progress_bar.setVisible(False)
+
+    def _enqueue_on_click(self):
+        params = self._get_parameters()
+        if params is None:
+            return
+        # checked now, so the dialog to switch to tiles doesn't pop up
+        # while the queue runs
+        run = self._get_admitted_run(params)
+        if run is None:
+            return
+        job = self.job_queue.add(
+            f"{self.label_illu1.text()} fused", params, *run
+        )
+        # the input layers may be gone once the job returns
+        self.job_placements[job.id] = self._source_placement(
+            params, channels=run[2]
+        )
+        self.logger.info("Job #%d queued", job.id)
+        self._update_job_list()
+        self._run_queue()
+
+    def _run_queue_on_click(self):
+        if self.queue_active:
+            # running jobs finish, queued jobs wait
+            self.queue_active = False
+            self.btn_run_queue.setText("Run queue")
+            self.logger.info("Queue paused")
+            return
+        try:
+            self.job_queue.limit = int(self.lineedit_queue_limit.text())
+        except ValueError:
+            self.logger.error("Invalid number of concurrent jobs")
+            return
+        self.queue_active = True
+        self.btn_run_queue.setText("Pause queue")
+        self.logger.info("Queue started")
+        self._run_queue()
+
+    def _run_queue(self):
+        # starts queued jobs while slots and resources are free
+        while self.queue_active:
+            job = self.job_queue.next_job()
+            if job is None:
+                return
+            if self.job_queue.running():
+                stacked = None
+                if job.timelapse is not None:
+                    stacked = job.timelapse[1]
+                elif job.channels is not None:
+                    stacked = job.channels[1]
+                needed = estimate(job.params, job.tiling, stacked)
+                available = available_resources(job.params["tmp_path"])
+                if not fits(needed, available):
+                    # wait for a running job to free its resources
+                    job.message = "waiting for resources"
+                    self._update_job_list()
+                    return
+            if not self._start_job(job):
+                self.job_queue.finish(job, FAILED, "could not start")
+                self._update_job_list()
+
+    def _start_job(self, job):
+        function, args = self._fusion_call(
+            job.params, job.tiling, job.timelapse, job.channels
+        )
+        prepared = self._prepare_run(function, args, pyramid=True)
+        if prepared is None:
+            return False
+        function, args, store, run, profile = prepared
+        self.job_queue.start(job)
+        worker = self._create_worker(function, args)
+        worker.yielded.connect(
+            lambda progress: self._on_job_progress(job, progress)
+        )
+        worker.returned.connect(
+            lambda result: self._on_job_returned(job, profile, result)
+        )
+        worker.errored.connect(
+            lambda error: self._on_job_errored(job, store, run, error)
+        )
+        worker.aborted.connect(lambda: self._on_job_aborted(job, store, run))
+        worker.finished.connect(
+            lambda: self._on_job_finished(job, store, run, profile)
+        )
+        self.job_workers[job.id] = worker
+        self._update_job_list()
+        worker.start()
+        self.logger.info("Job #%d started", job.id)
+        return True
+
+    def _on_job_progress(self, job, progress):
+        step, total, stage = progress
+        job.message = f"{stage} ({step}/{total})"
+        self._update_job_list()
+
+    def _on_job_returned(self, job, profile, result):
+        with profile.stage("Adding layer"):
+            self._on_fusion_returned(
+                result,
+                name=job.label,
+                placement=self.job_placements.pop(job.id, None),
+                scratch_root=job.params["tmp_path"],
+            )
+        self.job_queue.finish(job, DONE)
+        self.logger.info("Job #%d finished", job.id)
+
+    def _on_job_errored(self, job, store, run, error):
+        self.job_queue.finish(job, FAILED, str(error))
+        self.logger.error("Job #%d failed: %s", job.id, error)
+        store.discard(run)
+
+    def _on_job_aborted(self, job, store, run):
+        self.job_queue.finish(job, CANCELLED)
+        self.logger.info("Job #%d cancelled", job.id)
+        store.discard(run)
+
+    def _on_job_finished(self, job, store, run, profile):
+        self._finish_run(store, run, profile)
+        del self.job_workers[job.id]
+        self.job_placements.pop(job.id, None)
+        self._update_job_list()
+        self._run_queue()
+
+    def _remove_job_on_click(self):
+        row = self.list_jobs.currentRow()
+        if row < 0:
+            self.logger.info("No job selected")
+            return
+        job = self.job_queue.jobs[row]
+        if job.status == RUNNING:
+            # stops like a cancelled fusion, see _cancel_on_click
+            self.job_workers[job.id].quit()
+            job.message = "cancelling"
+            self.logger.info("Cancel of job #%d requested", job.id)
         else:
-            model = FUSE_det()
+            self.job_queue.remove(job)
+            self.job_placements.pop(job.id, None)
+            self.logger.info("Job #%d removed", job.id)
+        self._update_job_list()
+
+    def _clear_jobs_on_click(self):
+        self.job_queue.clear_finished()
+        self._update_job_list()
+
+    def _update_job_list(self):
+        row = self.list_jobs.currentRow()
+        self.list_jobs.clear()
+        self.list_jobs.addItems(
+            [job.describe() for job in self.job_queue.jobs]
+        )
+        self.list_jobs.setCurrentRow(min(row, self.list_jobs.count() - 1))
 
-        output_image = model.train_from_params(params)
-        self.viewer.add_image(output_image)  # set name of layer
+    def _get_tiling(self, params):
+        try:
+            slab_text = self.lineedit_slab_size.text().strip()
+            slab_size = int(slab_text) if slab_text else None
+            overlap_text = self.lineedit_overlap.text().strip()
+            overlap = int(overlap_text) if overlap_text else None
+            workers = int(self.lineedit_tile_workers.text())
+        except ValueError:
+            self.logger.error("Invalid tiling parameters")
+            return None
+        try:
+            validate_tiling(params, slab_size, overlap)
+        except ValueError as e:
+            self.logger.error(str(e))
+            return None
+        return slab_size, overlap, max(1, workers)
+
+    def _layer_data(self, name, level):
+        # data of a layer at a pyramid level, kept lazy until the worker
+        # reads it
+        layer = self.viewer.layers[name]
+        if not layer.multiscale:
+            if level != 0:
+                raise ValueError(f"Layer {name} has no pyramid levels")
+            return layer.data
+        if not 0 <= level < len(layer.data):
+            raise ValueError(
+                f"Layer {name} has {len(layer.data)} pyramid levels"
+            )
+        return layer.data[level]
 
     def _get_parameters(self):
         self.logger.debug("Compiling parameters")
@@ -520,6 +1661,12 @@ class FusionWidget(QWidget):
 
         params = {}
 
+        try:
+            level = int(self.lineedit_pyramid_level.text())
+        except ValueError:
+            self.logger.error("Invalid pyramid level")
+            return None
+
         method = self.method.text()
         params["method"] = method
         if method == "detection":
@@ -527,32 +1674,35 @@ class FusionWidget(QWidget):
         else:
             amount = 2
         params["amount"] = amount
-        image1_name = self.label_illu1.text()
-        params["image1"] = self.viewer.layers[image1_name].data
-        params["direction1"] = self.label_selected_direction1.text()
-
-        if method == "illumination" or amount == 4:
-            image2_name = self.label_illu2.text()
-            params["image2"] = self.viewer.layers[image2_name].data
-            params["direction2"] = self.label_selected_direction2.text()
-
-        if method == "detection":
-            image3_name = self.label_illu3.text()
-            params["image3"] = self.viewer.layers[image3_name].data
-            params["direction3"] = self.label_selected_direction3.text()
-            if amount == 4:
-                image4_name = self.label_illu4.text()
-                params["image4"] = self.viewer.layers[image4_name].data
-                params["direction4"] = self.label_selected_direction4.text()
+        try:
+            image1_name = self.label_illu1.text()
+            params["image1"] = self._layer_data(image1_name, level)
+            params["direction1"] = self.label_selected_direction1.text()
+
+            if method == "illumination" or amount == 4:
+                image2_name = self.label_illu2.text()
+                params["image2"] = self._layer_data(image2_name, level)
+                params["direction2"] = self.label_selected_direction2.text()
+
+            if method == "detection":
+                image3_name = self.label_illu3.text()
+                params["image3"] = self._layer_data(image3_name, level)
+                params["direction3"] = self.label_selected_direction3.text()
+                if amount == 4:
+                    image4_name = self.label_illu4.text()
+                    params["image4"] = self._layer_data(image4_name, level)
+                    params["direction4"] = (
+                        self.label_selected_direction4.text()
+                    )
+        except ValueError as e:
+            self.logger.error(str(e))
+            return None
 
         try:
             params["resample_ratio"] = int(self.lineedit_resample_ratio.text())
         except ValueError:
             self.logger.error("Invalid resample ratio")
             return
-        if not (1 <= params["resample_ratio"] <= 5):
-            self.logger.error("Resample ratio must be between 1 and 5")
-            return
         try:
             params["window_size"] = (
                 int(self.lineedit_window_size_Y.text()),
@@ -561,20 +1711,11 @@ class FusionWidget(QWidget):
         except ValueError:
             self.logger.error("Invalid window size")
             return
-        if not (
-            9 <= params["window_size"][0] <= 89
-            and 3 <= params["window_size"][1] <= 29
-        ):
-            self.logger.error("Window size must be between 3x9 and 29x89")
-            return
         try:
             params["GF_kernel_size"] = int(self.lineedit_gf_kernel_size.text())
         except ValueError:
             self.logger.error("Invalid GF kernel size")
             return
-        if not (29 <= params["GF_kernel_size"] <= 89):
-            self.logger.error("GF kernel size must be between 29 and 89")
-            return
         params["require_segmentation"] = (
             self.checkbox_req_segmentation.isChecked()
         )
@@ -600,6 +1741,11 @@ class FusionWidget(QWidget):
         params["require_flip_det"] = self.checkbox_req_flip_det.isChecked()
         params["keep_intermediates"] = self.checkbox_keep_tmp.isChecked()
         params["tmp_path"] = self.label_tmp_path.text()
+        try:
+            validate_parameters(params)
+        except ValueError as e:
+            self.logger.error(str(e))
+            return
         self.logger.debug(f"Parameters: {params.keys()}")
         return params
 
@@ -607,7 +1753,7 @@ class FusionWidget(QWidget):
 class LayerSelection(QDialog):
     def __init__(self, layernames: list[str]):
         super().__init__()
-        self.setWindowTitle("Select Layer to save as TIFF")
+        self.setWindowTitle("Select Layer to save")
         self.combobox = QComboBox()
         self.combobox.addItems(layernames)
         btn_select = QPushButton("Select")
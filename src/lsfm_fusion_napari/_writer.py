@@ -1,52 +1,459 @@
 """
-This module is an example of a barebones writer plugin for napari.
+Writers for fused volumes.
 
 It implements the Writer specification.
 see: https://napari.org/stable/plugins/guides.html?#writers
 
-Replace code below according to your needs.
+write_tiff saves a volume as a BigTIFF OME-TIFF plane by plane, rescaled to
+uint16 if needed, with the scale and offset kept in the OME description.
+write_zarr saves it as a chunked OME-Zarr store with a multiscale pyramid,
+compressing chunks in parallel. Both store the layer scale as voxel size and
+read lazy data a block at a time.
 """
+
 from __future__ import annotations
 
+import itertools
+import json
+import os
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    wait,
+)
+from typing import Iterator
+from xml.etree import ElementTree
+
 import numpy as np
-from aicsimageio.writers import OmeTiffWriter
-from qtpy.QtWidgets import QFileDialog
+import tifffile
+
+from ._normalization import iter_data_chunks
+
+
+# OME dimension order of volumes by number of dimensions
+AXES = {2: "YX", 3: "ZYX", 4: "TZYX"}
+
+
+def voxel_size(meta: dict | None, ndim: int) -> list[float] | None:
+    """
+    Size of a voxel along every axis, from the layer attributes
+
+    Parameters
+    ----------
+    meta : dict or None
+        Layer attributes passed by napari, the scale is used
+    ndim : int
+        Number of dimensions of the data
+
+    Returns
+    -------
+    list[float] or None
+        Scale of the last ndim axes, None if the layer has none
+    """
+    scale = (meta or {}).get("scale")
+    if scale is None:
+        return None
+    scale = [float(size) for size in scale]
+    if len(scale) < ndim:
+        raise ValueError(f"Scale {scale} doesn't match {ndim}D data")
+    return scale[-ndim:]
+
+
+def value_range(data) -> tuple[float, float]:
+    """
+    Minimum and maximum of data, read chunk by chunk
+
+    Parameters
+    ----------
+    data : array-like
+        Input data, may be lazy
+
+    Returns
+    -------
+    tuple[float, float]
+        Minimum and maximum value
+    """
+    min_v, max_v = np.inf, -np.inf
+    for chunk in iter_data_chunks(data):
+        values = np.asarray(data[chunk])
+        min_v = min(min_v, float(values.min()))
+        max_v = max(max_v, float(values.max()))
+    return min_v, max_v
+
+
+def conversion_parameters(data, dtype: np.dtype) -> tuple[float, float]:
+    """
+    Find how to convert data to an integer dtype without losing its range
+
+    Data is stored as round((value - offset) * scale), so the original
+    values are recovered as stored / scale + offset. Data that already fits
+    into dtype is stored as it is, everything else is rescaled to the full
+    range of dtype. The value range is only computed if the dtypes alone
+    don't guarantee a fit.
+
+    Parameters
+    ----------
+    data : array-like
+        Input data, may be lazy
+    dtype : np.dtype
+        Integer data type to convert to
+
+    Returns
+    -------
+    tuple[float, float]
+        Scale and offset
+    """
+    if np.can_cast(data.dtype, dtype, casting="safe"):
+        return 1.0, 0.0
+    info = np.iinfo(dtype)
+    min_v, max_v = value_range(data)
+    if data.dtype.kind in "ui" and info.min <= min_v and max_v <= info.max:
+        return 1.0, 0.0
+    if max_v == min_v:
+        return 1.0, min_v - info.min
+    scale = (info.max - info.min) / (max_v - min_v)
+    return scale, min_v - info.min / scale
 
-def save_dialog(parent):
+
+def iter_planes(
+    data, dtype: np.dtype, scale: float = 1.0, offset: float = 0.0
+) -> Iterator[np.ndarray]:
     """
-    Opens a dialog to select a location to save a file
+    Iterate over the 2D planes of a volume, converted to dtype
+
+    Only one plane is read and converted at a time. Planes that already
+    have the right dtype and need no rescaling are not copied.
 
     Parameters
     ----------
-    parent : QWidget
-        Parent widget for the dialog
+    data : array-like
+        Volume of any dimensionality of at least 2, may be lazy
+    dtype : np.dtype
+        Data type of the planes
+    scale : float, optional
+        Factor applied after subtracting the offset, by default 1
+    offset : float, optional
+        Value subtracted before scaling, by default 0
+
+    Yields
+    ------
+    np.ndarray
+        One plane of the volume
+    """
+    rescale = scale != 1.0 or offset != 0.0
+    for index in np.ndindex(*data.shape[:-2]):
+        plane = np.asarray(data[index])
+        if rescale:
+            plane = np.subtract(plane, offset, dtype=np.float64)
+            plane *= scale
+            np.rint(plane, out=plane)
+            if dtype.kind in "ui":
+                info = np.iinfo(dtype)
+                np.clip(plane, info.min, info.max, out=plane)
+        yield plane.astype(dtype, copy=False)
+
+
+def read_conversion(path: str) -> tuple[float, float]:
+    """
+    Read the scale and offset stored by write_tiff
+
+    Parameters
+    ----------
+    path : str
+        Path of an OME-TIFF file
 
     Returns
     -------
-    str
-        Path of selected file
+    tuple[float, float]
+        Scale and offset, (1, 0) if none were stored
     """
-    dialog = QFileDialog()
-    filepath, _ = dialog.getSaveFileName(
-        parent,
-        "Select location for TIFF-File to be created",
-        filter="TIFF files (*tif *.tiff)",
+    with tifffile.TiffFile(path) as tif:
+        if not tif.is_ome:
+            return 1.0, 0.0
+        image = ElementTree.fromstring(tif.ome_metadata).find(
+            "{*}Image/{*}Description"
+        )
+    if image is None or not image.text:
+        return 1.0, 0.0
+    try:
+        description = json.loads(image.text)
+    except json.JSONDecodeError:
+        return 1.0, 0.0
+    return (
+        float(description.get("intensity_scale", 1.0)),
+        float(description.get("intensity_offset", 0.0)),
     )
-    if not (filepath.endswith(".tiff") or filepath.endswith(".tif")):
-        filepath += ".tiff"
-    return filepath
 
 
-def write_tiff(path: str, data: np.ndarray):
+def write_tiff(path: str, data: np.ndarray, meta: dict | None = None):
     """
-    Write data to a TIFF file
+    Write data to an OME-TIFF file
+
+    The file is written as BigTIFF, one plane after another, so it may
+    exceed 4 GB and the data never has to be converted as a whole. Data
+    that doesn't fit into uint16, e.g. floats in [0, 1], is rescaled to the
+    full uint16 range. The scale and offset are stored in the description
+    of the OME image, see read_conversion. The voxel size is stored as the
+    physical size of the OME pixels.
 
     Parameters
     ----------
     path : str
         Path to save the file
     data : np.ndarray
-        Data to save
+        Data to save, 2D (YX), 3D (ZYX) or 4D (TZYX)
+    meta : dict, optional
+        Layer attributes passed by napari, the scale is the voxel size
+
+    Returns
+    -------
+    list[str]
+        Path of the written file
     """
-    data = data.astype(np.uint16)
-    OmeTiffWriter.save(data, path, dim_order_out="YX")
+    if data.ndim not in AXES:
+        raise ValueError(f"Cannot write {data.ndim}D data as TIFF")
+    dtype = np.dtype(np.uint16)
+    scale, offset = conversion_parameters(data, dtype)
+    description = json.dumps(
+        {"intensity_scale": scale, "intensity_offset": offset}
+    )
+    metadata = {"axes": AXES[data.ndim], "Description": description}
+    sizes = voxel_size(meta, data.ndim)
+    if sizes is not None:
+        for axis, size in zip(AXES[data.ndim], sizes):
+            if axis == "T":
+                metadata["TimeIncrement"] = size
+            else:
+                metadata[f"PhysicalSize{axis}"] = size
+    with tifffile.TiffWriter(path, bigtiff=True, ome=True) as tif:
+        tif.write(
+            iter_planes(data, dtype, scale, offset),
+            shape=data.shape,
+            dtype=dtype,
+            photometric="minisblack",
+            metadata=metadata,
+        )
+    return [path]
+
+
+# compressors available for OME-Zarr, by Blosc codec name
+ZARR_COMPRESSORS = ("zstd", "lz4", "zlib", "none")
+
+# OME-NGFF axes by number of dimensions
+ZARR_AXES = {
+    2: [("y", "space"), ("x", "space")],
+    3: [("z", "space"), ("y", "space"), ("x", "space")],
+    4: [("t", "time"), ("z", "space"), ("y", "space"), ("x", "space")],
+}
+
+
+def _zarr_compressor(name: str):
+    from numcodecs import Blosc
+
+    if name not in ZARR_COMPRESSORS:
+        raise ValueError(f"Compressor must be one of {ZARR_COMPRESSORS}")
+    if name == "none":
+        return None
+    return Blosc(cname=name, clevel=5, shuffle=Blosc.BITSHUFFLE)
+
+
+def _chunk_slices(shape, chunks) -> Iterator[tuple[slice, ...]]:
+    # slices of all chunks of an array
+    grid = [range(0, size, chunk) for size, chunk in zip(shape, chunks)]
+    for starts in itertools.product(*grid):
+        yield tuple(
+            slice(start, min(start + chunk, size))
+            for start, chunk, size in zip(starts, chunks, shape)
+        )
+
+
+def default_levels(shape: tuple[int, ...], max_size: int = 512) -> int:
+    """
+    Number of pyramid levels until the planes are at most max_size wide
+
+    Every level halves Y and X, there are at most 8 levels.
+
+    Parameters
+    ----------
+    shape : tuple[int, ...]
+        Shape of the full resolution level
+    max_size : int, optional
+        Largest width or height of the smallest level, by default 512
+
+    Returns
+    -------
+    int
+        Number of levels including the full resolution
+    """
+    levels = 1
+    while max(shape[-2:]) / 2 ** (levels - 1) > max_size and levels < 8:
+        levels += 1
+    return levels
+
+
+def downsample(block: np.ndarray, factors: tuple[int, ...]) -> np.ndarray:
+    """
+    Reduce a block by averaging non-overlapping windows
+
+    Axes with a length that is not a multiple of their factor are padded
+    by repeating the last element.
+
+    Parameters
+    ----------
+    block : np.ndarray
+        Input data
+    factors : tuple[int, ...]
+        Window size along every axis
+
+    Returns
+    -------
+    np.ndarray
+        Reduced block with the dtype of the input
+    """
+    padding = [
+        (0, -size % factor) for size, factor in zip(block.shape, factors)
+    ]
+    if any(after for _, after in padding):
+        block = np.pad(block, padding, mode="edge")
+    shape = []
+    for size, factor in zip(block.shape, factors):
+        shape += [size // factor, factor]
+    reduced = block.reshape(shape).mean(
+        axis=tuple(range(1, 2 * block.ndim, 2)), dtype=np.float64
+    )
+    if block.dtype.kind in "uib":
+        np.rint(reduced, out=reduced)
+    return reduced.astype(block.dtype, copy=False)
+
+
+def _copy_chunks(executor, workers, target, read_block):
+    # fill target chunk by chunk, keeping only a few chunks in flight
+    pending = set()
+    for slices in _chunk_slices(target.shape, target.chunks):
+        if len(pending) >= 2 * workers:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+
+        def copy(slices=slices):
+            target[slices] = read_block(slices)
+
+        pending.add(executor.submit(copy))
+    for future in pending:
+        future.result()
+
+
+def write_zarr(
+    path: str,
+    data: np.ndarray,
+    meta: dict | None = None,
+    chunks: tuple[int, ...] | None = None,
+    compressor: str = "zstd",
+    levels: int | None = None,
+    workers: int | None = None,
+):
+    """
+    Write data to a chunked OME-Zarr store with a multiscale pyramid
+
+    Chunks are read, compressed and written in parallel on a thread pool,
+    with only a few chunks in memory at a time. Every pyramid level halves
+    the spatial axes and is computed chunk by chunk from the level before.
+    The scale of every level is the voxel size times its downsampling.
+
+    Parameters
+    ----------
+    path : str
+        Path of the store, usually ending with .zarr
+    data : np.ndarray
+        Data to save, 2D (YX), 3D (ZYX) or 4D (TZYX), may be lazy
+    meta : dict, optional
+        Layer attributes passed by napari, the scale is the voxel size
+    chunks : tuple[int, ...], optional
+        Chunk shape, by default 64 along Z and 256 along Y and X
+    compressor : str, optional
+        One of ZARR_COMPRESSORS, by default "zstd"
+    levels : int, optional
+        Number of resolution levels, by default until the planes are at
+        most 512 pixels wide
+    workers : int, optional
+        Number of threads, by default the number of CPUs
+
+    Returns
+    -------
+    list[str]
+        Path of the written store
+    """
+    import zarr
+
+    if data.ndim not in ZARR_AXES:
+        raise ValueError(f"Cannot write {data.ndim}D data as OME-Zarr")
+    axes = ZARR_AXES[data.ndim]
+    if chunks is None:
+        default = {"t": 1, "z": 64, "y": 256, "x": 256}
+        chunks = tuple(default[name] for name, _ in axes)
+    factors = tuple(2 if kind == "space" else 1 for _, kind in axes)
+    sizes = voxel_size(meta, data.ndim) or [1.0] * data.ndim
+    if levels is None:
+        levels = default_levels(data.shape)
+    workers = workers or os.cpu_count() or 1
+
+    group = zarr.open_group(path, mode="w")
+    datasets = []
+    previous = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for level in range(levels):
+            if previous is None:
+                shape = data.shape
+
+                def read_block(slices):
+                    return np.asarray(data[slices])
+
+            else:
+                shape = tuple(
+                    -(-size // factor)
+                    for size, factor in zip(previous.shape, factors)
+                )
+
+                def read_block(slices, source=previous):
+                    source_slices = tuple(
+                        slice(s.start * factor, s.stop * factor)
+                        for s, factor in zip(slices, factors)
+                    )
+                    return downsample(source[source_slices], factors)
+
+            target = group.create_dataset(
+                str(level),
+                shape=shape,
+                chunks=tuple(min(c, n) for c, n in zip(chunks, shape)),
+                dtype=data.dtype,
+                compressor=_zarr_compressor(compressor),
+                dimension_separator="/",
+                overwrite=True,
+            )
+            _copy_chunks(executor, workers, target, read_block)
+            datasets.append(
+                {
+                    "path": str(level),
+                    "coordinateTransformations": [
+                        {
+                            "type": "scale",
+                            "scale": [
+                                size * factor**level
+                                for size, factor in zip(sizes, factors)
+                            ],
+                        }
+                    ],
+                }
+            )
+            previous = target
+
+    group.attrs["multiscales"] = [
+        {
+            "version": "0.4",
+            "name": os.path.basename(os.path.normpath(path)),
+            "axes": [{"name": name, "type": kind} for name, kind in axes],
+            "datasets": datasets,
+            "type": "mean",
+        }
+    ]
+    return [path]